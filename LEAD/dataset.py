@@ -9,6 +9,7 @@ import csv
 import sys
 from tqdm import tqdm
 import unicodedata
+from token_cache import load_token_cache
 
 csv.field_size_limit(sys.maxsize)
 logger = logging.getLogger(__name__)
@@ -60,7 +61,9 @@ class TraditionDataset(Dataset):
         self.file_path = file_path
         self.tokenizer = tokenizer
         self.data = self.load_data()
-        self.passage = self.load_corpus_passage(args.passage_path)
+        # pre-tokenized passages written by token_cache.py, the raw corpus is only needed without them
+        self.passage_tokens = load_token_cache(args.token_cache_dir, 'passage', tokenizer, max_seq_length)
+        self.passage = self.load_corpus_passage(args.passage_path) if self.passage_tokens is None else None
         self.is_training = is_training
         self.num_hard_negatives = num_hard_negatives
         self.max_doc_length = max_seq_length
@@ -106,9 +109,9 @@ class TraditionDataset(Dataset):
     def __getitem__(self, index):
         json_sample = self.data[index]
         query = normalize_question(json_sample["question"])
-        positive_ctxs = [self.passage[int(elem)] for elem in json_sample["positive_ctxs"]]
+        positive_ctxs = [int(elem) for elem in json_sample["positive_ctxs"]]
         hard_negative_ctxs = (
-            [self.passage[int(elem)] for elem in json_sample["hard_negative_ctxs"]]
+            [int(elem) for elem in json_sample["hard_negative_ctxs"]]
             if "hard_negative_ctxs" in json_sample
             else []
         )
@@ -124,9 +127,13 @@ class TraditionDataset(Dataset):
         else:
             positive_passagese_ctx = positive_passages[0]
         ctxs = [positive_passagese_ctx] + hard_neg_ctxs
-        ctx_token_ids = [self.tokenizer.encode(ctx['title'], text_pair=ctx['text'].strip(), add_special_tokens=True,
-                                               max_length=self.max_doc_length, truncation=True,
-                                               pad_to_max_length=False) for ctx in ctxs]
+        if self.passage_tokens is not None:
+            ctx_token_ids = [self.passage_tokens[ctx_id].tolist() for ctx_id in ctxs]
+        else:
+            ctxs = [self.passage[ctx_id] for ctx_id in ctxs]
+            ctx_token_ids = [self.tokenizer.encode(ctx['title'], text_pair=ctx['text'].strip(), add_special_tokens=True,
+                                                   max_length=self.max_doc_length, truncation=True,
+                                                   pad_to_max_length=False) for ctx in ctxs]
         ctx_token_ids_col = [[self.D_marker_token_id] + elem[1:] for elem in ctx_token_ids]
 
         question_token_ids = self.tokenizer.encode(query)[:self.max_query_length]
@@ -4,6 +4,7 @@ import sys
 from torch.utils.data.dataset import Dataset
 
 sys.path += ['../']
+import time
 import json
 import logging
 import os
@@ -24,7 +25,12 @@ import regex
 
 logger = logging.getLogger(__name__)
 import faiss
-from util import set_env, get_arguments, load_model, Eval_Tool, is_first_worker, SimpleTokenizer
+from retrieval_metrics import hit_list_metrics, ranking_scores
+from util import set_env, get_arguments, load_model, is_first_worker, SimpleTokenizer
+from embedding_shards import (
+    EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, manifest_path, shard_range, write_manifest,
+    reorder_by_ids
+)
 import transformers
 transformers.logging.set_verbosity_error()
 csv.field_size_limit(sys.maxsize)
@@ -283,12 +289,16 @@ def get_question_embeddings(args, questions, tokenizer, model):
     return full_embedding, full_embedding2id
 
 
-def embed_passages(opt, passages, model, tokenizer):
+def embed_passages(opt, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = opt.per_gpu_eval_batch_size
     collator = TextCollator(tokenizer, opt.max_doc_length)
     dataset = TextDataset(passages)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=10, collate_fn=collator)
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
 
     with torch.no_grad():
@@ -298,125 +308,57 @@ def embed_passages(opt, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 100 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
 
 
 def get_passage_embedding(args, passages, model, tokenizer):
-    if os.path.exists(os.path.join(args.output_dir, "passage_embedding_data_obj_0.pb")):
+    if os.path.exists(manifest_path(args.output_dir, 'passage_embedding')):
         args.load_cache = True
+    rank = args.local_rank if args.local_rank >= 0 else 0
+    world_size = args.world_size if args.local_rank != -1 else 1
 
     if not args.load_cache:
-        shard_size = len(passages) // args.world_size
-        start_idx = args.local_rank * shard_size if args.local_rank >= 0 else 0
-        end_idx = start_idx + shard_size
-        if args.local_rank == args.world_size - 1 or args.local_rank == -1:
-            end_idx = len(passages)
+        start_idx, end_idx = shard_range(len(passages), rank, world_size)
         passages_piece = passages[start_idx:end_idx]
         logger.info(f'Embedding generation for {len(passages_piece)} passages from idx {start_idx} to {end_idx}')
-        allids, allembeddings = embed_passages(args, passages_piece, model, tokenizer)
-        if is_first_worker():
-            if not os.path.exists(args.output_dir):
-                os.makedirs(args.output_dir)
-
-        if (args.local_rank != -1):
-            dist.barrier()
-        pickle_path = os.path.join(args.output_dir,
-                                   "{1}_data_obj_{0}.pb".format(str(args.local_rank if args.local_rank >= 0 else 0), 'passage_embedding'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allembeddings, handle, protocol=4)
-        pickle_path = os.path.join(args.output_dir,
-                                   "{1}_data_obj_{0}.pb".format(str(args.local_rank if args.local_rank >= 0 else 0), 'passage_embedding_id'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allids, handle, protocol=4)
-        logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
+        # the checkpoint load_model restores, shards of other weights are encoded again
+        checkpoint = args.model_name_or_path_ict or args.eval_model_dir
+        writer = EmbeddingShardWriter(args.output_dir, 'passage_embedding', rank, start_idx, end_idx, len(passages),
+                                      tag=checkpoint_fingerprint(checkpoint) if checkpoint else None)
+        embed_passages(args, passages_piece, model, tokenizer, writer=writer)
+        logger.info(f'Total passages processed {writer.completed}.')
         if (args.local_rank != -1):
             dist.barrier()
 
     passage_embedding, passage_embedding_id = None, None
     if is_first_worker():
-        passage_embedding_list = []
-        passage_embedding_id_list = []
-        for i in range(args.world_size if args.local_rank != -1 else 8):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_list.append(b)
-        for i in range(args.world_size if args.local_rank != -1 else 8):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding_id'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_id_list.append(b)
-        passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-        passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+        if not args.load_cache:
+            write_manifest(args.output_dir, 'passage_embedding', world_size, len(passages),
+                           checkpoint=args.eval_model_dir)
+        # one read-only memmap over every rank's rows, nothing is merged in memory
+        shards = EmbeddingShards(args.output_dir, 'passage_embedding')
+        passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
     return passage_embedding, passage_embedding_id
 
 
 def compute_metrics(qids_to_relevant_passageids, qids_to_ranked_candidate_passages):
-    """Compute MRR metric"""
-    MaxMRRRank = 10
-    all_scores = {}
-    MRR = 0
-    ranking = []
-    recall_q_top1 = set()
-    recall_q_top5 = set()
-    recall_q_top20 = set()
-    recall_q_top50 = set()
-    recall_q_top100 = set()
-    recall_q_all = set()
-
-    for qid in qids_to_ranked_candidate_passages:
-        if qid in qids_to_relevant_passageids:
-            ranking.append(0)
-            target_pid = qids_to_relevant_passageids[qid]
-            candidate_pid = qids_to_ranked_candidate_passages[qid]
-            for i in range(0, MaxMRRRank):
-                if candidate_pid[i] in target_pid:
-                    MRR += 1.0 / (i + 1)
-                    ranking.pop()
-                    ranking.append(i + 1)
-                    break
-            for i, pid in enumerate(candidate_pid):
-                if pid in target_pid:
-                    recall_q_all.add(qid)
-                    if i < 100:
-                        recall_q_top100.add(qid)
-                    if i < 50:
-                        recall_q_top50.add(qid)
-                    if i < 20:
-                        recall_q_top20.add(qid)
-                    if i < 5:
-                        recall_q_top5.add(qid)
-                    if i == 0:
-                        recall_q_top1.add(qid)
-                    break
-    if len(ranking) == 0:
-        raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
-
-    MRR = MRR / len(qids_to_relevant_passageids)
-    recall_top1 = len(recall_q_top1) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top5 = len(recall_q_top5) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top20 = len(recall_q_top20) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top50 = len(recall_q_top50) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top100 = len(recall_q_top100) * 1.0 / len(qids_to_relevant_passageids)
-    recall_all = len(recall_q_all) * 1.0 / len(qids_to_relevant_passageids)
-    all_scores['MRR @10'] = MRR
-    all_scores["recall@1"] = recall_top1
-    all_scores["recall@5"] = recall_top5
-    all_scores["recall@20"] = recall_top20
-    all_scores["recall@50"] = recall_top50
-    all_scores["recall@100"] = recall_top100
-    all_scores["recall@all"] = recall_all
-    all_scores['QueriesRanked'] = len(qids_to_ranked_candidate_passages)
-    all_scores['record'] = str(round(recall_top1*100, 2)) + " / " + str(round(recall_top5*100, 2)) + " / " + str(round(recall_top20*100, 2)) + \
-        " / " + str(round(recall_top50*100, 2)) + " / " + str(round(recall_top100*100, 2)) + " / " + str(round(recall_all*100, 2))
-    return all_scores
+    """MRR@10 and recall@1/5/20/50/100/all, see retrieval_metrics.py"""
+    return ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages,
+                          recall_cutoffs=(1, 5, 20, 50, 100), record=True)
 
 
 def load_reference_from_stream(path_to_reference):
@@ -472,11 +414,7 @@ def generate_new_embeddings(args, tokenizer, model):
         print('passage embedding shape: ' + str(passage_embedding.shape))
         ## the aim of reorder is to let dev_I variable directly map to the docid
         logger.info("***** Begin passage_embedding reorder *****")
-        new_passage_embedding = passage_embedding.copy()
-        for i in range(passage_embedding.shape[0]):
-            new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
-        del (passage_embedding)
-        passage_embedding = new_passage_embedding
+        passage_embedding = reorder_by_ids(passage_embedding, passage_embedding2id)
         ## passage_embedding2id: [original id] : original id in test file
         passage_embedding2id = np.arange(passage_embedding.shape[0])
         logger.info("***** Begin passage_embedding reorder  *****")
@@ -494,7 +432,7 @@ def generate_new_embeddings(args, tokenizer, model):
             co=co
         )
         logger.info("***** Begin faiss *****")
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
+        gpu_index_flat.add(np.ascontiguousarray(passage_embedding, dtype=np.float32))
         cpu_index = gpu_index_flat
         logger.info("***** Done ANN Index *****")
 
@@ -586,7 +524,7 @@ def validate(test_file_name, questions, passages, answers, closest_docs, similar
     with open('final_result_dict_list.pkl', 'wb') as f:
         pickle.dump(final_result_dict_list, f)
     f.close()
-    return top_k_hits, final_scores, Eval_Tool.get_matrics(final_scores), final_result_dict_list
+    return top_k_hits, final_scores, hit_list_metrics(final_scores), final_result_dict_list
 
 
 def evaluate(args, tokenizer, model):
@@ -0,0 +1,214 @@
+import sys
+import argparse
+import csv
+import json
+import logging
+import os
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+csv.field_size_limit(sys.maxsize)
+
+TOKEN_SUFFIX = '.tokens.int32'
+OFFSET_SUFFIX = '.offsets.npy'
+KEY_SUFFIX = '.keys.npy'
+META_SUFFIX = '.meta.json'
+
+
+def tokenizer_tag(tokenizer):
+    name = getattr(tokenizer, 'name_or_path', None) or type(tokenizer).__name__
+    return os.path.basename(os.path.normpath(name)).replace('/', '_')
+
+
+def cache_prefix(cache_dir, name, tokenizer, max_length):
+    """Caches are keyed by content name, tokenizer and max length, e.g. `passage.bert-base-uncased.256`"""
+    return os.path.join(cache_dir, '{}.{}.{}'.format(name, tokenizer_tag(tokenizer), max_length))
+
+
+def cache_exists(prefix):
+    return all(os.path.exists(prefix + suffix) for suffix in [TOKEN_SUFFIX, OFFSET_SUFFIX, KEY_SUFFIX, META_SUFFIX])
+
+
+class TokenCache:
+    """Read-only, memory-mapped `key -> int32 token ids` lookup written by `build_token_cache`.
+
+    The ids are stored exactly as `tokenizer.encode(..., add_special_tokens=True, truncation=True)`
+    returns them, without padding.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + META_SUFFIX, 'r') as f:
+            self.meta = json.load(f)
+        self.num_records = self.meta['num_records']
+        self.dense_keys = self.meta['dense_keys']
+        self._tokens = None
+        self._offsets = None
+        self._keys = None
+        self._sorted_pos = None
+        self._sorted_keys = None
+
+    def _open(self):
+        if self._offsets is not None:
+            return
+        self._offsets = np.load(self.prefix + OFFSET_SUFFIX, mmap_mode='r')
+        self._keys = np.load(self.prefix + KEY_SUFFIX, mmap_mode='r')
+        if self._offsets[-1] > 0:
+            self._tokens = np.memmap(self.prefix + TOKEN_SUFFIX, dtype=np.int32, mode='r')
+        else:
+            self._tokens = np.zeros(0, dtype=np.int32)
+        if not self.dense_keys:
+            self._sorted_pos = np.argsort(self._keys, kind='stable')
+            self._sorted_keys = np.asarray(self._keys)[self._sorted_pos]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_tokens', '_offsets', '_keys', '_sorted_pos', '_sorted_keys']:
+            state[key] = None
+        return state
+
+    def position(self, key):
+        self._open()
+        key = int(key)
+        if self.dense_keys:
+            return key if 0 <= key < self.num_records else -1
+        i = int(np.searchsorted(self._sorted_keys, key))
+        if i < self.num_records and self._sorted_keys[i] == key:
+            return int(self._sorted_pos[i])
+        return -1
+
+    def get(self, key, default=None):
+        position = self.position(key)
+        if position < 0:
+            return default
+        return self._tokens[self._offsets[position]:self._offsets[position + 1]]
+
+    def __getitem__(self, key):
+        token_ids = self.get(key)
+        if token_ids is None:
+            raise KeyError(key)
+        return token_ids
+
+    def __contains__(self, key):
+        return self.position(key) >= 0
+
+    def __len__(self):
+        return self.num_records
+
+
+def load_token_cache(cache_dir, name, tokenizer, max_length):
+    """Return the `TokenCache` for (name, tokenizer, max_length) under `cache_dir`, None if not built."""
+    if not cache_dir:
+        return None
+    prefix = cache_prefix(cache_dir, name, tokenizer, max_length)
+    if not cache_exists(prefix):
+        logger.warning('Token cache %s not found, falling back to on-the-fly tokenization', prefix)
+        return None
+    logger.info('Using token cache %s', prefix)
+    return TokenCache(prefix)
+
+
+# ---------------------------- preprocessing ----------------------------
+
+_worker_tokenizer = None
+_worker_max_length = None
+
+
+def _init_worker(tokenizer_name, max_length):
+    global _worker_tokenizer, _worker_max_length
+    _worker_tokenizer = load_tokenizer(tokenizer_name)
+    _worker_max_length = max_length
+
+
+def _encode_chunk(chunk):
+    results = []
+    for key, text, text_pair in chunk:
+        token_ids = _worker_tokenizer.encode(text, text_pair=text_pair, add_special_tokens=True,
+                                             max_length=_worker_max_length, truncation=True)
+        results.append((key, token_ids))
+    return results
+
+
+def load_tokenizer(tokenizer_name):
+    # same as util.load_model
+    from transformers import BertTokenizer
+    return BertTokenizer.from_pretrained(tokenizer_name, do_lower_case=True if tokenizer_name == 'bert-base-uncased' else False)
+
+
+def chunked(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def build_token_cache(prefix, records, args, max_length, tokenizer):
+    """Tokenize `(key, text, text_pair)` records with a process pool and write them as a flat int32 file.
+
+    Records keep their input order, keys must be ints.
+    """
+    keys, offsets = [], [0]
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    with Pool(args.num_workers, initializer=_init_worker,
+              initargs=(args.tokenizer_name, max_length)) as pool, \
+            open(prefix + TOKEN_SUFFIX, 'wb') as out:
+        for results in tqdm(pool.imap(_encode_chunk, chunked(records, args.chunk_size)),
+                            desc='tokenize ' + os.path.basename(prefix)):
+            for key, token_ids in results:
+                out.write(np.asarray(token_ids, dtype=np.int32).tobytes())
+                keys.append(key)
+                offsets.append(offsets[-1] + len(token_ids))
+    keys = np.asarray(keys, dtype=np.int64)
+    dense = bool(len(keys) > 0 and np.array_equal(keys, np.arange(len(keys), dtype=np.int64)))
+    np.save(prefix + OFFSET_SUFFIX, np.asarray(offsets, dtype=np.int64))
+    np.save(prefix + KEY_SUFFIX, keys)
+    with open(prefix + META_SUFFIX, 'w') as f:
+        json.dump({'num_records': int(len(keys)), 'dense_keys': dense, 'max_length': max_length,
+                   'tokenizer': tokenizer_tag(tokenizer)}, f, indent=2)
+    logger.info('Wrote %d records / %d tokens to %s', len(keys), offsets[-1], prefix)
+
+
+def wiki_records(corpus_path):
+    """psgs_w100.tsv title/passage pairs, same inputs as LEAD TraditionDataset (ids shifted to start at 0)"""
+    with open(corpus_path) as fin:
+        reader = csv.reader(fin, delimiter='\t')
+        for row in reader:
+            if not row[0] == 'id':
+                yield int(row[0]) - 1, row[2], row[1].strip()
+
+
+CORPUS_RECORDS = {
+    'wiki': wiki_records,
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus_path", type=str, required=True, help="psgs_w100.tsv")
+    parser.add_argument("--corpus_format", type=str, default='wiki', choices=list(CORPUS_RECORDS.keys()))
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--tokenizer_name", type=str, default='bert-base-uncased')
+    parser.add_argument("--max_seq_length", type=int, default=256)
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--chunk_size", type=int, default=2048)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    args = get_arguments()
+    tokenizer = load_tokenizer(args.tokenizer_name)
+    records = CORPUS_RECORDS[args.corpus_format](args.corpus_path)
+    build_token_cache(cache_prefix(args.cache_dir, 'passage', tokenizer, args.max_seq_length),
+                      records, args, args.max_seq_length, tokenizer)
+
+
+if __name__ == "__main__":
+    main()
@@ -1071,6 +1071,7 @@ def get_arguments():
     parser.add_argument("--model_type", default=None, type=str, choices=['cross_encoder', 'colbert', 'dual_encoder', 'distilbert'], required=True, help="choose model type")
     parser.add_argument("--pretrained_model_name", default=None, type=str, required=True, help="Model type selected in the list:")
     parser.add_argument("--passage_path", default=None, type=str)
+    parser.add_argument("--token_cache_dir", default=None, type=str, help="passage token ids built by token_cache.py, tokenize on the fly if unset")
     parser.add_argument("--train_file", default=None, type=str)
     parser.add_argument("--test_file", default=None, type=str)
     parser.add_argument("--train_q2d_file", default=None, type=str)
@@ -38,9 +38,9 @@ from utils.dpr_utils import (
     load_states_from_checkpoint,
     get_model_obj,
     CheckpointState,
-    get_optimizer,
-    all_gather_list
+    get_optimizer
 )
+from utils.distributed_gather import all_gather_tensors, offset_positive_idxs
 from utils.MARCO_until import Rocketqa_v2Dataset
 import collections
 
@@ -179,47 +179,11 @@ def train(args, model, tokenizer):
 
 def caculate_cont_loss(args, local_q_vector, local_ctx_vectors, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_vector_to_send = (
-            torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-        )
-        ctx_vector_to_send = (
-            torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_vector_to_send,
-                ctx_vector_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_vector = []
-        global_ctxs_vector = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_vector, ctx_vectors, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_vector.append(q_vector.to(local_q_vector.device))
-                global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_vector.append(local_q_vector)
-                global_ctxs_vector.append(local_ctx_vectors)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_vectors.size(0)
-        global_q_vector = torch.cat(global_q_vector, dim=0)
-        global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
+        q_vectors, ctx_vectors, positive_idxs = all_gather_tensors(
+            [local_q_vector, local_ctx_vectors, torch.tensor(local_positive_idxs, device=local_q_vector.device)])
+        global_q_vector = torch.cat(q_vectors, dim=0)
+        global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_vectors)
     else:
         global_q_vector = local_q_vector
         global_ctxs_vector = local_ctx_vectors
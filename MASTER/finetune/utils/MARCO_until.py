@@ -33,6 +33,7 @@ def _read_tsv(input_file, trainer_id=0, trainer_num=1):
 
 from torch.utils.data import DataLoader, Dataset, TensorDataset, IterableDataset
 import six
+from utils.passage_store import load_passage_store
 def convert_to_unicode(text):
     """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
     if six.PY3:
@@ -141,6 +142,9 @@ class Rocketqa_v2Dataset(Dataset):
 
     def load_id_text(self,file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -247,6 +251,9 @@ class Doc_v2Dataset(Dataset):
 
     def load_id_text(self, file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -368,6 +375,9 @@ class Rocketqa_v3Dataset(Dataset):
 
     def load_id_text(self, file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -0,0 +1,109 @@
+import logging
+import time
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+logger = logging.getLogger(__name__)
+
+# faiss fills missing results of inner-product searches with -FLT_MAX and id -1
+MISSING_SCORE = -np.finfo(np.float32).max
+
+
+def _topk_numpy(scores, ids, k):
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, ids = np.take_along_axis(scores, top, axis=1), np.take_along_axis(ids, top, axis=1)
+    return scores, ids
+
+
+def _topk_torch(scores, ids, k):
+    if scores.shape[1] > k:
+        scores, top = torch.topk(scores, k, dim=1, sorted=False)
+        ids = torch.gather(ids, 1, top)
+    return scores, ids
+
+
+class BlockedExactIndex:
+    """Exact inner-product search over a [N, dim] passage matrix, without faiss.
+
+    The matrix (typically the read-only memmap of `EmbeddingShards`) is scanned in blocks of
+    `block_size` passages; each block is multiplied with batches of `query_batch_size` queries
+    and merged into a running top-k, so memory stays at one block plus the score tiles no matter
+    how large the corpus is. The matmul runs on torch when it is installed (`num_threads` sets
+    its intra-op threads), otherwise on numpy's BLAS.
+
+    `search(queries, k)` returns `(scores, I)` like a faiss index: float32 / int64 [Q, k] sorted
+    by decreasing score, where I are row positions of the matrix.
+    """
+
+    def __init__(self, embeddings, block_size=262144, query_batch_size=4096, num_threads=None, use_torch=True):
+        self.embeddings = embeddings
+        self.ntotal = len(embeddings)
+        self.d = embeddings.shape[1]
+        self.block_size = block_size
+        self.query_batch_size = query_batch_size
+        self.use_torch = use_torch and torch is not None
+        if self.use_torch and num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+    def _block(self, start):
+        return np.ascontiguousarray(self.embeddings[start:start + self.block_size], dtype=np.float32)
+
+    def _search_torch(self, queries, k):
+        queries = torch.from_numpy(queries)
+        top_scores = torch.full((len(queries), 0), MISSING_SCORE, dtype=torch.float32)
+        top_ids = torch.full((len(queries), 0), -1, dtype=torch.int64)
+        for start in range(0, self.ntotal, self.block_size):
+            block = torch.from_numpy(self._block(start))
+            block_ids = torch.arange(start, start + len(block), dtype=torch.int64)
+            merged_scores, merged_ids = [], []
+            for q_start in range(0, len(queries), self.query_batch_size):
+                q_end = q_start + self.query_batch_size
+                scores = torch.matmul(queries[q_start:q_end], block.t())
+                scores, ids = _topk_torch(scores, block_ids.expand_as(scores), k)
+                scores, ids = _topk_torch(torch.cat([top_scores[q_start:q_end], scores], dim=1),
+                                          torch.cat([top_ids[q_start:q_end], ids], dim=1), k)
+                merged_scores.append(scores)
+                merged_ids.append(ids)
+            top_scores, top_ids = torch.cat(merged_scores), torch.cat(merged_ids)
+        return top_scores.numpy(), top_ids.numpy()
+
+    def _search_numpy(self, queries, k):
+        top_scores = np.full((len(queries), 0), MISSING_SCORE, dtype=np.float32)
+        top_ids = np.full((len(queries), 0), -1, dtype=np.int64)
+        for start in range(0, self.ntotal, self.block_size):
+            block = self._block(start)
+            block_ids = np.arange(start, start + len(block), dtype=np.int64)
+            merged_scores, merged_ids = [], []
+            for q_start in range(0, len(queries), self.query_batch_size):
+                q_end = q_start + self.query_batch_size
+                scores = queries[q_start:q_end] @ block.T
+                scores, ids = _topk_numpy(scores, np.broadcast_to(block_ids, scores.shape), k)
+                scores, ids = _topk_numpy(np.concatenate([top_scores[q_start:q_end], scores], axis=1),
+                                          np.concatenate([top_ids[q_start:q_end], ids], axis=1), k)
+                merged_scores.append(scores)
+                merged_ids.append(ids)
+            top_scores, top_ids = np.concatenate(merged_scores), np.concatenate(merged_ids)
+        return top_scores, top_ids
+
+    def search(self, queries, k):
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        start = time.time()
+        if self.use_torch:
+            scores, ids = self._search_torch(queries, k)
+        else:
+            scores, ids = self._search_numpy(queries, k)
+        order = np.argsort(-scores, axis=1, kind='stable')
+        scores, ids = np.take_along_axis(scores, order, axis=1), np.take_along_axis(ids, order, axis=1)
+        if scores.shape[1] < k:
+            # fewer passages than k
+            pad = k - scores.shape[1]
+            scores = np.concatenate([scores, np.full((len(queries), pad), MISSING_SCORE, dtype=np.float32)], axis=1)
+            ids = np.concatenate([ids, np.full((len(queries), pad), -1, dtype=np.int64)], axis=1)
+        logger.info('Exact search of %d queries over %d passages in %.1fs', len(queries), self.ntotal,
+                    time.time() - start)
+        return scores, ids
@@ -0,0 +1,210 @@
+import hashlib
+import json
+import logging
+import os
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+EMBEDDING_SUFFIX = '.emb'
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+def embedding_path(output_dir, name):
+    return os.path.join(output_dir, name + EMBEDDING_SUFFIX)
+
+
+def manifest_path(output_dir, name):
+    return os.path.join(output_dir, name + MANIFEST_SUFFIX)
+
+
+def shard_meta_path(output_dir, name, rank):
+    return os.path.join(output_dir, '{}.shard{}.json'.format(name, rank))
+
+
+def shard_ids_path(output_dir, name, rank):
+    return os.path.join(output_dir, '{}.ids{}.npy'.format(name, rank))
+
+
+def checkpoint_fingerprint(checkpoint):
+    """sha1 over path, size and mtime of a checkpoint file (or of every file of a checkpoint dir)"""
+    if os.path.isdir(checkpoint):
+        paths = sorted(os.path.join(root, name) for root, _, names in os.walk(checkpoint) for name in names)
+    else:
+        paths = [checkpoint]
+    digest = hashlib.sha1()
+    for path in paths:
+        stat = os.stat(path)
+        digest.update('{}\t{}\t{}\n'.format(os.path.abspath(path), stat.st_size, stat.st_mtime_ns).encode('utf-8'))
+    return digest.hexdigest()[:16]
+
+
+def shard_range(num_rows, rank, world_size):
+    """[start, end) rows encoded by `rank`, the last rank takes the remainder"""
+    shard_size = num_rows // world_size
+    start = rank * shard_size
+    end = num_rows if rank == world_size - 1 else start + shard_size
+    return start, end
+
+
+class EmbeddingShardWriter:
+    """Writes the rows [start, end) of a [num_rows, dim] embedding matrix shared by all ranks.
+
+    The matrix is one raw memmap file, so every rank writes its slice in place and the union
+    can be read back as a single view without merging. Ids go to a small per-rank .npy.
+
+    `append` streams batches at the `completed` offset and checkpoints the progress every
+    `checkpoint_every` rows. A writer created again with the same `tag` and the same shard
+    resumes from the last checkpointed offset. The tag must identify the weights being encoded
+    (`checkpoint_fingerprint` of the checkpoint): a step or a directory name can be reused by a
+    retrained model, whose rows would then be skipped. Without a tag the shard is always
+    encoded from the start.
+    """
+
+    def __init__(self, output_dir, name, rank, start, end, num_rows, dtype=np.float32, tag=None,
+                 checkpoint_every=100000):
+        self.output_dir = output_dir
+        self.name = name
+        self.rank = rank
+        self.start = start
+        self.end = end
+        self.num_rows = num_rows
+        self.dtype = np.dtype(dtype)
+        self.tag = tag
+        self.checkpoint_every = checkpoint_every
+        self.dim = None
+        self.completed = 0
+        self._embeddings = None
+        self._last_checkpoint = 0
+        os.makedirs(output_dir, exist_ok=True)
+
+        ids_path = shard_ids_path(output_dir, name, rank)
+        progress = self._load_progress()
+        if progress is not None and os.path.exists(ids_path):
+            self.completed = progress['completed']
+            self._last_checkpoint = self.completed
+            self._ids = np.load(ids_path, mmap_mode='r+')
+            if progress['dim'] is not None:
+                self._open(progress['dim'])
+            logger.info('Rank %d resumes %s at offset %d of %d', rank, name, self.completed, end - start)
+        else:
+            self._ids = np.lib.format.open_memmap(ids_path, mode='w+', dtype=np.int64, shape=(end - start,))
+
+    def _load_progress(self):
+        path = shard_meta_path(self.output_dir, self.name, self.rank)
+        if self.tag is None or not os.path.exists(path):
+            return None
+        with open(path, 'r') as f:
+            progress = json.load(f)
+        expected = {'tag': self.tag, 'start': self.start, 'end': self.end, 'num_rows': self.num_rows,
+                    'dtype': self.dtype.name}
+        if any(progress.get(key) != value for key, value in expected.items()):
+            return None
+        return progress
+
+    @property
+    def done(self):
+        return self.completed == self.end - self.start
+
+    def _open(self, dim):
+        self.dim = dim
+        path = embedding_path(self.output_dir, self.name)
+        size = self.num_rows * dim * self.dtype.itemsize
+        # every rank may get here first: create without truncating and only ever grow the file
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+        self._embeddings = np.memmap(path, dtype=self.dtype, mode='r+', shape=(self.num_rows, dim))
+
+    def write(self, offset, ids, embeddings):
+        """write rows at `offset` inside this rank's shard"""
+        embeddings = np.asarray(embeddings)
+        if self._embeddings is None:
+            self._open(embeddings.shape[1])
+        self._embeddings[self.start + offset:self.start + offset + len(embeddings)] = embeddings
+        self._ids[offset:offset + len(ids)] = ids
+        self.completed = max(self.completed, offset + len(embeddings))
+
+    def append(self, ids, embeddings):
+        """write the next batch after the rows already completed"""
+        self.write(self.completed, ids, embeddings)
+        if self.completed - self._last_checkpoint >= self.checkpoint_every:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """flush the rows written so far, then record them as completed"""
+        if self._embeddings is not None:
+            self._embeddings.flush()
+        self._ids.flush()
+        with open(shard_meta_path(self.output_dir, self.name, self.rank), 'w') as f:
+            json.dump({'rank': self.rank, 'tag': self.tag, 'start': self.start, 'end': self.end,
+                       'num_rows': self.num_rows, 'dim': self.dim, 'dtype': self.dtype.name,
+                       'completed': self.completed}, f)
+        self._last_checkpoint = self.completed
+
+    def close(self):
+        self.checkpoint()
+        logger.info('Rank %d wrote embeddings [%d, %d) to %s', self.rank, self.start, self.start + self.completed,
+                    embedding_path(self.output_dir, self.name))
+
+
+def write_manifest(output_dir, name, world_size, num_rows, step=None, checkpoint=None):
+    """Collect the per-rank shard metadata into `{name}.manifest.json`, called once after all ranks closed"""
+    shards = []
+    for rank in range(world_size):
+        with open(shard_meta_path(output_dir, name, rank), 'r') as f:
+            shards.append(json.load(f))
+    dims = {shard['dim'] for shard in shards if shard['dim'] is not None}
+    assert len(dims) == 1, 'inconsistent embedding dims {}'.format(dims)
+    incomplete = [shard['rank'] for shard in shards if shard['completed'] != shard['end'] - shard['start']]
+    assert len(incomplete) == 0, 'shards of ranks {} are incomplete'.format(incomplete)
+    covered = sum(shard['end'] - shard['start'] for shard in shards)
+    assert covered == num_rows, 'shards cover {} of {} rows'.format(covered, num_rows)
+    manifest = {'num_rows': num_rows, 'dim': dims.pop(), 'dtype': shards[0]['dtype'],
+                'step': step, 'checkpoint': checkpoint,
+                'embeddings': os.path.basename(embedding_path(output_dir, name)),
+                'shards': [{'rank': shard['rank'], 'start': shard['start'], 'end': shard['end'],
+                            'ids': os.path.basename(shard_ids_path(output_dir, name, shard['rank']))}
+                           for shard in shards]}
+    with open(manifest_path(output_dir, name), 'w') as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+class EmbeddingShards:
+    """Read side of `EmbeddingShardWriter`: `embeddings` is one read-only memmap over all shards
+    and `ids[i]` is the external id of row i."""
+
+    def __init__(self, output_dir, name):
+        with open(manifest_path(output_dir, name), 'r') as f:
+            self.manifest = json.load(f)
+        self.num_rows = self.manifest['num_rows']
+        self.dim = self.manifest['dim']
+        self.step = self.manifest['step']
+        self.embeddings = np.memmap(os.path.join(output_dir, self.manifest['embeddings']),
+                                    dtype=np.dtype(self.manifest['dtype']), mode='r',
+                                    shape=(self.num_rows, self.dim))
+        self.ids = np.concatenate([np.load(os.path.join(output_dir, shard['ids']))
+                                   for shard in sorted(self.manifest['shards'], key=lambda s: s['start'])])
+
+    def __len__(self):
+        return self.num_rows
+
+
+
+def reorder_by_ids(embeddings, ids):
+    """Embeddings moved so that row `ids[i]` holds `embeddings[i]`, for indexes whose positions are the ids.
+
+    The common case of ids already being 0..n-1 in order (corpus encoded in file order) returns
+    `embeddings` untouched, otherwise the rows are scattered with a single fancy-index assignment.
+    """
+    ids = np.asarray(ids)
+    if len(ids) == len(embeddings) and np.array_equal(ids, np.arange(len(ids))):
+        return embeddings
+    reordered = np.array(embeddings)
+    reordered[ids] = embeddings
+    return reordered
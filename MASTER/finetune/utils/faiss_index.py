@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import re
+import time
+import numpy as np
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+try:
+    from utils.dense_search import BlockedExactIndex
+    from utils.embedding_shards import checkpoint_fingerprint
+except ImportError:
+    from dense_search import BlockedExactIndex
+    from embedding_shards import checkpoint_fingerprint
+
+logger = logging.getLogger(__name__)
+
+ADD_BLOCK_SIZE = 1000000
+# --index_spec value selecting the faiss-free BlockedExactIndex
+EXACT_SPEC = 'Exact'
+INDEX_FILE = 'index.faiss'
+IDS_FILE = 'ids.npy'
+META_FILE = 'meta.json'
+
+
+def add_index_args(parser):
+    """ANN index flags shared by the scripts that build a passage index"""
+    parser.add_argument("--index_spec", type=str, default='Flat',
+                        help="faiss index_factory string, e.g. Flat, IVF65536,PQ64, HNSW32, SQ8, "
+                             "or Exact for blocked exact search without faiss")
+    parser.add_argument("--index_nprobe", type=int, default=None, help="inverted lists visited per query (IVF)")
+    parser.add_argument("--index_ef_search", type=int, default=None, help="search depth (HNSW)")
+    parser.add_argument("--index_train_size", type=int, default=1000000,
+                        help="passages sampled to train IVF / PQ / SQ indexes")
+    parser.add_argument("--index_cpu", default=False, action="store_true",
+                        help="keep the index on CPU even when GPUs are available")
+    parser.add_argument("--index_recall_queries", type=int, default=1000,
+                        help="queries used to report recall against exact search, 0 to skip")
+    parser.add_argument("--index_recall_k", type=int, default=100)
+    parser.add_argument("--exact_block_size", type=int, default=262144,
+                        help="passages scored per block by --index_spec Exact and the recall report")
+    parser.add_argument("--index_cache_dir", type=str, default=None,
+                        help="save built indexes here, keyed by checkpoint and --index_spec, and reuse them "
+                             "(skipping passage inference) when evaluating the same checkpoint again")
+    return parser
+
+
+def num_gpus():
+    # the CPU-only faiss build has no get_num_gpus
+    get_num_gpus = getattr(faiss, 'get_num_gpus', None) if faiss is not None else None
+    return get_num_gpus() if get_num_gpus is not None else 0
+
+
+def _as_float32(embeddings):
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def _train(index, embeddings, spec, train_size, use_gpu, seed=0):
+    num_train = min(train_size, len(embeddings))
+    rows = np.sort(np.random.RandomState(seed).choice(len(embeddings), num_train, replace=False))
+    ivf = faiss.try_extract_index_ivf(index) if hasattr(faiss, 'try_extract_index_ivf') else None
+    if ivf is not None and use_gpu:
+        # k-means assignment on the GPUs, the trained index is cloned afterwards
+        clustering_index = faiss.index_cpu_to_all_gpus(faiss.IndexFlatIP(ivf.d))
+        ivf.clustering_index = clustering_index
+    start = time.time()
+    index.train(_as_float32(embeddings[rows]))
+    if ivf is not None and use_gpu:
+        ivf.clustering_index = None
+    logger.info('Trained %s on %d passages in %.1fs', spec, num_train, time.time() - start)
+
+
+def _is_gpu_index(index):
+    return isinstance(index, faiss.IndexShards) or type(index).__name__.startswith('Gpu')
+
+
+def _to_gpu(index, spec, use_float16):
+    co = faiss.GpuMultipleClonerOptions()
+    co.shard = True
+    # also selects float16 lookup tables, which IVF-PQ needs for large M
+    co.useFloat16 = use_float16 or 'PQ' in spec
+    try:
+        return faiss.index_cpu_to_all_gpus(index, co=co), True
+    except (RuntimeError, AttributeError) as e:
+        logger.warning('Cannot move %s to GPU (%s), searching on CPU', spec, e)
+        return index, False
+
+
+def set_search_params(index, on_gpu=False, nprobe=None, ef_search=None):
+    params = faiss.GpuParameterSpace() if on_gpu else faiss.ParameterSpace()
+    if nprobe is not None:
+        params.set_index_parameter(index, 'nprobe', nprobe)
+    if ef_search is not None:
+        params.set_index_parameter(index, 'efSearch', ef_search)
+
+
+def build_index(embeddings, spec='Flat', use_gpu=True, use_float16=False, train_size=1000000,
+                nprobe=None, ef_search=None, exact_block_size=262144):
+    """Inner-product index over `embeddings` ([N, dim], rows are the ids) from a faiss factory string.
+
+    Indexes that need training are trained on a random sample of `train_size` rows. The index is
+    sharded over all visible GPUs, except HNSW which faiss only has on CPU; without GPUs (or a
+    CPU-only faiss build) everything stays on CPU. `Exact` searches `embeddings` in place with
+    `BlockedExactIndex` and needs no faiss at all.
+    """
+    if spec == EXACT_SPEC:
+        return BlockedExactIndex(embeddings, block_size=exact_block_size)
+    if faiss is None:
+        raise ImportError('faiss is required for --index_spec {}, use --index_spec {} without it'.format(
+            spec, EXACT_SPEC))
+    dim = embeddings.shape[1]
+    index = faiss.index_factory(dim, spec, faiss.METRIC_INNER_PRODUCT)
+    use_gpu = use_gpu and num_gpus() > 0
+    if not use_gpu:
+        logger.info('No GPU used for faiss, building %s on CPU', spec)
+    if not index.is_trained:
+        _train(index, embeddings, spec, train_size, use_gpu)
+    on_gpu = False
+    if use_gpu and 'HNSW' not in spec:
+        index, on_gpu = _to_gpu(index, spec, use_float16)
+
+    start = time.time()
+    for block_start in range(0, len(embeddings), ADD_BLOCK_SIZE):
+        index.add(_as_float32(embeddings[block_start:block_start + ADD_BLOCK_SIZE]))
+    set_search_params(index, on_gpu, nprobe=nprobe, ef_search=ef_search)
+    logger.info('Added %d passages to %s (%s) in %.1fs', index.ntotal, spec, 'GPU' if on_gpu else 'CPU',
+                time.time() - start)
+    return index
+
+
+def recall_vs_flat(index, embeddings, queries, k=100, num_queries=1000, seed=0, block_size=262144):
+    """Fraction of the exact top-k found by `index` for a sample of `queries`"""
+    if len(queries) > num_queries:
+        queries = queries[np.sort(np.random.RandomState(seed).choice(len(queries), num_queries, replace=False))]
+    queries = _as_float32(queries)
+    _, approx_ids = index.search(queries, k)
+    _, exact_ids = BlockedExactIndex(embeddings, block_size=block_size).search(queries, k)
+    hits = sum(len(np.intersect1d(approx, exact)) for approx, exact in zip(approx_ids, exact_ids))
+    return hits / float(exact_ids.size)
+
+
+def build_index_from_args(args, embeddings, queries=None, use_float16=False):
+    """`build_index` configured by `add_index_args`, logging recall@k vs exact search for `queries`"""
+    index = build_index(embeddings, spec=args.index_spec, use_gpu=not args.index_cpu, use_float16=use_float16,
+                        train_size=args.index_train_size, nprobe=args.index_nprobe,
+                        ef_search=args.index_ef_search, exact_block_size=args.exact_block_size)
+    if queries is not None and args.index_recall_queries > 0 and args.index_spec not in ('Flat', EXACT_SPEC):
+        recall = recall_vs_flat(index, embeddings, queries, k=args.index_recall_k,
+                                num_queries=args.index_recall_queries, block_size=args.exact_block_size)
+        logger.info('%s recall@%d vs flat: %.4f', args.index_spec, args.index_recall_k, recall)
+    return index
+
+
+def index_cache_path(cache_dir, checkpoint, spec):
+    return os.path.join(cache_dir, '{}.{}'.format(checkpoint_fingerprint(checkpoint),
+                                                  re.sub(r'[^0-9A-Za-z_]+', '_', spec)))
+
+
+def save_index(path, index, ids, spec, checkpoint=None):
+    """Write `index` (moved back to CPU if needed) and its row ids, meta.json last marks the entry complete"""
+    os.makedirs(path, exist_ok=True)
+    if _is_gpu_index(index):
+        index = faiss.index_gpu_to_cpu(index)
+    start = time.time()
+    faiss.write_index(index, os.path.join(path, INDEX_FILE))
+    np.save(os.path.join(path, IDS_FILE), np.asarray(ids, dtype=np.int64))
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump({'spec': spec, 'checkpoint': checkpoint, 'ntotal': int(index.ntotal), 'dim': int(index.d)},
+                  f, indent=2)
+    logger.info('Saved %s index to %s in %.1fs', spec, path, time.time() - start)
+
+
+def load_index(path, use_gpu=True, use_float16=False, nprobe=None, ef_search=None):
+    """(index, ids) written by `save_index`. The index file is memory-mapped when faiss supports it
+    for the index type, and cloned to the GPUs like `build_index` does."""
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        spec = json.load(f)['spec']
+    index_file = os.path.join(path, INDEX_FILE)
+    start = time.time()
+    try:
+        index = faiss.read_index(index_file, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+    except RuntimeError:
+        index = faiss.read_index(index_file)
+    on_gpu = False
+    if use_gpu and num_gpus() > 0 and 'HNSW' not in spec:
+        index, on_gpu = _to_gpu(index, spec, use_float16)
+    set_search_params(index, on_gpu, nprobe=nprobe, ef_search=ef_search)
+    logger.info('Loaded %s index with %d passages from %s in %.1fs', spec, index.ntotal, path, time.time() - start)
+    return index, np.load(os.path.join(path, IDS_FILE))
+
+
+def find_cached_index(args, checkpoint, num_passages=None):
+    """Path of the complete index cache entry for `checkpoint` and `args.index_spec`, None if there is none"""
+    if not args.index_cache_dir or not checkpoint or not os.path.exists(checkpoint) or args.index_spec == EXACT_SPEC:
+        return None
+    path = index_cache_path(args.index_cache_dir, checkpoint, args.index_spec)
+    if not os.path.exists(os.path.join(path, META_FILE)):
+        return None
+    with open(os.path.join(path, META_FILE), 'r') as f:
+        meta = json.load(f)
+    if num_passages is not None and meta['ntotal'] != num_passages:
+        logger.warning('Ignoring cached index %s: %d passages, expected %d', path, meta['ntotal'], num_passages)
+        return None
+    return path
+
+
+def load_index_from_args(args, path, use_float16=False):
+    return load_index(path, use_gpu=not args.index_cpu, use_float16=use_float16, nprobe=args.index_nprobe,
+                      ef_search=args.index_ef_search)
+
+
+def cache_index_from_args(args, checkpoint, index, ids):
+    """`save_index` into `--index_cache_dir`, a no-op when caching is off or there is no faiss index"""
+    if not args.index_cache_dir or not checkpoint or args.index_spec == EXACT_SPEC:
+        return
+    save_index(index_cache_path(args.index_cache_dir, checkpoint, args.index_spec), index, ids, args.index_spec,
+               checkpoint=checkpoint)
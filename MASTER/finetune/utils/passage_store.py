@@ -0,0 +1,215 @@
+import sys
+
+sys.path += ['../']
+import argparse
+import json
+import logging
+import os
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+STORE_DATA_SUFFIX = '.store.bin'
+STORE_OFFSET_SUFFIX = '.store.offsets.npy'
+STORE_ID_SUFFIX = '.store.ids.npy'
+STORE_META_SUFFIX = '.store.meta.json'
+
+
+def parse_id_text_line(line):
+    """para.txt / para.title.txt: `pid \\t text`"""
+    id, text = line.strip().split('\t')
+    return int(id), text
+
+
+def parse_marco_doc_line(line):
+    """msmarco-docs.tsv: `Dpid \\t url \\t title \\t body` (title may be missing), same layout as Doc_v2Dataset.load_id_text"""
+    line_arr = line.split('\t')
+    p_id = int(line_arr[0][1:])  # remove "D"
+    full_text = "<sep>".join(field.rstrip() for field in line_arr[1:4])
+    return p_id, full_text[:10000]
+
+
+LINE_FORMATS = {
+    'id_text': parse_id_text_line,
+    'marco_doc': parse_marco_doc_line,
+}
+
+
+def store_exists(file_name):
+    return all(os.path.exists(file_name + suffix) for suffix in
+               [STORE_DATA_SUFFIX, STORE_OFFSET_SUFFIX, STORE_ID_SUFFIX, STORE_META_SUFFIX])
+
+
+def build_passage_store(file_name, line_fn=parse_id_text_line, out_prefix=None):
+    """Convert a `pid \\t text` corpus file into one utf-8 blob plus an offsets array.
+
+    Records keep the order of the source file, the blob is written in a single pass so
+    the 8.8M MS MARCO passages never have to be held in memory at once.
+    """
+    out_prefix = file_name if out_prefix is None else out_prefix
+    ids, offsets = [], [0]
+    with open(file_name, 'r', encoding='utf-8') as inp, open(out_prefix + STORE_DATA_SUFFIX, 'wb') as out:
+        for line in tqdm(inp, desc='build store ' + os.path.basename(file_name)):
+            if not line.strip():
+                continue
+            p_id, text = line_fn(line)
+            data = text.encode('utf-8')
+            out.write(data)
+            ids.append(p_id)
+            offsets.append(offsets[-1] + len(data))
+    ids = np.asarray(ids, dtype=np.int64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    dense = bool(len(ids) > 0 and np.array_equal(ids, np.arange(len(ids), dtype=np.int64)))
+    np.save(out_prefix + STORE_OFFSET_SUFFIX, offsets)
+    np.save(out_prefix + STORE_ID_SUFFIX, ids)
+    with open(out_prefix + STORE_META_SUFFIX, 'w') as f:
+        json.dump({'num_records': int(len(ids)), 'dense_ids': dense,
+                   'source': os.path.abspath(file_name)}, f, indent=2)
+    logger.info('Built passage store for %s: %d records, %d bytes', file_name, len(ids), offsets[-1])
+    return out_prefix
+
+
+class PassageStore:
+    """Read-only, dict-like view over a corpus built by `build_passage_store`.
+
+    Nothing is read eagerly: the blob and the offsets are memory-mapped on first access in
+    each process, so every rank and DataLoader worker on a node shares the same page cache
+    instead of holding its own dict of python strings.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + STORE_META_SUFFIX, 'r') as f:
+            meta = json.load(f)
+        self.num_records = meta['num_records']
+        self.dense_ids = meta['dense_ids']
+        self._data = None
+        self._offsets = None
+        self._ids = None
+        self._sorted_pos = None
+        self._sorted_ids = None
+
+    def _open(self):
+        if self._offsets is not None:
+            return
+        self._offsets = np.load(self.prefix + STORE_OFFSET_SUFFIX, mmap_mode='r')
+        self._ids = np.load(self.prefix + STORE_ID_SUFFIX, mmap_mode='r')
+        if self._offsets[-1] > 0:
+            self._data = np.memmap(self.prefix + STORE_DATA_SUFFIX, dtype=np.uint8, mode='r')
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+        if not self.dense_ids:
+            self._sorted_pos = np.argsort(self._ids, kind='stable')
+            self._sorted_ids = np.asarray(self._ids)[self._sorted_pos]
+
+    def __getstate__(self):
+        # mmaps are reopened lazily after pickling to spawned workers
+        state = self.__dict__.copy()
+        for key in ['_data', '_offsets', '_ids', '_sorted_pos', '_sorted_ids']:
+            state[key] = None
+        return state
+
+    def position(self, p_id):
+        """row of `p_id` in the store, -1 if missing"""
+        self._open()
+        p_id = int(p_id)
+        if self.dense_ids:
+            return p_id if 0 <= p_id < self.num_records else -1
+        i = int(np.searchsorted(self._sorted_ids, p_id))
+        if i < self.num_records and self._sorted_ids[i] == p_id:
+            return int(self._sorted_pos[i])
+        return -1
+
+    def text_at(self, position):
+        self._open()
+        start, end = self._offsets[position], self._offsets[position + 1]
+        return self._data[start:end].tobytes().decode('utf-8')
+
+    def id_at(self, position):
+        self._open()
+        return int(self._ids[position])
+
+    @property
+    def ids(self):
+        self._open()
+        return self._ids
+
+    def get(self, p_id, default=None):
+        position = self.position(p_id)
+        if position < 0:
+            return default
+        return self.text_at(position)
+
+    def __getitem__(self, p_id):
+        position = self.position(p_id)
+        if position < 0:
+            raise KeyError(p_id)
+        return self.text_at(position)
+
+    def __contains__(self, p_id):
+        return self.position(p_id) >= 0
+
+    def __len__(self):
+        return self.num_records
+
+
+class StorePassages:
+    """Sequence of `(pid, text, title)` tuples backed by passage stores, or `(pid, text)`
+    when no title store is given.
+
+    Drop-in for the list built by `RenewTools.load_passage`: supports len, indexing and
+    slicing (slices stay lazy views).
+    """
+
+    def __init__(self, text_store, title_store=None, start=0, end=None):
+        self.text_store = text_store
+        self.title_store = title_store
+        self.start = start
+        self.end = len(text_store) if end is None else end
+
+    def __len__(self):
+        return self.end - self.start
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert step == 1, 'StorePassages only supports contiguous slices'
+            return StorePassages(self.text_store, self.title_store, self.start + start, self.start + stop)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        position = self.start + index
+        p_id = self.text_store.id_at(position)
+        if self.title_store is None:
+            return p_id, self.text_store.text_at(position)
+        return p_id, self.text_store.text_at(position), self.title_store.get(p_id, '-')
+
+
+def load_passage_store(file_name):
+    """Return a `PassageStore` for `file_name` if one was built next to it, else None."""
+    if store_exists(file_name):
+        logger.info('Using passage store %s', file_name + STORE_DATA_SUFFIX)
+        return PassageStore(file_name)
+    return None
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_files", nargs='+', required=True,
+                        help="corpus files to convert, e.g. data/MS-Pas/para.txt data/MS-Pas/para.title.txt")
+    parser.add_argument("--format", default='id_text', choices=list(LINE_FORMATS.keys()))
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    args = get_arguments()
+    for file_name in args.input_files:
+        build_passage_store(file_name, line_fn=LINE_FORMATS[args.format])
+
+
+if __name__ == "__main__":
+    main()
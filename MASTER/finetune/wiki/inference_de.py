@@ -4,6 +4,7 @@ import sys
 from torch.utils.data.dataset import Dataset
 
 sys.path += ['../']
+import time
 import json
 import logging
 import os
@@ -15,11 +16,18 @@ sys.path.append(os.getcwd())
 sys.path.append(os.path.abspath(os.path.dirname(os.getcwd())))
 from tqdm import tqdm
 import torch.distributed as dist
+from utils.retrieval_metrics import hit_list_metrics
 from utils.util import (
     is_first_worker,
 )
 from model.models import BiBertEncoder
-from utils.dpr_utils import load_states_from_checkpoint, get_model_obj, SimpleTokenizer, has_answer
+from utils.dpr_utils import load_states_from_checkpoint, get_model_obj
+from utils.answer_match import AnswerMatcher, label_candidates
+from utils.embedding_shards import (
+    EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, write_manifest, reorder_by_ids
+)
+from utils.faiss_index import (add_index_args, build_index_from_args, cache_index_from_args, find_cached_index,
+                               load_index_from_args)
 import pickle
 from transformers import (
     BertTokenizer
@@ -247,12 +255,16 @@ class TextCollator(object):
         return index, text_ids, text_mask
 
 
-def embed_passages(opt, passages, model, tokenizer):
+def embed_passages(opt, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = opt.per_gpu_eval_batch_size
     collator = TextCollator(tokenizer, opt.max_seq_length)
     dataset = TextDataset(passages)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=10, collate_fn=collator)
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
     with torch.no_grad():
         for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
@@ -261,11 +273,18 @@ def embed_passages(opt, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 100 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
@@ -280,38 +299,24 @@ def get_passage_embedding(args, passages, model, tokenizer):
             end_idx = len(passages)
         passages_piece = passages[start_idx:end_idx]
         logger.info(f'Embedding generation for {len(passages_piece)} passages from idx {start_idx} to {end_idx}')
-        allids, allembeddings = embed_passages(args, passages_piece, model, tokenizer)
         if is_first_worker():
             if not os.path.exists(args.output_dir):
                 os.makedirs(args.output_dir)
         dist.barrier()
-        pickle_path = os.path.join(args.output_dir,
-                                   "{1}_data_obj_{0}.pb".format(str(args.local_rank), 'passage_embedding'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allembeddings, handle, protocol=4)
-        pickle_path = os.path.join(args.output_dir,
-                                   "{1}_data_obj_{0}.pb".format(str(args.local_rank), 'passage_embedding_id'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allids, handle, protocol=4)
-        logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
+        writer = EmbeddingShardWriter(args.output_dir, 'passage_embedding', args.local_rank, start_idx, end_idx,
+                                      len(passages), tag=checkpoint_fingerprint(args.eval_model_dir))
+        embed_passages(args, passages_piece, model, tokenizer, writer=writer)
+        logger.info(f'Total passages processed {writer.completed}.')
         dist.barrier()
 
     passage_embedding, passage_embedding_id = None, None
     if is_first_worker():
-        passage_embedding_list = []
-        passage_embedding_id_list = []
-        for i in range(args.world_size):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_list.append(b)
-        for i in range(args.world_size):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding_id'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_id_list.append(b)
-        passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-        passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+        if not args.load_cache:
+            write_manifest(args.output_dir, 'passage_embedding', args.world_size, len(passages),
+                           checkpoint=args.eval_model_dir)
+        # one read-only memmap over every rank's rows, nothing is merged in memory
+        shards = EmbeddingShards(args.output_dir, 'passage_embedding')
+        passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
     return passage_embedding, passage_embedding_id
 
 
@@ -359,7 +364,12 @@ def generate_new_embeddings(args, tokenizer, model):
     passages = load_data(args)
     logger.info("***** inference of passages *****")
 
-    passage_embedding, passage_embedding2id = get_passage_embedding(args, passages, model, tokenizer)
+    index_cache = find_cached_index(args, args.eval_model_dir, len(passages))
+    if index_cache is not None:
+        logger.info("***** Reusing cached index %s, skip passage inference *****", index_cache)
+        passage_embedding, passage_embedding2id = None, None
+    else:
+        passage_embedding, passage_embedding2id = get_passage_embedding(args, passages, model, tokenizer)
     logger.info("***** Done passage inference *****")
 
     logger.info("***** inference of test query *****")
@@ -411,34 +421,23 @@ def generate_new_embeddings(args, tokenizer, model):
         for passage in passages:
             passage_text[passage[0]] = (passage[1], passage[2])
 
-        dim = passage_embedding.shape[1]
-        print('passage embedding shape: ' + str(passage_embedding.shape))
-        logger.info("***** Begin passage_embedding reorder *****")
-        new_passage_embedding = passage_embedding.copy()
-        for i in range(passage_embedding.shape[0]):
-            new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
-        del (passage_embedding)
-        passage_embedding = new_passage_embedding
-        passage_embedding2id = np.arange(passage_embedding.shape[0])
-        logger.info("***** Begin passage_embedding reorder  *****")
+        if index_cache is None:
+            dim = passage_embedding.shape[1]
+            print('passage embedding shape: ' + str(passage_embedding.shape))
+            logger.info("***** Begin passage_embedding reorder *****")
+            passage_embedding = reorder_by_ids(passage_embedding, passage_embedding2id)
+            passage_embedding2id = np.arange(passage_embedding.shape[0])
+            logger.info("***** Begin passage_embedding reorder  *****")
 
         logger.info("***** Begin ANN Index build *****")
         top_k = args.top_k
         faiss.omp_set_num_threads(args.thread_num)
-        cpu_index = faiss.IndexFlatIP(dim)
-
-        co = faiss.GpuMultipleClonerOptions()
-        co.shard = True
-        co.useFloat16 = True
-        gpu_index_flat = faiss.index_cpu_to_all_gpus(  # build the index
-            cpu_index,
-            co=co
-        )
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
-        cpu_index = gpu_index_flat
+        if index_cache is not None:
+            cpu_index, passage_embedding2id = load_index_from_args(args, index_cache, use_float16=True)
+        else:
+            cpu_index = build_index_from_args(args, passage_embedding, queries=test_question_embedding, use_float16=True)
+            cache_index_from_args(args, args.eval_model_dir, cpu_index, passage_embedding2id)
         # cpu_index.add(passage_embedding.astype(np.float32))
-        # output_path = os.path.join(args.output_dir, 'faiss.index')
-        # faiss.write_index(cpu_index, output_path)
         logger.info("***** Done ANN Index *****")
 
         logger.info("***** Begin test ANN Index *****")
@@ -544,38 +543,15 @@ def generate_new_embeddings(args, tokenizer, model):
 
 def GeneratePassaageID(args, passages, answers, query_embedding2id, passage_embedding2id, closest_docs,
                        training_query_positive_id):
+    query_ids = [query_embedding2id[query_idx] for query_idx in range(closest_docs.shape[0])]
+    doc_ids = np.asarray(passage_embedding2id)[closest_docs]
+    negatives, positives = label_candidates(passages, answers, query_ids, doc_ids, training_query_positive_id,
+                                            args.negative_sample, num_workers=args.label_workers)
     query_negative_passage = {}
     query_positive_passage = {}
-    tok_opts = {}
-    tokenizer = SimpleTokenizer(**tok_opts)
-
-    for query_idx in tqdm(range(closest_docs.shape[0])):
-        query_id = query_embedding2id[query_idx]
-
-        pos_pid = training_query_positive_id[query_id]
-        doc_ids = [passage_embedding2id[pidx] for pidx in closest_docs[query_idx]]
-
-        query_negative_passage[query_id] = []
-        query_positive_passage[query_id] = []
-        neg_cnt = 0
-        pos_cnt = 0
-        for doc_id in doc_ids:
-            if doc_id == pos_pid:
-                continue
-            if doc_id in query_negative_passage[query_id]:
-                continue
-            if neg_cnt >= args.negative_sample:
-                break
-
-            text = passages[doc_id][0]
-
-            if not has_answer(answers[query_id], text, tokenizer):
-                query_negative_passage[query_id].append(doc_id)
-                neg_cnt += 1
-            else:
-                if pos_cnt < 10:
-                    query_positive_passage[query_id].append(doc_id)
-                    pos_cnt += 1
+    for query_id, negative_ids, positive_ids in zip(query_ids, negatives, positives):
+        query_negative_passage[query_id] = negative_ids[negative_ids >= 0].tolist()
+        query_positive_passage[query_id] = positive_ids[positive_ids >= 0].tolist()
     return query_negative_passage, query_positive_passage
 
 
@@ -589,8 +565,7 @@ class V_dataset(Dataset):
         self.similar_scores = similar_scores
         self.query_embedding2id = query_embedding2id
         self.passage_embedding2id = passage_embedding2id
-        tok_opts = {}
-        self.tokenizer = SimpleTokenizer(**tok_opts)
+        self.matcher = AnswerMatcher()
 
     def __getitem__(self, query_idx):
         query_id = self.query_embedding2id[query_idx]
@@ -601,9 +576,10 @@ class V_dataset(Dataset):
         temp_result_dict['question'] = self.questions[query_id]
         temp_result_dict['answers'] = self.answers[query_id]
         temp_result_dict['ctxs'] = []
+        answer_tokens = self.matcher.answer_tokens(self.answers[query_id])
         for i, doc_id in enumerate(doc_ids):
             text, title = self.passages[doc_id]
-            hits.append(has_answer(self.answers[query_id], text, self.tokenizer))
+            hits.append(self.matcher.has_answer(answer_tokens, doc_id, text))
             temp_result_dict['ctxs'].append({'d_id': str(doc_id),
                                              'text': text,
                                              'title': title,
@@ -648,88 +624,12 @@ def validate(questions, passages, answers, closest_docs, similar_scores, query_e
     top_k_hits = [v / len(closest_docs) for v in top_k_hits]
     logger.info('Validation results: top k documents hits accuracy %s', top_k_hits)
 
-    return top_k_hits, final_scores, Eval_Tool.get_matrics(final_scores), final_result_dict_list
+    return top_k_hits, final_scores, hit_list_metrics(final_scores), final_result_dict_list
 
 
 import math
 
 
-class Eval_Tool:
-    @classmethod
-    def MRR_n(cls, results_list, n):
-        mrr_100_list = []
-        for hits in results_list:
-            score = 0
-            for rank, item in enumerate(hits[:n]):
-                if item:
-                    score = 1.0 / (rank + 1.0)
-                    break
-            mrr_100_list.append(score)
-        return sum(mrr_100_list) / len(mrr_100_list)
-
-    @classmethod
-    def MAP_n(cls, results_list, n):
-        MAP_n_list = []
-        for predict in results_list:
-            ap = 0
-            hit_num = 1
-            for rank, item in enumerate(predict[:n]):
-                if item:
-                    ap += hit_num / (rank + 1.0)
-                    hit_num += 1
-            ap /= n
-            MAP_n_list.append(ap)
-        return sum(MAP_n_list) / len(MAP_n_list)
-
-    @classmethod
-    def DCG_n(cls, results_list, n):
-        DCG_n_list = []
-        for predict in results_list:
-            DCG = 0
-            for rank, item in enumerate(predict[:n]):
-                if item:
-                    DCG += 1 / math.log2(rank + 2)
-            DCG_n_list.append(DCG)
-        return sum(DCG_n_list) / len(DCG_n_list)
-
-    @classmethod
-    def nDCG_n(cls, results_list, n):
-        nDCG_n_list = []
-        for predict in results_list:
-            nDCG = 0
-            for rank, item in enumerate(predict[:n]):
-                if item:
-                    nDCG += 1 / math.log2(rank + 2)
-            nDCG /= sum([math.log2(i + 2) for i in range(n)])
-            nDCG_n_list.append(nDCG)
-        return sum(nDCG_n_list) / len(nDCG_n_list)
-
-    @classmethod
-    def P_n(cls, results_list, n):
-        p_n_list = []
-        for predict in results_list:
-            true_num = 0
-            for rank, item in enumerate(predict[:n]):
-                if item:
-                    true_num += 1
-            p = true_num / n
-            p_n_list.append(p)
-        return sum(p_n_list) / len(p_n_list)
-
-    @classmethod
-    def get_matrics(cls, results_list):
-        p_list = [1, 5, 10, 20, 50, 100]
-        metrics = {'MRR_n': cls.MRR_n,
-                   'MAP_n': cls.MAP_n,
-                   'DCG_n': cls.DCG_n, 'nDCG_n': cls.nDCG_n, 'P_n': cls.P_n}
-        result_dict = {}
-        for metric_name, fuction in metrics.items():
-            for p in p_list:
-                temp_result = fuction(results_list, p)
-                result_dict[metric_name + '@_' + str(p)] = temp_result
-        return result_dict
-
-
 def get_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -849,6 +749,11 @@ def get_arguments():
         action="store_true",
     )
     parser.add_argument("--write_hardneg", type=bool, default=False)
+    parser.add_argument("--negative_sample", type=int, default=30,
+                        help="hard negatives kept per training query by GeneratePassaageID")
+    parser.add_argument("--label_workers", type=int, default=None,
+                        help="processes labeling retrieved passages in GeneratePassaageID, all cores by default")
+    add_index_args(parser)
     args = parser.parse_args()
 
     return args
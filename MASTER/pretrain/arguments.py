@@ -21,6 +21,10 @@ class DataTrainingArguments:
     train_path: Union[str] = field(
         default=None, metadata={"help": "Path to train data"}
     )
+    train_arrow_dir: Optional[str] = field(
+        default=None, metadata={"help": "Path to the Arrow train dataset of prepare_data.py, used instead of "
+                                        "--train_dir"}
+    )
     train_file: Optional[str] = field(default=None, metadata={"help": "The input training data file (a text file)."})
     validation_file: Optional[str] = field(
         default=None,
@@ -37,6 +41,10 @@ class DataTrainingArguments:
     frequency_dict: Union[str] = field(
         default=None, metadata={"help": "Path to frequency dict"}
     )
+    keyword_weights: Optional[str] = field(
+        default=None, metadata={"help": "Path to the .npz keyword weights of keyword_weights.py, used instead of "
+                                        "--frequency_dict"}
+    )
     overwrite_cache: bool = field(
         default=False, metadata={"help": "Overwrite the cached training and evaluation sets"}
     )
@@ -58,6 +66,9 @@ class DataTrainingArguments:
     decoder_mlm_probability: float = field(
         default=0.5, metadata={"help": "Ratio of tokens to mask for decoder masked language modeling loss"}
     )
+    vectorized_masking: bool = field(
+        default=True, metadata={"help": "Sample the whole word masks of a batch with numpy instead of per example"}
+    )
     pad_to_max_length: bool = field(
         default=False,
         metadata={
@@ -110,6 +121,13 @@ class ModelArguments:
     skip_from: int = field(default=2)
     late_mlm: bool = field(default=False)
     temp: float = field(default=0.05)
+    batched_heads: bool = field(
+        default=False,
+        metadata={"help": "Run the decoder heads whose inputs have the same shape as one group of batched layers"},
+    )
+    head_timing_steps: int = field(
+        default=0, metadata={"help": "Log the forward time of each decoder head (group) every this many steps, 0 off"}
+    )
 
 
 @dataclass
@@ -2,16 +2,25 @@ import random
 from dataclasses import dataclass
 from typing import List, Dict
 import copy
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from transformers import DataCollatorForWholeWordMask
 
+from keyword_weights import KeywordWeights, stored_word_weights
+from masking import WholeWordMasker
+
+# the [SEP] id appended to every query of an example when they are joined
+QUERY_SEP_ID = 102
+
 
 @dataclass
 class CondenserCollator(DataCollatorForWholeWordMask):
     max_seq_length: int = 512
     decoder_mlm_probability: float = 0.5
     frequency_dict: dict = None
+    keyword_weights: KeywordWeights = None
+    vectorized_masking: bool = True
 
     def __post_init__(self):
         super(CondenserCollator, self).__post_init__()
@@ -26,6 +35,14 @@ class CondenserCollator(DataCollatorForWholeWordMask):
             raise NotImplementedError(f'{type(self.tokenizer)} collator not supported yet')
 
         self.specials = self.tokenizer.all_special_tokens
+        # __call__ masks with the BERT word pieces
+        self.masker = None
+        if self.vectorized_masking and isinstance(self.tokenizer, (BertTokenizer, BertTokenizerFast)):
+            if self.keyword_weights is None and self.frequency_dict:
+                self.keyword_weights = KeywordWeights.from_frequency_dict(self.tokenizer, self.frequency_dict)
+            self.masker = WholeWordMasker(self.tokenizer, self.keyword_weights)
+        elif self.frequency_dict is None and self.keyword_weights is not None:
+            raise ValueError('The per-example masking needs the frequency dict, not only keyword weights')
 
     def _whole_word_cand_indexes_bert(self, input_tokens: List[str]):
         cand_indexes = []
@@ -219,9 +236,13 @@ class CondenserCollator(DataCollatorForWholeWordMask):
         return mask_labels
 
     def _truncate(self, example: List[int]):
+        return self._truncate_window(example)[0]
+
+    def _truncate_window(self, example: List[int]):
+        """_truncate, along with the offset of the kept window in `example`"""
         tgt_len = self.max_seq_length - self.tokenizer.num_special_tokens_to_add(False)
         if len(example) <= tgt_len:
-            return example
+            return example, 0
         trunc = len(example) - tgt_len
         trunc_left = random.randint(0, trunc)
         trunc_right = trunc - trunc_left
@@ -233,176 +254,154 @@ class CondenserCollator(DataCollatorForWholeWordMask):
         if not len(truncated) == tgt_len:
             print(len(example), len(truncated), trunc_left, trunc_right, tgt_len, flush=True)
             raise ValueError
-        return truncated
+        return truncated, trunc_left
 
     def _pad(self, seq, val=0):
         tgt_len = self.max_seq_length
         assert len(seq) <= tgt_len
         return seq + [val for _ in range(tgt_len - len(seq))]
 
-    def __call__(self, examples: List[Dict[str, List[int]]]):
-        encoded_examples = []
-        masks = []
-        next_encoder_encoded_examples = []
-        next_encoder_masks = []
-        next_decoder_encoded_examples = []
-        next_decoder_masks = []
-        query_encoded_examples = []
-        query_masks = []
-        gpt_encoded_examples = []
-        gpt_masks = []
-
-        mlm_masks = []
-        decoder_mlm_masks = []
-        next_encoder_mlm_masks = []
-        next_decoder_mlm_masks = []
-        overlap_encoder_mlm_masks = []
-        overlap_decoder_mlm_masks = []
-        query_mlm_masks = []
-        gpt_mlm_masks = []
+    def _pad_labels(self, labels):
+        """[N, T] 0/1 labels as [N, max_seq_length], shifted right past the [CLS] slot"""
+        padded = np.zeros((len(labels), self.max_seq_length), dtype=np.int64)
+        padded[:, 1:1 + labels.shape[1]] = labels
+        return padded
+
+    def _mask_labels(self, examples, texts, text_offsets, queries, gpts):
+        """whole word mask labels of the text, query, gpt, next encoder/decoder and overlap inputs,
+        each [N, max_seq_length]"""
+        if self.masker is not None:
+            masker = self.masker
+            # numpy draws seeded from `random`, which set_seed and the dataloader workers seed
+            rng = np.random.default_rng(random.getrandbits(64))
+            text_segments = masker.segment(texts)
+            next_decoder_segments = masker.segment([text[len(text) // 2:] for text in texts])
+            text_weights = next_decoder_weights = None
+            # keyword weights stored with the examples by keyword_weights.py
+            if all('word_weights' in e for e in examples):
+                text_weights = stored_word_weights(text_segments, text_offsets, examples, self.keyword_weights)
+                next_decoder_weights = stored_word_weights(
+                    next_decoder_segments, [offset + len(text) // 2 for offset, text in zip(text_offsets, texts)],
+                    examples, self.keyword_weights)
+            overlap_encoder_labels = masker.mask(text_segments, 0.5, rng)
+            in_text = np.arange(text_segments.ids.shape[1]) < text_segments.lengths[:, None]
+            labels = [
+                masker.mask(text_segments, self.mlm_probability, rng),
+                masker.mask_keyword(text_segments, self.decoder_mlm_probability, rng, weights=text_weights),
+                masker.mask(masker.segment(queries), self.decoder_mlm_probability, rng),
+                masker.mask(masker.segment(gpts), self.decoder_mlm_probability, rng),
+                masker.mask(masker.segment([text[:len(text) // 2] for text in texts]), self.mlm_probability, rng),
+                masker.mask_keyword(next_decoder_segments, self.decoder_mlm_probability, rng,
+                                    weights=next_decoder_weights),
+                overlap_encoder_labels,
+                in_text & ~overlap_encoder_labels,
+            ]
+            return [self._pad_labels(label.astype(np.int64)) for label in labels]
+
+        def to_tokens(ids):
+            return [self.tokenizer._convert_id_to_token(tid) for tid in ids]
+
+        def pad(masks):
+            return np.array([self._pad([0] + mask) for mask in masks], dtype=np.int64)
+
+        text_tokens = [to_tokens(text) for text in texts]
+        overlap_masks = [self._whole_word_mask_dual(tokens) for tokens in text_tokens]
+        return [
+            pad([self._whole_word_mask(tokens) for tokens in text_tokens]),
+            pad([self._whole_word_mask_decoder_keyword(tokens) for tokens in text_tokens]),
+            pad([self._whole_word_mask_decoder(to_tokens(query)) for query in queries]),
+            pad([self._whole_word_mask_decoder(to_tokens(gpt)) for gpt in gpts]),
+            pad([self._whole_word_mask(tokens[:len(tokens) // 2]) for tokens in text_tokens]),
+            pad([self._whole_word_mask_decoder_keyword(tokens[len(tokens) // 2:]) for tokens in text_tokens]),
+            pad([encoder_mask for encoder_mask, _ in overlap_masks]),
+            pad([decoder_mask for _, decoder_mask in overlap_masks]),
+        ]
+
+    def _encode(self, ids):
+        encoded = self.tokenizer.encode_plus(
+            ids,
+            add_special_tokens=True,
+            max_length=self.max_seq_length,
+            padding="max_length",
+            truncation=True,
+            return_token_type_ids=False,
+        )
+        return encoded['input_ids'], encoded['attention_mask']
 
+    def __call__(self, examples: List[Dict[str, List[int]]]):
+        texts = []
+        text_offsets = []
+        queries = []
+        gpts = []
         for e in examples:
-            e_trunc = self._truncate(e['text'])
-            tokens = [self.tokenizer._convert_id_to_token(tid) for tid in e_trunc]
-            mlm_mask = self._whole_word_mask(tokens)
-            mlm_mask = self._pad([0] + mlm_mask)
-            mlm_masks.append(mlm_mask)
-
-            decoder_mlm_mask = self._whole_word_mask_decoder_keyword(tokens)
-            decoder_mlm_mask = self._pad([0] + decoder_mlm_mask)
-            decoder_mlm_masks.append(decoder_mlm_mask)
-
-            long_query = []
-            for query in e['queries']:
-                long_query.extend(query+[102])
-            long_query = self._truncate(long_query)
-            query_tokens = [self.tokenizer._convert_id_to_token(tid) for tid in long_query]
-            query_mlm_mask = self._whole_word_mask_decoder(query_tokens)
-            query_mlm_mask = self._pad([0] + query_mlm_mask)
-            query_mlm_masks.append(query_mlm_mask)
-
-            gpt_e_trunc = self._truncate(e['next'][0])
-            gpt_tokens = [self.tokenizer._convert_id_to_token(tid) for tid in gpt_e_trunc]
-            if len(gpt_tokens)==0:
+            e_trunc, text_offset = self._truncate_window(e['text'])
+            texts.append(e_trunc)
+            text_offsets.append(text_offset)
+
+            # the queries are already joined in the datasets of prepare_data.py
+            if 'query_ids' in e:
+                long_query = e['query_ids']
+            else:
+                long_query = []
+                for query in e['queries']:
+                    long_query.extend(query+[QUERY_SEP_ID])
+            queries.append(self._truncate(long_query))
+
+            gpt_e_trunc = self._truncate(e['gpt_ids'] if 'gpt_ids' in e else e['next'][0])
+            if len(gpt_e_trunc)==0:
                 gpt_e_trunc = e_trunc
-                gpt_tokens = tokens
-            gpt_mlm_mask = self._whole_word_mask_decoder(gpt_tokens)
-            gpt_mlm_mask = self._pad([0] + gpt_mlm_mask)
-            gpt_mlm_masks.append(gpt_mlm_mask)
-
-            pat_id = len(tokens)//2
-            next_encoder_e_trunc = e_trunc[:pat_id]
-            next_encoder_tokens = tokens[:pat_id]
-            next_encoder_mlm_mask = self._whole_word_mask(next_encoder_tokens)
-            next_encoder_mlm_mask = self._pad([0] + next_encoder_mlm_mask)
-            next_encoder_mlm_masks.append(next_encoder_mlm_mask)
-
-            next_decoder_e_trunc = e_trunc[pat_id:]
-            next_decoder_tokens = tokens[pat_id:]
-            next_decoder_mlm_mask = self._whole_word_mask_decoder_keyword(next_decoder_tokens)
-            next_decoder_mlm_mask = self._pad([0] + next_decoder_mlm_mask)
-            next_decoder_mlm_masks.append(next_decoder_mlm_mask)
-
-            overlap_encoder_mlm_mask, overlap_decoder_mlm_mask = self._whole_word_mask_dual(tokens)
-            overlap_encoder_mlm_mask = self._pad([0] + overlap_encoder_mlm_mask)
-            overlap_encoder_mlm_masks.append(overlap_encoder_mlm_mask)
-
-            overlap_decoder_mlm_mask = self._pad([0] + overlap_decoder_mlm_mask)
-            overlap_decoder_mlm_masks.append(overlap_decoder_mlm_mask)
-
-            encoded = self.tokenizer.encode_plus(
-                e_trunc,
-                add_special_tokens=True,
-                max_length=self.max_seq_length,
-                padding="max_length",
-                truncation=True,
-                return_token_type_ids=False,
-            )
-            masks.append(encoded['attention_mask'])
-            encoded_examples.append(encoded['input_ids'])
-
-            encoded_query = self.tokenizer.encode_plus(
-                long_query,
-                add_special_tokens=True,
-                max_length=self.max_seq_length,
-                padding="max_length",
-                truncation=True,
-                return_token_type_ids=False,
-            )
-            query_masks.append(encoded_query['attention_mask'])
-            query_encoded_examples.append(encoded_query['input_ids'])
-
-            encoded_gpt = self.tokenizer.encode_plus(
-                gpt_e_trunc,
-                add_special_tokens=True,
-                max_length=self.max_seq_length,
-                padding="max_length",
-                truncation=True,
-                return_token_type_ids=False,
-            )
-            gpt_masks.append(encoded_gpt['attention_mask'])
-            gpt_encoded_examples.append(encoded_gpt['input_ids'])
-
-            next_encoder_encoded = self.tokenizer.encode_plus(
-                next_encoder_e_trunc,
-                add_special_tokens=True,
-                max_length=self.max_seq_length,
-                padding="max_length",
-                truncation=True,
-                return_token_type_ids=False,
-            )
-            next_encoder_masks.append(next_encoder_encoded['attention_mask'])
-            next_encoder_encoded_examples.append(next_encoder_encoded['input_ids'])
-
-            next_decoder_encoded = self.tokenizer.encode_plus(
-                next_decoder_e_trunc,
-                add_special_tokens=True,
-                max_length=self.max_seq_length,
-                padding="max_length",
-                truncation=True,
-                return_token_type_ids=False,
-            )
-            next_decoder_masks.append(next_decoder_encoded['attention_mask'])
-            next_decoder_encoded_examples.append(next_decoder_encoded['input_ids'])
+            gpts.append(gpt_e_trunc)
+
+        mlm_masks, decoder_mlm_masks, query_mlm_masks, gpt_mlm_masks, next_encoder_mlm_masks, \
+            next_decoder_mlm_masks, overlap_encoder_mlm_masks, overlap_decoder_mlm_masks = \
+            self._mask_labels(examples, texts, text_offsets, queries, gpts)
+
+        encoded_examples, masks = zip(*[self._encode(text) for text in texts])
+        query_encoded_examples, query_masks = zip(*[self._encode(query) for query in queries])
+        gpt_encoded_examples, gpt_masks = zip(*[self._encode(gpt) for gpt in gpts])
+        next_encoder_encoded_examples, next_encoder_masks = zip(
+            *[self._encode(text[:len(text) // 2]) for text in texts])
+        next_decoder_encoded_examples, next_decoder_masks = zip(
+            *[self._encode(text[len(text) // 2:]) for text in texts])
 
         inputs, labels = self.torch_mask_tokens(
             torch.tensor(encoded_examples, dtype=torch.long),
-            torch.tensor(mlm_masks, dtype=torch.long)
+            torch.from_numpy(mlm_masks)
         )
 
         decoder_inputs, decoder_labels = self.torch_mask_tokens(
             torch.tensor(encoded_examples, dtype=torch.long),
-            torch.tensor(decoder_mlm_masks, dtype=torch.long)
+            torch.from_numpy(decoder_mlm_masks)
         )
 
         query_inputs, query_labels = self.torch_mask_tokens(
             torch.tensor(query_encoded_examples, dtype=torch.long),
-            torch.tensor(query_mlm_masks, dtype=torch.long)
+            torch.from_numpy(query_mlm_masks)
         )
 
         gpt_inputs, gpt_labels = self.torch_mask_tokens(
             torch.tensor(gpt_encoded_examples, dtype=torch.long),
-            torch.tensor(gpt_mlm_masks, dtype=torch.long)
+            torch.from_numpy(gpt_mlm_masks)
         )
 
         next_encoder_inputs, next_encoder_labels = self.torch_mask_tokens(
             torch.tensor(next_encoder_encoded_examples, dtype=torch.long),
-            torch.tensor(next_encoder_mlm_masks, dtype=torch.long)
+            torch.from_numpy(next_encoder_mlm_masks)
         )
 
         next_decoder_inputs, next_decoder_labels = self.torch_mask_tokens(
             torch.tensor(next_decoder_encoded_examples, dtype=torch.long),
-            torch.tensor(next_decoder_mlm_masks, dtype=torch.long)
+            torch.from_numpy(next_decoder_mlm_masks)
         )
 
         overlap_encoder_inputs, overlap_encoder_labels = self.torch_mask_tokens(
             torch.tensor(encoded_examples, dtype=torch.long),
-            torch.tensor(overlap_encoder_mlm_masks, dtype=torch.long)
+            torch.from_numpy(overlap_encoder_mlm_masks)
         )
 
         overlap_decoder_inputs, overlap_decoder_labels = self.torch_mask_tokens(
             torch.tensor(encoded_examples, dtype=torch.long),
-            torch.tensor(overlap_decoder_mlm_masks, dtype=torch.long)
+            torch.from_numpy(overlap_decoder_mlm_masks)
         )
         batch = {
             "input_ids": inputs,
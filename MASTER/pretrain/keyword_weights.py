@@ -0,0 +1,192 @@
+import argparse
+import json
+import logging
+import os
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# multiplier of the polynomial hash of the wordpiece ids of a word
+HASH_BASE = 0x100000001B3
+# lines segmented per batch by the preprocessing
+LINES_PER_BATCH = 4096
+
+
+def word_hash(piece_ids):
+    """uint64 hash of a word's wordpiece ids: sum(id * HASH_BASE ** k) mod 2 ** 64"""
+    return sum(piece_id * pow(HASH_BASE, k, 2 ** 64) for k, piece_id in enumerate(piece_ids)) % 2 ** 64
+
+
+def _hash_powers(n):
+    powers = np.ones(max(1, n), dtype=np.uint64)
+    powers[1:] = np.cumprod(np.full(len(powers) - 1, HASH_BASE, dtype=np.uint64))
+    return powers
+
+
+class KeywordWeights:
+    """The inverse word frequencies of the Masked Keywords Prediction as compact arrays.
+
+    A word of a single wordpiece gets its weight from `piece_weights`, indexed by token id. Longer
+    words are found by the `word_hash` of their wordpiece ids in the sorted `word_hashes`, aligned
+    with `word_weights`. Words missing from the frequency dict weigh 1, as in
+    `_whole_word_cand_indexes_bert_keyword`.
+    """
+
+    def __init__(self, piece_weights, word_hashes, word_weights):
+        self.piece_weights = piece_weights
+        self.word_hashes = word_hashes
+        self.word_weights = word_weights
+
+    @classmethod
+    def from_frequency_dict(cls, tokenizer, frequency_dict):
+        """From the {word: frequency} dict of the README, whose words are their wordpieces joined
+        ('play##ing'). Words that do not split back into wordpieces of the vocab are skipped."""
+        vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        token_ids = {token: i for i, token in enumerate(vocab)}
+        piece_weights = np.ones(len(vocab), dtype=np.float32)
+        word_weights = {}
+        for word, frequency in frequency_dict.items():
+            if word in token_ids:
+                piece_weights[token_ids[word]] = 1 / frequency
+                continue
+            parts = word.split('##')
+            pieces = [parts[0]] + ['##' + part for part in parts[1:]]
+            if not parts[0] or any(piece not in token_ids for piece in pieces):
+                continue
+            word_weights[word_hash([token_ids[piece] for piece in pieces])] = 1 / frequency
+        word_hashes = np.array(sorted(word_weights), dtype=np.uint64)
+        return cls(piece_weights, word_hashes,
+                   np.array([word_weights[h] for h in word_hashes.tolist()], dtype=np.float32))
+
+    @classmethod
+    def load(cls, path):
+        arrays = np.load(path)
+        return cls(arrays['piece_weights'], arrays['word_hashes'], arrays['word_weights'])
+
+    def save(self, path):
+        np.savez(path, piece_weights=self.piece_weights, word_hashes=self.word_hashes,
+                 word_weights=self.word_weights)
+
+    @staticmethod
+    def hash_words(segments):
+        """[N, W] `word_hash` of the words of `masking.Segments`, 0 past num_words"""
+        is_word = np.arange(segments.word_lengths.shape[1]) < segments.num_words[:, None]
+        hashes = np.zeros(segments.word_lengths.shape, dtype=np.uint64)
+        lengths = segments.word_lengths[is_word]
+        if not len(lengths):
+            return hashes
+        # the valid positions in row-major order run through the words one after another
+        pieces = segments.ids[segments.valid].astype(np.uint64)
+        word_firsts = np.concatenate([[0], np.cumsum(lengths)[:-1]])
+        piece_ranks = np.arange(len(pieces)) - np.repeat(word_firsts, lengths)
+        hashes[is_word] = np.add.reduceat(pieces * _hash_powers(lengths.max())[piece_ranks], word_firsts)
+        return hashes
+
+    def lookup(self, segments, words=None):
+        """[N, W] weights of the words of `masking.Segments`, only of the `words` ([N, W] mask)
+        when given and 1 elsewhere"""
+        weights = np.ones(segments.word_lengths.shape)
+        is_word = np.arange(weights.shape[1]) < segments.num_words[:, None]
+        if words is not None:
+            is_word &= words
+        single_piece = is_word & (segments.word_lengths == 1)
+        weights[single_piece] = self.piece_weights[segments.ids[np.nonzero(single_piece)[0],
+                                                                segments.word_starts[single_piece]]]
+        multi_piece = is_word & (segments.word_lengths > 1)
+        if multi_piece.any() and len(self.word_hashes):
+            hashes = self.hash_words(segments)[multi_piece]
+            found = np.minimum(np.searchsorted(self.word_hashes, hashes), len(self.word_hashes) - 1)
+            weights[multi_piece] = np.where(self.word_hashes[found] == hashes, self.word_weights[found], 1)
+        return weights
+
+
+def stored_word_weights(segments, offsets, examples, keyword_weights=None):
+    """[N, W] weights of the words of `segments`, the windows of the examples' texts that start
+    at `offsets`.
+
+    A word the window keeps whole takes the weight stored with its example by this module's
+    preprocessing (`word_starts`, `word_lengths` and `word_weights` over the whole text). A word
+    the window cuts is a different word, it is weighed with `keyword_weights` (1 without it).
+    """
+    num_sequences, width = segments.word_lengths.shape
+    # the stored words of all examples, keyed by (example, start) in increasing order
+    stride = max([len(e['text']) for e in examples] + [1])
+    keys = np.concatenate([row * stride + np.asarray(e['word_starts'], dtype=np.int64)
+                           for row, e in enumerate(examples)] + [np.zeros(0, dtype=np.int64)])
+    lengths = np.concatenate([np.asarray(e['word_lengths'], dtype=np.int64) for e in examples]
+                             + [np.zeros(0, dtype=np.int64)])
+    weights = np.concatenate([np.asarray(e['word_weights'], dtype=np.float64) for e in examples]
+                             + [np.zeros(0)])
+
+    whole = np.zeros((num_sequences, width), dtype=bool)
+    if len(keys):
+        window_keys = (np.arange(num_sequences)[:, None] * stride + np.asarray(offsets, dtype=np.int64)[:, None]
+                       + segments.word_starts)
+        found = np.minimum(np.searchsorted(keys, window_keys), len(keys) - 1)
+        whole = (np.arange(width) < segments.num_words[:, None]) & (keys[found] == window_keys) \
+            & (lengths[found] == segments.word_lengths)
+    if keyword_weights is not None:
+        word_weights = keyword_weights.lookup(segments, words=~whole)
+    else:
+        word_weights = np.ones((num_sequences, width))
+    if whole.any():
+        word_weights[whole] = weights[found[whole]]
+    return word_weights
+
+
+def main():
+    """Build the compact keyword weights of a frequency dict, and optionally store the word spans
+    and weights of every example next to its token ids: each json line of --train_dir gets
+    `word_starts`, `word_lengths` and `word_weights` over its "text" in --output_dir"""
+    from transformers import AutoTokenizer
+    from masking import WholeWordMasker
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="bert-base-uncased")
+    parser.add_argument("--frequency_dict", type=str, required=True)
+    parser.add_argument("--output", type=str, required=True, help="the .npz keyword weights for --keyword_weights")
+    parser.add_argument("--train_dir", type=str, default=None)
+    parser.add_argument("--output_dir", type=str, default=None)
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s", level=logging.INFO)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=False)
+    with open(args.frequency_dict, 'r', encoding='utf-8') as f:
+        keyword_weights = KeywordWeights.from_frequency_dict(tokenizer, json.load(f))
+    keyword_weights.save(args.output)
+    logger.info("%d multi-piece words, keyword weights saved to %s", len(keyword_weights.word_hashes), args.output)
+    if args.train_dir is None:
+        return
+
+    assert args.output_dir is not None, "--output_dir is needed with --train_dir"
+    os.makedirs(args.output_dir, exist_ok=True)
+    masker = WholeWordMasker(tokenizer)
+
+    def write(examples, out):
+        segments = masker.segment([e['text'] for e in examples])
+        weights = keyword_weights.lookup(segments)
+        for row, e in enumerate(examples):
+            num_words = segments.num_words[row]
+            e['word_starts'] = segments.word_starts[row, :num_words].tolist()
+            e['word_lengths'] = segments.word_lengths[row, :num_words].tolist()
+            e['word_weights'] = [float('%.6g' % weight) for weight in weights[row, :num_words]]
+            out.write(json.dumps(e) + '\n')
+
+    for file in sorted(os.listdir(args.train_dir)):
+        if not (file.endswith('tsv') or file.endswith('json')):
+            continue
+        with open(os.path.join(args.train_dir, file), 'r') as f, \
+                open(os.path.join(args.output_dir, file), 'w') as out:
+            examples = []
+            for line in tqdm(f, desc=file):
+                examples.append(json.loads(line))
+                if len(examples) == LINES_PER_BATCH:
+                    write(examples, out)
+                    examples = []
+            if examples:
+                write(examples, out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,193 @@
+import argparse
+import collections
+import json
+import logging
+import random
+import time
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# token ids of a batch of sequences, padded to [N, T], split into whole words
+Segments = collections.namedtuple('Segments', [
+    'ids',           # [N, T] token ids, 0 past the end of a sequence
+    'lengths',       # [N] sequence lengths
+    'valid',         # [N, T] positions that belong to a word: inside the sequence and not a special token
+    'word_ids',      # [N, T] index of the word of each valid position within its sequence, -1 elsewhere
+    'num_words',     # [N]
+    'word_starts',   # [N, W] position of the first wordpiece of each word, 0 past num_words
+    'word_lengths',  # [N, W] wordpieces per word, 0 past num_words
+])
+
+
+class WholeWordMasker:
+    """Whole word masking of `CondenserCollator` on numpy arrays, for a whole batch at once.
+
+    `segment` splits the token id sequences into words once, with vocab-level tables of the
+    continuation ('##') wordpieces and the special tokens: words are formed as in
+    `_whole_word_cand_indexes_bert`. The mask functions sample those words for every sequence of
+    the batch together and return [N, T] boolean labels, with the same distribution as the
+    per-example loops:
+
+    * `mask`: `_whole_word_mask` (and its decoder/dual variants) with a given probability. The
+      words are visited in a random order and taken while they fit in the number to predict.
+    * `mask_keyword`: `_whole_word_mask_decoder_keyword`. Words are drawn without replacement
+      with probability proportional to 1 / frequency, from `keyword_weights.KeywordWeights`
+      or given weights, until the number to predict is reached.
+    """
+
+    def __init__(self, tokenizer, keyword_weights=None):
+        self.vocab = tokenizer.convert_ids_to_tokens(list(range(len(tokenizer))))
+        self.is_continuation = np.array([token.startswith('##') for token in self.vocab], dtype=bool)
+        self.is_special = np.zeros(len(self.vocab), dtype=bool)
+        self.is_special[tokenizer.convert_tokens_to_ids(tokenizer.all_special_tokens)] = True
+        self.keyword_weights = keyword_weights
+
+    def segment(self, sequences):
+        num_sequences = len(sequences)
+        lengths = np.array([len(seq) for seq in sequences], dtype=np.int64)
+        ids = np.zeros((num_sequences, max(1, lengths.max(initial=0))), dtype=np.int64)
+        in_sequence = np.arange(ids.shape[1]) < lengths[:, None]
+        if lengths.sum():
+            ids[in_sequence] = np.concatenate([np.asarray(seq, dtype=np.int64) for seq in sequences])
+        valid = in_sequence & ~self.is_special[ids]
+        # a continuation piece opens a word when no word precedes it
+        first = valid & (np.cumsum(valid, axis=1) == 1)
+        starts = valid & (first | ~self.is_continuation[ids])
+        word_ids = np.where(valid, np.cumsum(starts, axis=1) - 1, -1)
+        num_words = starts.sum(axis=1)
+        width = max(1, num_words.max(initial=0))
+        rows = np.broadcast_to(np.arange(num_sequences)[:, None], ids.shape)
+        word_starts = np.zeros((num_sequences, width), dtype=np.int64)
+        word_starts[rows[starts], word_ids[starts]] = np.nonzero(starts)[1]
+        word_lengths = np.bincount(rows[valid] * width + word_ids[valid],
+                                   minlength=num_sequences * width).reshape(num_sequences, width)
+        return Segments(ids, lengths, valid, word_ids, num_words, word_starts, word_lengths)
+
+    @staticmethod
+    def _num_to_predict(num_tokens, probability, max_predictions):
+        return np.minimum(max_predictions, np.maximum(1, np.rint(num_tokens * probability).astype(np.int64)))
+
+    @staticmethod
+    def _labels(segments, order, taken):
+        """[N, T] labels of the positions of the words `taken` ([N, W], in the word `order`)"""
+        chosen = np.zeros_like(taken)
+        np.put_along_axis(chosen, order, taken, axis=1)
+        return segments.valid & np.take_along_axis(chosen, np.maximum(segments.word_ids, 0), axis=1)
+
+    def _sorted_word_lengths(self, segments, keys):
+        """word order of ascending `keys` per sequence, with the words past num_words last, and the
+        word lengths in that order"""
+        is_word = np.arange(keys.shape[1]) < segments.num_words[:, None]
+        order = np.argsort(np.where(is_word, keys, np.inf), axis=1, kind='stable')
+        return order, np.take_along_axis(segments.word_lengths, order, axis=1), is_word
+
+    def mask(self, segments, probability, rng, max_predictions=512):
+        num_to_predict = self._num_to_predict(segments.lengths, probability, max_predictions)
+        order, lengths, is_word = self._sorted_word_lengths(segments, rng.random(segments.word_lengths.shape))
+        lengths = np.where(is_word, lengths, segments.ids.shape[1] + max_predictions + 1)
+        taken = np.cumsum(lengths, axis=1) <= num_to_predict[:, None]
+        remaining = num_to_predict - np.where(taken, lengths, 0).sum(axis=1)
+        # past the first word that does not fit, the loop keeps taking the next words that still fit
+        while True:
+            fits = ~taken & (lengths <= remaining[:, None])
+            rows = np.flatnonzero(fits.any(axis=1))
+            if not len(rows):
+                break
+            first = fits[rows].argmax(axis=1)
+            taken[rows, first] = True
+            remaining[rows] -= lengths[rows, first]
+        return self._labels(segments, order, taken)
+
+    def mask_keyword(self, segments, probability, rng, max_predictions=512, weights=None):
+        num_to_predict = self._num_to_predict(segments.valid.sum(axis=1), probability, max_predictions)
+        if weights is None:
+            weights = self.word_weights(segments)
+        # exponential keys scaled by 1 / weight, sorted ascending, order the words as successive
+        # weighted draws without replacement
+        order, lengths, is_word = self._sorted_word_lengths(segments, rng.exponential(size=weights.shape) / weights)
+        # a word is taken while fewer than num_to_predict positions are masked, even if it overshoots
+        taken = is_word & (np.cumsum(lengths, axis=1) - lengths < num_to_predict[:, None])
+        return self._labels(segments, order, taken)
+
+    def word_weights(self, segments, words=None):
+        """[N, W] 1 / frequency of the words (of the `words` mask when given), 1 without keyword weights"""
+        if self.keyword_weights is None:
+            return np.ones(segments.word_lengths.shape)
+        return self.keyword_weights.lookup(segments, words)
+
+
+def _synthetic_examples(tokenizer, num_examples, max_seq_length, seed):
+    rng = np.random.default_rng(seed)
+    special_ids = set(tokenizer.all_special_ids)
+    vocab_ids = np.array([i for i in range(len(tokenizer)) if i not in special_ids])
+
+    def text(low, high):
+        return rng.choice(vocab_ids, size=int(rng.integers(low, high))).tolist()
+
+    return [{'text': text(max_seq_length // 2, 2 * max_seq_length),
+             'queries': [text(4, 16) for _ in range(int(rng.integers(1, 6)))],
+             'next': [text(0, 2 * max_seq_length)]} for _ in range(num_examples)]
+
+
+def main():
+    """Benchmark CondenserCollator with the numpy masking against the per-example Python loops,
+    on --train_path examples (json lines) or random token ids, and compare the masked rates"""
+    from transformers import AutoTokenizer
+    from data import CondenserCollator
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="bert-base-uncased")
+    parser.add_argument("--train_path", type=str, default=None, help="json lines pretraining data, random if unset")
+    parser.add_argument("--frequency_dict", type=str, default=None,
+                        help="keyword frequencies, every word weighs the same if unset")
+    parser.add_argument("--max_seq_length", type=int, default=512)
+    parser.add_argument("--batch_size", type=int, default=128)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--mlm_probability", type=float, default=0.3)
+    parser.add_argument("--decoder_mlm_probability", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer)
+    # an empty dict weighs every word 1 in both collators, the per-example one needs a dict
+    frequency_dict = json.load(open(args.frequency_dict)) if args.frequency_dict else {}
+    num_examples = args.batch_size * args.batches
+    if args.train_path:
+        with open(args.train_path) as f:
+            examples = [json.loads(line) for line, _ in zip(f, range(num_examples))]
+    else:
+        examples = _synthetic_examples(tokenizer, num_examples, args.max_seq_length, args.seed)
+    batches = [examples[i:i + args.batch_size] for i in range(0, len(examples), args.batch_size)]
+
+    for vectorized_masking in (False, True):
+        collator = CondenserCollator(
+            tokenizer=tokenizer,
+            mlm_probability=args.mlm_probability,
+            decoder_mlm_probability=args.decoder_mlm_probability,
+            max_seq_length=args.max_seq_length,
+            frequency_dict=frequency_dict,
+            vectorized_masking=vectorized_masking,
+        )
+        random.seed(args.seed)
+        masked, labelled = collections.Counter(), collections.Counter()
+        start = time.time()
+        for batch in batches:
+            batch = collator(batch)
+            for key, labels in batch.items():
+                if key.endswith('labels'):
+                    masked[key] += int((labels != -100).sum())
+            for key, mask in [('labels', 'attention_mask'), ('query_labels', 'query_attention_mask'),
+                              ('gpt_labels', 'gpt_attention_mask')]:
+                labelled[key] += int(batch[mask].sum())
+        seconds = (time.time() - start) / len(batches)
+        print('%-14s %8.2f ms / batch of %d' % ('numpy' if vectorized_masking else 'python', seconds * 1000,
+                                                args.batch_size))
+        print('  masked tokens per batch: ' + ', '.join(
+            '%s %.1f' % (key, count / len(batches)) for key, count in sorted(masked.items())))
+        print('  masked rate: ' + ', '.join(
+            '%s %.3f' % (key, masked[key] / labelled[key]) for key in sorted(labelled)))
+
+
+if __name__ == "__main__":
+    main()
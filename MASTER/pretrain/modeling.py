@@ -1,5 +1,9 @@
+import collections
+import math
 import os
+import time
 import warnings
+from contextlib import contextmanager, nullcontext
 
 import torch
 from torch import nn, Tensor
@@ -18,6 +22,119 @@ import logging
 logger = logging.getLogger(__name__)
 
 
+def select_labelled(hiddens, labels, ignore_index=-100):
+    """[n, H] hidden states and [n] labels of the positions that have a label, the only ones an
+    MLM loss reads; the vocabulary projection then runs on n rows instead of every position"""
+    labels = labels.reshape(-1)
+    hiddens = hiddens.reshape(labels.size(0), -1)
+    positions = (labels != ignore_index).nonzero(as_tuple=True)[0]
+    return hiddens.index_select(0, positions), labels.index_select(0, positions)
+
+
+def _grouped_linear(x, linears):
+    """the k-th of the `linears` applied to x[k] ([K, ..., in]), as one batched matmul"""
+    weight = torch.stack([linear.weight for linear in linears])
+    bias = torch.stack([linear.bias for linear in linears])
+    out = torch.baddbmm(bias.unsqueeze(1), x.reshape(x.size(0), -1, x.size(-1)), weight.transpose(1, 2))
+    return out.view(x.shape[:-1] + (weight.size(1),))
+
+
+def _grouped_layer_norm(x, norms):
+    weight = torch.stack([norm.weight for norm in norms])
+    bias = torch.stack([norm.bias for norm in norms])
+    shape = (x.size(0),) + (1,) * (x.dim() - 2) + (x.size(-1),)
+    return F.layer_norm(x, x.shape[-1:], eps=norms[0].eps) * weight.view(shape) + bias.view(shape)
+
+
+def _grouped_bert_layer(layers, hiddens, attention_mask):
+    """`BertLayer.forward` of K encoder layers, hiddens [K, B, L, H]"""
+    K, B, L, H = hiddens.shape
+    self_attention = [layer.attention.self for layer in layers]
+    num_heads = self_attention[0].num_attention_heads
+    head_size = self_attention[0].attention_head_size
+
+    def split_heads(x):
+        return x.reshape(K * B, L, num_heads, head_size).permute(0, 2, 1, 3)
+
+    query = split_heads(_grouped_linear(hiddens, [attention.query for attention in self_attention]))
+    key = split_heads(_grouped_linear(hiddens, [attention.key for attention in self_attention]))
+    value = split_heads(_grouped_linear(hiddens, [attention.value for attention in self_attention]))
+    scores = torch.matmul(query, key.transpose(-1, -2)) / math.sqrt(head_size) + attention_mask
+    probs = self_attention[0].dropout(F.softmax(scores, dim=-1))
+    context = torch.matmul(probs, value).permute(0, 2, 1, 3).reshape(K, B, L, H)
+
+    attention_outputs = [layer.attention.output for layer in layers]
+    attention_hiddens = _grouped_layer_norm(
+        attention_outputs[0].dropout(_grouped_linear(context, [output.dense for output in attention_outputs]))
+        + hiddens,
+        [output.LayerNorm for output in attention_outputs]
+    )
+    intermediate = layers[0].intermediate.intermediate_act_fn(
+        _grouped_linear(attention_hiddens, [layer.intermediate.dense for layer in layers]))
+    outputs = [layer.output for layer in layers]
+    return _grouped_layer_norm(
+        outputs[0].dropout(_grouped_linear(intermediate, [output.dense for output in outputs])) + attention_hiddens,
+        [output.LayerNorm for output in outputs]
+    )
+
+
+def grouped_bert_layers(heads, hiddens, attention_mask):
+    """Run K BertLayer stacks of the same depth (the `heads`) side by side.
+
+    `hiddens` [K * B, L, H] and the extended `attention_mask` [K * B, 1, 1, L] hold the inputs of
+    the heads one after the other; returns their outputs in the same layout. The weights of the
+    i-th layer of every head are stacked, so each projection of a layer is one batched matmul for
+    all heads instead of one per head. Matches `layer(hiddens, attention_mask)[0]` of each head
+    for layers with absolute position embeddings and no feed-forward chunking.
+    """
+    K = len(heads)
+    hiddens = hiddens.view((K, -1) + hiddens.shape[1:])
+    for layers in zip(*heads):
+        hiddens = _grouped_bert_layer(layers, hiddens, attention_mask)
+    return hiddens.view((-1,) + hiddens.shape[2:])
+
+
+class HeadTimer:
+    """Forward time of the decoder heads, logged as ms per forward every `report_steps` forwards.
+
+    On GPU the spans are timed with CUDA events, which are only synchronized when a report is due.
+    """
+
+    def __init__(self, report_steps):
+        self.report_steps = report_steps
+        self.steps = 0
+        self.totals = collections.OrderedDict()
+        self._events = []
+
+    @contextmanager
+    def time(self, name):
+        if torch.cuda.is_available():
+            start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            start.record()
+            yield
+            end.record()
+            self._events.append((name, start, end))
+        else:
+            start = time.perf_counter()
+            yield
+            self._add(name, (time.perf_counter() - start) * 1000)
+
+    def _add(self, name, ms):
+        self.totals[name] = self.totals.get(name, 0.0) + ms
+
+    def step(self):
+        self.steps += 1
+        if self.steps % self.report_steps:
+            return
+        for name, start, end in self._events:
+            end.synchronize()
+            self._add(name, start.elapsed_time(end))
+        self._events = []
+        logger.info('decoder head forward ms over %d steps: %s', self.report_steps, ', '.join(
+            '%s %.2f' % (name, total / self.report_steps) for name, total in self.totals.items()))
+        self.totals.clear()
+
+
 class CondenserForPretraining(nn.Module):
     def __init__(
         self,
@@ -49,118 +166,110 @@ class CondenserForPretraining(nn.Module):
         self.model_args = model_args
         self.train_args = train_args
         self.data_args = data_args
+        if model_args.batched_heads:
+            config = bert.config
+            assert getattr(config, 'position_embedding_type', 'absolute') == 'absolute' \
+                and not getattr(config, 'chunk_size_feed_forward', 0), \
+                '--batched_heads supports BertLayer heads with absolute positions and no feed-forward chunking'
+        self.head_timer = HeadTimer(model_args.head_timing_steps) if model_args.head_timing_steps > 0 else None
 
     def forward(self, model_input, labels):
-        lm_out: MaskedLMOutput = self.lm(
-            input_ids=model_input['input_ids'],
-            attention_mask=model_input['attention_mask'],
-            labels=labels,
-            output_hidden_states=True,
-            return_dict=True
-        )
-        cls_hiddens = lm_out.hidden_states[-1][:, :1]
-
-        # decoder with itself
-        skip_hiddens = self.lm.bert.embeddings(input_ids = model_input['decoder_input_ids']) #lm_out.hidden_states[self.model_args.skip_from]
-        hiddens = torch.cat([cls_hiddens, skip_hiddens[:, 1:]], dim=1)
-        attention_mask = self.lm.get_extended_attention_mask(
+        encoder_hiddens, encoder_loss = self.encoder_mlm(
+            model_input['input_ids'],
             model_input['attention_mask'],
-            model_input['attention_mask'].shape,
-            model_input['attention_mask'].device
+            labels
         )
-        for layer in self.c_head:
-            layer_out = layer(
-                hiddens,
-                attention_mask,
-            )
-            hiddens = layer_out[0]
-        loss = self.mlm_loss(hiddens, model_input['decoder_labels'])
-
-        # decoder with query
-        query_skip_hiddens = self.lm.bert.embeddings(input_ids = model_input['query_input_ids']) #lm_out.hidden_states[self.model_args.skip_from]
-        query_hiddens = torch.cat([cls_hiddens, query_skip_hiddens[:, 1:]], dim=1)
-        query_attention_mask = self.lm.get_extended_attention_mask(
-            model_input['query_attention_mask'],
-            model_input['query_attention_mask'].shape,
-            model_input['query_attention_mask'].device
-        )
-        for layer in self.query_head:
-            query_layer_out = layer(
-                query_hiddens,
-                query_attention_mask,
-            )
-            query_hiddens = query_layer_out[0]
-        query_loss = self.mlm_loss(query_hiddens, model_input['query_labels'])
-
-        # decoder with query
-        gpt_skip_hiddens = self.lm.bert.embeddings(input_ids = model_input['gpt_input_ids']) #lm_out.hidden_states[self.model_args.skip_from]
-        gpt_hiddens = torch.cat([cls_hiddens, gpt_skip_hiddens[:, 1:]], dim=1)
-        gpt_attention_mask = self.lm.get_extended_attention_mask(
-            model_input['gpt_attention_mask'],
-            model_input['gpt_attention_mask'].shape,
-            model_input['gpt_attention_mask'].device
-        )
-        for layer in self.gpt_head:
-            gpt_layer_out = layer(
-                gpt_hiddens,
-                gpt_attention_mask,
-            )
-            gpt_hiddens = gpt_layer_out[0]
-        gpt_loss = self.mlm_loss(gpt_hiddens, model_input['gpt_labels'])
+        cls_hiddens = encoder_hiddens[:, :1]
 
         # next encoder-decoder
-        next_encoder_lm_out: MaskedLMOutput = self.lm(
-            input_ids=model_input['next_encoder_input_ids'],
-            attention_mask=model_input['next_encoder_attention_mask'],
-            labels=model_input['next_encoder_labels'],
-            output_hidden_states=True,
-            return_dict=True
-        )
-        next_decoder_cls_hiddens = next_encoder_lm_out.hidden_states[-1][:, :1]
-
-        # decoder with itself
-        next_decoder_skip_hiddens = self.lm.bert.embeddings(input_ids=model_input['next_decoder_input_ids'])  # lm_out.hidden_states[self.model_args.skip_from]
-        next_decoder_hiddens = torch.cat([next_decoder_cls_hiddens, next_decoder_skip_hiddens[:, 1:]], dim=1)
-        next_decoder_attention_mask = self.lm.get_extended_attention_mask(
-            model_input['next_decoder_attention_mask'],
-            model_input['next_decoder_attention_mask'].shape,
-            model_input['next_decoder_attention_mask'].device
+        next_encoder_hiddens, next_encoder_loss = self.encoder_mlm(
+            model_input['next_encoder_input_ids'],
+            model_input['next_encoder_attention_mask'],
+            model_input['next_encoder_labels']
         )
-        for layer in self.next_head:
-            next_decoder_layer_out = layer(
-                next_decoder_hiddens,
-                next_decoder_attention_mask,
-            )
-            next_decoder_hiddens = next_decoder_layer_out[0]
-        next_loss = self.mlm_loss(next_decoder_hiddens, model_input['next_decoder_labels'])
+        next_decoder_cls_hiddens = next_encoder_hiddens[:, :1]
 
         # overlap encoder-decoder
-        overlap_encoder_lm_out: MaskedLMOutput = self.lm(
-            input_ids=model_input['overlap_encoder_input_ids'],
-            attention_mask=model_input['attention_mask'],
-            labels=model_input['overlap_encoder_labels'],
-            output_hidden_states=True,
-            return_dict=True
+        overlap_encoder_hiddens, overlap_encoder_loss = self.encoder_mlm(
+            model_input['overlap_encoder_input_ids'],
+            model_input['attention_mask'],
+            model_input['overlap_encoder_labels']
         )
-        overlap_decoder_cls_hiddens = overlap_encoder_lm_out.hidden_states[-1][:, :1]
-
-        # decoder with itself
-        overlap_decoder_skip_hiddens = self.lm.bert.embeddings(input_ids=model_input['overlap_decoder_input_ids'])  # lm_out.hidden_states[self.model_args.skip_from]
-        overlap_decoder_hiddens = torch.cat([overlap_decoder_cls_hiddens, overlap_decoder_skip_hiddens[:, 1:]], dim=1)
-        for layer in self.overlap_head:
-            overlap_decoder_layer_out = layer(
-                overlap_decoder_hiddens,
-                attention_mask,
-            )
-            overlap_decoder_hiddens = overlap_decoder_layer_out[0]
-        overlap_loss = self.mlm_loss(overlap_decoder_hiddens, model_input['overlap_decoder_labels'])
-
-        final_loss = loss + query_loss + gpt_loss + next_loss + overlap_loss + lm_out.loss + next_encoder_lm_out.loss + overlap_encoder_lm_out.loss
+        overlap_decoder_cls_hiddens = overlap_encoder_hiddens[:, :1]
+
+        # (head, cls hiddens, decoder input ids, attention mask, labels)
+        decoders = [
+            ('c_head', cls_hiddens, 'decoder_input_ids', 'attention_mask', 'decoder_labels'),
+            ('query_head', cls_hiddens, 'query_input_ids', 'query_attention_mask', 'query_labels'),
+            ('gpt_head', cls_hiddens, 'gpt_input_ids', 'gpt_attention_mask', 'gpt_labels'),
+            ('next_head', next_decoder_cls_hiddens, 'next_decoder_input_ids', 'next_decoder_attention_mask',
+             'next_decoder_labels'),
+            ('overlap_head', overlap_decoder_cls_hiddens, 'overlap_decoder_input_ids', 'attention_mask',
+             'overlap_decoder_labels'),
+        ]
+        loss, query_loss, gpt_loss, next_loss, overlap_loss = self.decoder_losses(model_input, decoders)
+
+        final_loss = loss + query_loss + gpt_loss + next_loss + overlap_loss + encoder_loss + next_encoder_loss + overlap_encoder_loss
+        if self.head_timer is not None:
+            self.head_timer.step()
 
         return final_loss
 
+    def decoder_losses(self, model_input, decoders):
+        """MLM loss of each decoder head, fed the cls hiddens and the embedded decoder input ids
+        (skipping their first token) under its extended attention mask.
+
+        The extended masks are built once per distinct mask. With --batched_heads the heads whose
+        decoder inputs have the same shape run as one group: a single embedding lookup over their
+        concatenated input ids, then `grouped_bert_layers` through all of their layers at once.
+        """
+        extended_masks = {}
+        for _, _, _, mask_key, _ in decoders:
+            if mask_key not in extended_masks:
+                mask = model_input[mask_key]
+                extended_masks[mask_key] = self.lm.get_extended_attention_mask(mask, mask.shape, mask.device)
+
+        groups = collections.OrderedDict()
+        for decoder in decoders:
+            _, _, input_key, _, _ = decoder
+            key = tuple(model_input[input_key].shape) if self.model_args.batched_heads else decoder[0]
+            groups.setdefault(key, []).append(decoder)
+
+        losses = {}
+        for group in groups.values():
+            names = [head for head, _, _, _, _ in group]
+            timing = self.head_timer.time('+'.join(names)) if self.head_timer is not None else nullcontext()
+            with timing:
+                input_ids = torch.cat([model_input[input_key] for _, _, input_key, _, _ in group])
+                skip_hiddens = self.lm.bert.embeddings(input_ids=input_ids)
+                cls_hiddens = torch.cat([cls for _, cls, _, _, _ in group])
+                hiddens = torch.cat([cls_hiddens, skip_hiddens[:, 1:]], dim=1)
+                attention_mask = torch.cat([extended_masks[mask_key] for _, _, _, mask_key, _ in group])
+                if len(group) == 1:
+                    for layer in getattr(self, names[0]):
+                        layer_out = layer(
+                            hiddens,
+                            attention_mask,
+                        )
+                        hiddens = layer_out[0]
+                else:
+                    hiddens = grouped_bert_layers([getattr(self, head) for head in names], hiddens, attention_mask)
+                for head_hiddens, (head, _, _, _, labels_key) in zip(hiddens.chunk(len(group)), group):
+                    losses[head] = self.mlm_loss(head_hiddens, model_input[labels_key])
+        return [losses[head] for head, _, _, _, _ in decoders]
+
+    def encoder_mlm(self, input_ids, attention_mask, labels):
+        # the MaskedLM loss of self.lm(..., labels=labels), without scoring the unlabelled positions
+        encoder_out = self.lm.bert(
+            input_ids=input_ids,
+            attention_mask=attention_mask,
+            return_dict=True
+        )
+        hiddens = encoder_out.last_hidden_state
+        return hiddens, self.mlm_loss(hiddens, labels)
 
     def mlm_loss(self, hiddens, labels):
+        hiddens, labels = select_labelled(hiddens, labels, self.cross_entropy.ignore_index)
         pred_scores = self.lm.cls(hiddens)
         masked_lm_loss = self.cross_entropy(
             pred_scores.view(-1, self.lm.config.vocab_size),
@@ -233,9 +342,11 @@ class ELECTRACondenserForPretraining(nn.Module):
         self.data_args = data_args
 
     def forward(self, model_input, labels):
-        lm_out_dis = self.dis(input_ids=model_input['input_ids'], attention_mask=model_input['attention_mask'], labels=labels,
-                              output_hidden_states=True, return_dict=True)
-        cls_hiddens = lm_out_dis.hidden_states[-1][:, :1]
+        # the MaskedLM loss of self.dis(..., labels=labels), scored on the labelled positions only
+        encoder_hiddens = self.dis.electra(input_ids=model_input['input_ids'], attention_mask=model_input['attention_mask'],
+                                           return_dict=True).last_hidden_state
+        encoder_loss = self.mlm_loss(encoder_hiddens, labels)
+        cls_hiddens = encoder_hiddens[:, :1]
         skip_hiddens = self.dis.electra.embeddings(input_ids = model_input['decoder_input_ids']) #lm_out.hidden_states[self.model_args.skip_from]
         hiddens = torch.cat([cls_hiddens, skip_hiddens[:, 1:]], dim=1)
         attention_mask = self.dis.get_extended_attention_mask(
@@ -281,7 +392,7 @@ class ELECTRACondenserForPretraining(nn.Module):
             overlap_hiddens = overlap_layer_out[0]
         overlap_loss = self.mlm_loss(overlap_hiddens, model_input['overlap_labels'])
 
-        loss = next_loss + overlap_loss + loss + lm_out_dis.loss
+        loss = next_loss + overlap_loss + loss + encoder_loss
 
         return loss
 
@@ -316,6 +427,7 @@ class ELECTRACondenserForPretraining(nn.Module):
         return loss
 
     def mlm_loss(self, hiddens, labels):
+        hiddens, labels = select_labelled(hiddens, labels, self.cross_entropy.ignore_index)
         prediction_scores = self.dis.generator_predictions(hiddens)
         prediction_scores = self.dis.generator_lm_head(prediction_scores)
 
@@ -375,6 +487,7 @@ class RobertaCondenserForPretraining(CondenserForPretraining):
         self.data_args = data_args
 
     def mlm_loss(self, hiddens, labels):
+        hiddens, labels = select_labelled(hiddens, labels, self.cross_entropy.ignore_index)
         pred_scores = self.lm.lm_head(hiddens)
         masked_lm_loss = self.cross_entropy(
             pred_scores.view(-1, self.lm.config.vocab_size),
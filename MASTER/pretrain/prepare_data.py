@@ -0,0 +1,94 @@
+import argparse
+import logging
+import os
+from datasets import load_dataset, Features, Sequence, Value
+from transformers import AutoTokenizer
+
+from data import QUERY_SEP_ID
+from keyword_weights import KeywordWeights
+from masking import WholeWordMasker
+
+logger = logging.getLogger(__name__)
+
+
+def prepare_batch(batch, masker, keyword_weights=None):
+    """The collator inputs of a batch of json examples: the text with its word spans (and keyword
+    weights), the queries joined as the collator joins them with the start of each, and the gpt
+    text `next[0]`"""
+    query_ids, query_starts = [], []
+    for queries in batch['queries']:
+        ids, starts = [], []
+        for query in queries:
+            starts.append(len(ids))
+            ids.extend(query + [QUERY_SEP_ID])
+        query_ids.append(ids)
+        query_starts.append(starts)
+
+    segments = masker.segment(batch['text'])
+    prepared = {
+        'text': batch['text'],
+        'query_ids': query_ids,
+        'query_starts': query_starts,
+        'gpt_ids': [next_texts[0] if next_texts else [] for next_texts in batch['next']],
+        'word_starts': [segments.word_starts[row, :n].tolist() for row, n in enumerate(segments.num_words)],
+        'word_lengths': [segments.word_lengths[row, :n].tolist() for row, n in enumerate(segments.num_words)],
+    }
+    if keyword_weights is not None:
+        weights = keyword_weights.lookup(segments)
+        prepared['word_weights'] = [weights[row, :n].tolist() for row, n in enumerate(segments.num_words)]
+    return prepared
+
+
+def main():
+    """Convert the json lines pretraining data into an Arrow dataset for --train_arrow_dir.
+
+    The token ids, the word spans of the text, the joined queries and the gpt text are stored as
+    Arrow columns once; run_pre_training.py memory-maps them with `load_from_disk` instead of
+    parsing the json at startup, and the collator reads the prepared fields instead of rebuilding
+    them per example.
+    """
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--tokenizer", type=str, default="bert-base-uncased")
+    parser.add_argument("--train_dir", type=str, required=True, help="dir of the json lines data")
+    parser.add_argument("--output_dir", type=str, required=True)
+    parser.add_argument("--keyword_weights", type=str, default=None,
+                        help=".npz of keyword_weights.py, stores the keyword weight of every word")
+    parser.add_argument("--preprocessing_num_workers", type=int, default=None)
+    parser.add_argument("--batch_size", type=int, default=1000, help="examples per map batch")
+    args = parser.parse_args()
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s", level=logging.INFO)
+
+    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer, use_fast=False)
+    masker = WholeWordMasker(tokenizer)
+    keyword_weights = KeywordWeights.load(args.keyword_weights) if args.keyword_weights else None
+
+    train_path = [os.path.join(args.train_dir, f) for f in sorted(os.listdir(args.train_dir))
+                  if f.endswith('tsv') or f.endswith('json')]
+    raw_set = load_dataset('json', data_files=train_path, block_size=2**25)['train']
+
+    columns = {
+        'text': Sequence(Value('int32')),
+        'query_ids': Sequence(Value('int32')),
+        'query_starts': Sequence(Value('int32')),
+        'gpt_ids': Sequence(Value('int32')),
+        'word_starts': Sequence(Value('int32')),
+        'word_lengths': Sequence(Value('int32')),
+    }
+    if keyword_weights is not None:
+        columns['word_weights'] = Sequence(Value('float32'))
+    train_set = raw_set.map(
+        prepare_batch,
+        fn_kwargs={'masker': masker, 'keyword_weights': keyword_weights},
+        batched=True,
+        batch_size=args.batch_size,
+        num_proc=args.preprocessing_num_workers,
+        remove_columns=raw_set.column_names,
+        features=Features(columns),
+    )
+    train_set.save_to_disk(args.output_dir)
+    logger.info("%d examples with columns %s saved to %s", len(train_set), ", ".join(train_set.column_names),
+                args.output_dir)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,11 +3,12 @@ import logging
 import math
 import os
 import sys
-from datasets import load_dataset
+from datasets import load_dataset, load_from_disk
 import json
 from arguments import DataTrainingArguments, ModelArguments, \
     CondenserPreTrainingArguments as TrainingArguments
 from data import CondenserCollator
+from keyword_weights import KeywordWeights
 from modeling import CondenserForPretraining, RobertaCondenserForPretraining, ELECTRACondenserForPretraining
 from trainer import CondenserPreTrainer as Trainer
 import transformers
@@ -77,11 +78,15 @@ def main():
     # Set seed before initializing model.
     set_seed(training_args.seed)
 
-    train_set = load_dataset(
-        'json',
-        data_files=data_args.train_path,
-        block_size=2**25,
-    )['train']
+    if data_args.train_arrow_dir is not None:
+        # memory-mapped, the collator inputs were prepared by prepare_data.py
+        train_set = load_from_disk(data_args.train_arrow_dir)
+    else:
+        train_set = load_dataset(
+            'json',
+            data_files=data_args.train_path,
+            block_size=2**25,
+        )['train']
     dev_set = load_dataset(
         'json',
         data_files=data_args.validation_file,
@@ -131,17 +136,22 @@ def main():
 
     # Data collator
     # This one will take care of randomly masking the tokens.
-    if data_args.frequency_dict:
+    frequency_dict = None
+    keyword_weights = None
+    if data_args.keyword_weights:
+        logger.info("Load Keyword Weights from %s", data_args.keyword_weights)
+        keyword_weights = KeywordWeights.load(data_args.keyword_weights)
+    elif data_args.frequency_dict:
         logger.info("Load Frequency Dictionary from %s", data_args.frequency_dict)
         frequency_dict = json.load(open(data_args.frequency_dict))
-    else:
-        frequency_dict = None
     data_collator = CondenserCollator(
         tokenizer=tokenizer,
         mlm_probability=data_args.mlm_probability,
         decoder_mlm_probability=data_args.decoder_mlm_probability,
         max_seq_length=data_args.max_seq_length,
-        frequency_dict=frequency_dict
+        frequency_dict=frequency_dict,
+        keyword_weights=keyword_weights,
+        vectorized_masking=data_args.vectorized_masking
     )
     # Initialize our Trainer
     trainer = Trainer(
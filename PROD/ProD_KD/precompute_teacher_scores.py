@@ -0,0 +1,154 @@
+import sys
+
+sys.path += ['../']
+import logging
+import os
+import numpy as np
+import torch
+import torch.distributed as dist
+from tqdm import tqdm
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.dirname(os.getcwd())))
+import run_progressive_distill_marco as distill
+from transformers import BertTokenizer
+from utils.util import is_first_worker
+from utils.marco_until import Rocketqa_v2Dataset, MarcoDoc_Dataset
+from utils.teacher_scores import write_candidates, write_meta, score_path
+
+logger = logging.getLogger(__name__)
+
+DATASETS = {'marco': Rocketqa_v2Dataset, 'marcodoc': MarcoDoc_Dataset}
+
+
+def get_arguments():
+    """run_progressive_distill_marco.py arguments, the scores are written to --teacher_scores_path"""
+    parser = distill.get_parser()
+    parser.add_argument("--dataset", type=str, default="marco", choices=sorted(DATASETS),
+                        help="marco for run_progressive_distill_marco.py, marcodoc for run_progressive_distill_marcodoc.py")
+    parser.add_argument("--score_batch_size", type=int, default=256, help="sequences per teacher forward")
+    args = parser.parse_args()
+    assert args.teacher_scores_path is not None, "--teacher_scores_path is the output directory"
+    assert args.teacher_type in ["dual_encoder", "cross_encoder"], "ColBERT teachers can not be precomputed"
+    assert args.double_teacher is None or args.double_teacher_type in ["dual_encoder", "cross_encoder"], \
+        "ColBERT teachers can not be precomputed"
+    return args
+
+
+def pad(token_ids, length):
+    return torch.LongTensor([ids + [0] * (length - len(ids)) for ids in token_ids])
+
+
+def batched(items, batch_size):
+    for start in range(0, len(items), batch_size):
+        yield items[start:start + batch_size]
+
+
+def open_scores(args, role, kind, shape):
+    """[shape] float32 memmap shared by the ranks, created by the first one"""
+    path = score_path(args.teacher_scores_path, role, kind)
+    if is_first_worker():
+        np.lib.format.open_memmap(path, mode='w+', dtype=np.float32, shape=shape).flush()
+    if args.local_rank != -1:
+        dist.barrier()
+    return np.load(path, mmap_mode='r+')
+
+
+def score_cross_encoder(args, model, role, dataset, offsets, pids):
+    """relevance logit of every (example, candidate) pair, examples `rank::world_size` on this rank"""
+    logits = open_scores(args, role, 'logits', (len(pids),))
+    pairs = [(example_id, row) for example_id in range(args.rank, len(dataset.data), args.world_size)
+             for row in range(offsets[example_id], offsets[example_id + 1])]
+    for batch in tqdm(list(batched(pairs, args.score_batch_size)), desc=role, disable=not is_first_worker()):
+        rows, input_ids = [], []
+        for example_id in sorted(set(example_id for example_id, _ in batch)):
+            example_rows = [row for i, row in batch if i == example_id]
+            _, _, c_e_token_ids = dataset.encode(dataset.data[example_id]['query_string'], pids[example_rows])
+            rows.extend(example_rows)
+            input_ids.append(c_e_token_ids)
+        input_ids = torch.cat(input_ids).unsqueeze(0).to(args.device)
+        _, relevance_logits, _ = model(input_ids=input_ids, attention_mask=(input_ids != 0).long())
+        logits[rows] = relevance_logits.view(-1).float().cpu().numpy()
+    logits.flush()
+
+
+def score_dual_encoder(args, model, role, dataset, passage_ids):
+    """CLS vectors of every example's query and of every candidate passage"""
+    probe = pad([dataset.query_token_ids('')], dataset.max_q_length).to(args.device)
+    dim = model.query_emb(probe, (probe != 0).long()).size(-1)
+    queries = open_scores(args, role, 'queries', (len(dataset.data), dim))
+    passages = open_scores(args, role, 'passages', (len(passage_ids), dim))
+    example_ids = list(range(args.rank, len(dataset.data), args.world_size))
+    for batch in tqdm(list(batched(example_ids, args.score_batch_size)), desc=role + ' queries',
+                      disable=not is_first_worker()):
+        input_ids = pad([dataset.query_token_ids(dataset.data[i]['query_string']) for i in batch],
+                        dataset.max_q_length).to(args.device)
+        queries[batch] = model.query_emb(input_ids, (input_ids != 0).long()).float().cpu().numpy()
+    rows = list(range(args.rank, len(passage_ids), args.world_size))
+    for batch in tqdm(list(batched(rows, args.score_batch_size)), desc=role + ' passages',
+                      disable=not is_first_worker()):
+        input_ids = pad(dataset.passage_token_ids(passage_ids[batch]), dataset.max_seq_length).to(args.device)
+        passages[batch] = model.body_emb(input_ids, (input_ids != 0).long()).float().cpu().numpy()
+    queries.flush()
+    passages.flush()
+    return dim
+
+
+def main():
+    """Score the training examples of run_progressive_distill_marco(doc).py with its frozen teachers.
+
+    The outputs are what `train` would compute on every batch: the cross-encoder logits of all
+    (query, candidate) pairs, or the query and passage vectors of a dual-encoder teacher, for the
+    teacher, the double teacher and with --open_LwF the initial student. Training with the same
+    flags plus --teacher_scores_path then reads them instead of loading these models.
+    """
+    args = get_arguments()
+    distill.set_env(args)
+    args.world_size, args.rank = 1, 0
+    if args.local_rank != -1:
+        args.world_size = dist.get_world_size()
+        args.rank = dist.get_rank()
+
+    tokenizer = BertTokenizer.from_pretrained("bert-base-uncased", do_lower_case=True)
+    dataset = DATASETS[args.dataset](args.origin_data_dir, tokenizer, num_hard_negatives=args.number_neg,
+                                     max_seq_length=args.max_seq_length, corpus_path=args.corpus_path,
+                                     is_training=False)
+    if is_first_worker():
+        write_candidates(args.teacher_scores_path, dataset.data)
+    if args.local_rank != -1:
+        dist.barrier()
+    offsets = np.load(os.path.join(args.teacher_scores_path, 'candidates.offsets.npy'))
+    pids = np.load(os.path.join(args.teacher_scores_path, 'candidates.pids.npy'))
+    passage_ids = np.load(os.path.join(args.teacher_scores_path, 'passages.ids.npy'))
+    logger.info("%d examples, %d candidate pairs, %d passages", len(dataset.data), len(pids), len(passage_ids))
+
+    roles = [('teacher', args.teacher_type, distill.load_teacher_model)]
+    if args.double_teacher is not None:
+        roles.append(('double_teacher', args.double_teacher_type, distill.load_double_teacher_model))
+    if args.open_LwF:
+        roles.append(('student_copy', 'dual_encoder', lambda args: distill.load_model(args)[1]))
+    meta = {'dataset': args.dataset, 'origin_data_dir': args.origin_data_dir, 'num_examples': len(dataset.data),
+            'max_seq_length': args.max_seq_length, 'roles': {}, 'dims': {}}
+    for role, teacher_type, load in roles:
+        # one model on the GPU at a time
+        model = load(args)
+        model.eval()
+        with torch.no_grad():
+            if teacher_type == 'cross_encoder':
+                score_cross_encoder(args, model, role, dataset, offsets, pids)
+            else:
+                meta['dims'][role] = score_dual_encoder(args, model, role, dataset, passage_ids)
+        meta['roles'][role] = teacher_type
+        del model
+        torch.cuda.empty_cache()
+
+    if args.local_rank != -1:
+        dist.barrier()
+    # written last, a directory without it is an unfinished run
+    if is_first_worker():
+        write_meta(args.teacher_scores_path, meta)
+        logger.info("teacher scores of %s written to %s", ", ".join(meta['roles']), args.teacher_scores_path)
+
+
+if __name__ == "__main__":
+    main()
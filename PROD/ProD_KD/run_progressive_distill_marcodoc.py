@@ -48,14 +48,15 @@ from utils.dpr_utils import (
     load_states_from_checkpoint,
     get_model_obj,
     CheckpointState,
-    get_optimizer,
-    all_gather_list
+    get_optimizer
 )
+from utils.distributed_gather import all_gather_tensors, offset_positive_idxs, pad_rows
 import collections
 from torch.nn.utils.rnn import pad_sequence
 from utils.marco_until import (
     MarcoDoc_Dataset
 )
+from utils.teacher_scores import TeacherScores, PrecomputedTeacher
 
 retrieverBatch = collections.namedtuple(
     "BiENcoderInput",
@@ -81,9 +82,14 @@ def train(args, double_teacher, teacher_model, model, tokenizer):
     args.train_batch_size = args.per_gpu_train_batch_size * max(1, args.n_gpu)  # nll loss for query
     optimizer = get_optimizer(args, model, lr=args.learning_rate, weight_decay=args.weight_decay)
 
+    # --teacher_scores_path: the teachers are read from a score file instead of being run
+    teacher_scores = teacher_model.scores if isinstance(teacher_model, PrecomputedTeacher) else None
     if args.open_LwF:
-        logger.info("***** copy student model to Stable Distillation *****")
-        student_copy = copy.deepcopy(model)
+        if teacher_scores is not None:
+            student_copy = PrecomputedTeacher(teacher_scores, 'student_copy', args.device)
+        else:
+            logger.info("***** copy student model to Stable Distillation *****")
+            student_copy = copy.deepcopy(model)
 
     if args.fp16:
         try:
@@ -101,17 +107,18 @@ def train(args, double_teacher, teacher_model, model, tokenizer):
         model = torch.nn.parallel.DistributedDataParallel(
             model, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
         )
-        teacher_model = torch.nn.parallel.DistributedDataParallel(
-            teacher_model, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
-        )
-        if double_teacher is not None:
-            double_teacher = torch.nn.parallel.DistributedDataParallel(
-                double_teacher, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
-            )
-        if args.open_LwF:
-            student_copy = torch.nn.parallel.DistributedDataParallel(
-                student_copy, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
+        if teacher_scores is None:
+            teacher_model = torch.nn.parallel.DistributedDataParallel(
+                teacher_model, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
             )
+            if double_teacher is not None:
+                double_teacher = torch.nn.parallel.DistributedDataParallel(
+                    double_teacher, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
+                )
+            if args.open_LwF:
+                student_copy = torch.nn.parallel.DistributedDataParallel(
+                    student_copy, device_ids=[args.rank], output_device=args.rank, find_unused_parameters=False,
+                )
     
     # Train!
     logger.info("***** Running training *****")
@@ -159,6 +166,9 @@ def train(args, double_teacher, teacher_model, model, tokenizer):
     else:
         logger.info("no such type of neg type...")
         exit(0)
+    if teacher_scores is not None and teacher_scores.num_examples != len(train_dataset):
+        raise ValueError("%s scores %d training examples, %s has %d" % (
+            args.teacher_scores_path, teacher_scores.num_examples, args.origin_data_dir, len(train_dataset)))
     train_sample = RandomSampler(train_dataset) if args.local_rank == -1 else DistributedSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sample,
                                   collate_fn=MarcoDoc_Dataset.get_collate_fn(args),
@@ -199,6 +209,8 @@ def train(args, double_teacher, teacher_model, model, tokenizer):
 
             batch_reranker = tuple(t.to(args.device) for t in batch['reranker'])
             inputs_reranker = {"input_ids": batch_reranker[0].long(), "attention_mask": batch_reranker[1].long()}
+            if teacher_scores is not None:
+                teacher_scores.select(*batch['pair_ids'])
 
             model.train()
 
@@ -380,64 +392,14 @@ large dual encoder -> small dual encoder
 '''
 def caculate_cont_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_vector, local_teacher_ctx_vectors, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_vector_to_send = (
-            torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-        )
-        ctx_vector_to_send = (
-            torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-        )
-
-        teacher_q_vector_to_send = (
-            torch.empty_like(local_teacher_q_vector).cpu().copy_(local_teacher_q_vector).detach_()
-        )
-        teacher_ctx_vector_to_send = (
-            torch.empty_like(local_teacher_ctx_vectors).cpu().copy_(local_teacher_ctx_vectors).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_vector_to_send,
-                ctx_vector_to_send,
-                teacher_q_vector_to_send,
-                teacher_ctx_vector_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_vector = []
-        global_ctxs_vector = []
-        global_teacher_q_vector = []
-        global_teacher_ctxs_vector = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_vector, ctx_vectors, teacher_q_vector, teacher_ctxs_vector, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_vector.append(q_vector.to(local_q_vector.device))
-                global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-                global_teacher_q_vector.append(teacher_q_vector.to(local_q_vector.device))
-                global_teacher_ctxs_vector.append(teacher_ctxs_vector.to(local_q_vector.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_vector.append(local_q_vector)
-                global_ctxs_vector.append(local_ctx_vectors)
-                global_teacher_q_vector.append(local_teacher_q_vector)
-                global_teacher_ctxs_vector.append(local_teacher_ctx_vectors)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_vectors.size(0)
-        global_q_vector = torch.cat(global_q_vector, dim=0)
-        global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
-        global_teacher_q_vector = torch.cat(global_teacher_q_vector, dim=0)
-        global_teacher_ctxs_vector = torch.cat(global_teacher_ctxs_vector, dim=0)
+        q_vectors, ctx_vectors, teacher_q_vectors, teacher_ctx_vectors, positive_idxs = all_gather_tensors(
+            [local_q_vector, local_ctx_vectors, local_teacher_q_vector, local_teacher_ctx_vectors,
+             torch.tensor(local_positive_idxs, device=local_q_vector.device)])
+        global_q_vector = torch.cat(q_vectors, dim=0)
+        global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
+        global_teacher_q_vector = torch.cat(teacher_q_vectors, dim=0)
+        global_teacher_ctxs_vector = torch.cat(teacher_ctx_vectors, dim=0)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_vectors)
     else:
         global_q_vector = local_q_vector
         global_ctxs_vector = local_ctx_vectors
@@ -458,73 +420,16 @@ def caculate_cont_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_
 
 def caculate_Col_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_hidden, local_teacher_ctx_hidden, local_teacher_ctx_mask, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_vector_to_send = (
-            torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-        )
-        ctx_vector_to_send = (
-            torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-        )
-        teacher_q_hidden_to_send = (
-            torch.empty_like(local_teacher_q_hidden).cpu().copy_(local_teacher_q_hidden).detach_()
-        )
-        teacher_ctx_hidden_to_send = (
-            torch.empty_like(local_teacher_ctx_hidden).cpu().copy_(local_teacher_ctx_hidden).detach_()
-        )
-        teacher_ctx_mask_to_send = (
-            torch.empty_like(local_teacher_ctx_mask).cpu().copy_(local_teacher_ctx_mask).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_vector_to_send,
-                ctx_vector_to_send,
-                teacher_q_hidden_to_send,
-                teacher_ctx_hidden_to_send,
-                teacher_ctx_mask_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_vector = []
-        global_ctxs_vector = []
-        global_teacher_q_hidden = []
-        global_teacher_ctx_hidden = []
-        global_teacher_ctx_mask = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_vector, ctx_vectors, teacher_q_hidden, teacher_ctx_hidden, teacher_ctx_mask, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_vector.append(q_vector.to(local_q_vector.device))
-                global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-                global_teacher_q_hidden.extend(teacher_q_hidden.to(local_q_vector.device))
-                global_teacher_ctx_hidden.extend(teacher_ctx_hidden.to(local_q_vector.device))
-                global_teacher_ctx_mask.extend(teacher_ctx_mask.to(local_q_vector.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_vector.append(local_q_vector)
-                global_ctxs_vector.append(local_ctx_vectors)
-                global_teacher_q_hidden.extend(local_teacher_q_hidden)
-                global_teacher_ctx_hidden.extend(local_teacher_ctx_hidden)
-                global_teacher_ctx_mask.extend(local_teacher_ctx_mask)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_vectors.size(0)
-        global_q_vector = torch.cat(global_q_vector, dim=0)
-        global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
-        global_teacher_q_hidden = pad_sequence(global_teacher_q_hidden, batch_first=True)
-        global_teacher_ctx_hidden = pad_sequence(global_teacher_ctx_hidden, batch_first=True)
-        global_teacher_ctx_mask = pad_sequence(global_teacher_ctx_mask, batch_first=True)
-        # global_teacher_q_hidden= torch.cat(global_teacher_q_hidden, dim=0)
-        # global_teacher_ctx_hidden = torch.cat(global_teacher_ctx_hidden, dim=0)
+        q_vectors, ctx_vectors, teacher_q_hidden, teacher_ctx_hidden, teacher_ctx_mask, positive_idxs = \
+            all_gather_tensors([local_q_vector, local_ctx_vectors, local_teacher_q_hidden, local_teacher_ctx_hidden,
+                                local_teacher_ctx_mask,
+                                torch.tensor(local_positive_idxs, device=local_q_vector.device)])
+        global_q_vector = torch.cat(q_vectors, dim=0)
+        global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
+        global_teacher_q_hidden = pad_rows(teacher_q_hidden)
+        global_teacher_ctx_hidden = pad_rows(teacher_ctx_hidden)
+        global_teacher_ctx_mask = pad_rows(teacher_ctx_mask)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_vectors)
     else:
         global_q_vector = local_q_vector
         global_ctxs_vector = local_ctx_vectors
@@ -547,48 +452,11 @@ def caculate_Col_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_h
 
 def caculate_Col_NLLloss(args, local_q_hidden, local_ctx_hidden, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_hidden_to_send = (
-            torch.empty_like(local_q_hidden).cpu().copy_(local_q_hidden).detach_()
-        )
-        ctx_hidden_to_send = (
-            torch.empty_like(local_ctx_hidden).cpu().copy_(local_ctx_hidden).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_hidden_to_send,
-                ctx_hidden_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_hidden = []
-        global_ctx_hidden = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_hidden, ctx_hidden, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_hidden.extend(q_hidden.to(local_q_hidden.device))
-                global_ctx_hidden.extend(ctx_hidden.to(local_q_hidden.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_hidden.extend(local_q_hidden)
-                global_ctx_hidden.extend(local_ctx_hidden)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_hidden.size(0)
-
-        global_q_hidden = pad_sequence(global_q_hidden, batch_first=True)
-        global_ctx_hidden = pad_sequence(global_ctx_hidden, batch_first=True)
+        q_hidden, ctx_hidden, positive_idxs = all_gather_tensors(
+            [local_q_hidden, local_ctx_hidden, torch.tensor(local_positive_idxs, device=local_q_hidden.device)])
+        global_q_hidden = pad_rows(q_hidden)
+        global_ctx_hidden = pad_rows(ctx_hidden)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_hidden)
     else:
         global_q_hidden = local_q_hidden
         global_ctx_hidden = local_ctx_hidden
@@ -671,28 +539,9 @@ def do_biencoder_fwd_pass_eval(args, model, batch):
 
     local_q_vector, local_ctx_vectors = model(**inputs)
 
-    q_vector_to_send = torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-    ctx_vector_to_send = torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-
-    global_question_ctx_vectors = all_gather_list(
-        [q_vector_to_send, ctx_vector_to_send],
-        max_size=640000000)
-
-    global_q_vector = []
-    global_ctxs_vector = []
-
-    for i, item in enumerate(global_question_ctx_vectors):
-        q_vector, ctx_vectors = item
-
-        if i != args.rank:
-            global_q_vector.append(q_vector.to(local_q_vector.device))
-            global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-        else:
-            global_q_vector.append(local_q_vector)
-            global_ctxs_vector.append(local_ctx_vectors)
-
-    global_q_vector = torch.cat(global_q_vector, dim=0)
-    global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
+    q_vectors, ctx_vectors = all_gather_tensors([local_q_vector, local_ctx_vectors])
+    global_q_vector = torch.cat(q_vectors, dim=0)
+    global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
 
     scores = torch.matmul(global_q_vector, torch.transpose(global_ctxs_vector, 0, 1))
     if len(global_q_vector.size()) > 1:
@@ -761,7 +610,7 @@ def _load_saved_state(model, optimizer, scheduler, saved_state: CheckpointState)
     return step
 
 
-def get_arguments():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Required parameters
@@ -1040,7 +889,18 @@ def get_arguments():
     parser.add_argument("--double_teacher_type", type=str, default=None, help="double teacher training")
     parser.add_argument("--double_teacher_num_hidden_layers", type=int, default=12, help="double teacher training")
 
-    args = parser.parse_args()
+    #-----------------offline teacher setting-----------------------
+    parser.add_argument("--teacher_scores_path", type=str, default=None,
+                        help="teacher outputs written by precompute_teacher_scores.py, read instead of loading and "
+                             "running the teachers")
+    return parser
+
+
+def get_arguments():
+    args = get_parser().parse_args()
+    if args.teacher_scores_path is not None:
+        assert args.teacher_type in ["dual_encoder", "cross_encoder"] and not args.teacher_step \
+            and not args.ts_share_weight, "--teacher_scores_path needs frozen dual_encoder / cross_encoder teachers"
     return args
 
 
@@ -1190,17 +1050,36 @@ def load_double_teacher_model(args):
     return model
 
 
+def load_teacher_scores(args):
+    """`PrecomputedTeacher` stand-ins for the teacher and double teacher, nothing is put on the GPU"""
+    scores = TeacherScores(args.teacher_scores_path)
+    roles = scores.roles()
+    if roles.get('teacher') != args.teacher_type:
+        raise ValueError("%s has no %s teacher" % (args.teacher_scores_path, args.teacher_type))
+    if args.double_teacher is not None and roles.get('double_teacher') != args.double_teacher_type:
+        raise ValueError("%s has no %s double teacher" % (args.teacher_scores_path, args.double_teacher_type))
+    if args.open_LwF and 'student_copy' not in roles:
+        raise ValueError("%s has no student_copy vectors for --open_LwF" % args.teacher_scores_path)
+    logger.info("read teacher outputs of %s from %s", ", ".join(sorted(roles)), args.teacher_scores_path)
+    teacher_model = PrecomputedTeacher(scores, 'teacher', args.device)
+    double_teacher = PrecomputedTeacher(scores, 'double_teacher', args.device) if args.double_teacher is not None else None
+    return teacher_model, double_teacher
+
+
 def main():
     args = get_arguments()
     set_env(args)
     logger.info("training using KD tpye : " + args.KD_type)
     tokenizer, model = load_model(args)
-    teacher_model = load_teacher_model(args)
-
-    if args.double_teacher != None:
-        double_teacher = load_double_teacher_model(args)
+    if args.teacher_scores_path is not None:
+        teacher_model, double_teacher = load_teacher_scores(args)
     else:
-        double_teacher = None
+        teacher_model = load_teacher_model(args)
+
+        if args.double_teacher != None:
+            double_teacher = load_double_teacher_model(args)
+        else:
+            double_teacher = None
 
     basic_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
     formatter = logging.Formatter(basic_format)
@@ -48,9 +48,9 @@ from utils.dpr_utils import (
     load_states_from_checkpoint,
     get_model_obj,
     CheckpointState,
-    get_optimizer,
-    all_gather_list
+    get_optimizer
 )
+from utils.distributed_gather import all_gather_tensors, offset_positive_idxs, pad_rows
 import collections
 from torch.nn.utils.rnn import pad_sequence
 from utils.marco_until import (
@@ -394,64 +394,14 @@ large dual encoder -> small dual encoder
 '''
 def caculate_cont_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_vector, local_teacher_ctx_vectors, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_vector_to_send = (
-            torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-        )
-        ctx_vector_to_send = (
-            torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-        )
-
-        teacher_q_vector_to_send = (
-            torch.empty_like(local_teacher_q_vector).cpu().copy_(local_teacher_q_vector).detach_()
-        )
-        teacher_ctx_vector_to_send = (
-            torch.empty_like(local_teacher_ctx_vectors).cpu().copy_(local_teacher_ctx_vectors).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_vector_to_send,
-                ctx_vector_to_send,
-                teacher_q_vector_to_send,
-                teacher_ctx_vector_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_vector = []
-        global_ctxs_vector = []
-        global_teacher_q_vector = []
-        global_teacher_ctxs_vector = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_vector, ctx_vectors, teacher_q_vector, teacher_ctxs_vector, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_vector.append(q_vector.to(local_q_vector.device))
-                global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-                global_teacher_q_vector.append(teacher_q_vector.to(local_q_vector.device))
-                global_teacher_ctxs_vector.append(teacher_ctxs_vector.to(local_q_vector.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_vector.append(local_q_vector)
-                global_ctxs_vector.append(local_ctx_vectors)
-                global_teacher_q_vector.append(local_teacher_q_vector)
-                global_teacher_ctxs_vector.append(local_teacher_ctx_vectors)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_vectors.size(0)
-        global_q_vector = torch.cat(global_q_vector, dim=0)
-        global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
-        global_teacher_q_vector = torch.cat(global_teacher_q_vector, dim=0)
-        global_teacher_ctxs_vector = torch.cat(global_teacher_ctxs_vector, dim=0)
+        q_vectors, ctx_vectors, teacher_q_vectors, teacher_ctx_vectors, positive_idxs = all_gather_tensors(
+            [local_q_vector, local_ctx_vectors, local_teacher_q_vector, local_teacher_ctx_vectors,
+             torch.tensor(local_positive_idxs, device=local_q_vector.device)])
+        global_q_vector = torch.cat(q_vectors, dim=0)
+        global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
+        global_teacher_q_vector = torch.cat(teacher_q_vectors, dim=0)
+        global_teacher_ctxs_vector = torch.cat(teacher_ctx_vectors, dim=0)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_vectors)
     else:
         global_q_vector = local_q_vector
         global_ctxs_vector = local_ctx_vectors
@@ -472,73 +422,16 @@ def caculate_cont_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_
 
 def caculate_Col_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_hidden, local_teacher_ctx_hidden, local_teacher_ctx_mask, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_vector_to_send = (
-            torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-        )
-        ctx_vector_to_send = (
-            torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-        )
-        teacher_q_hidden_to_send = (
-            torch.empty_like(local_teacher_q_hidden).cpu().copy_(local_teacher_q_hidden).detach_()
-        )
-        teacher_ctx_hidden_to_send = (
-            torch.empty_like(local_teacher_ctx_hidden).cpu().copy_(local_teacher_ctx_hidden).detach_()
-        )
-        teacher_ctx_mask_to_send = (
-            torch.empty_like(local_teacher_ctx_mask).cpu().copy_(local_teacher_ctx_mask).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_vector_to_send,
-                ctx_vector_to_send,
-                teacher_q_hidden_to_send,
-                teacher_ctx_hidden_to_send,
-                teacher_ctx_mask_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_vector = []
-        global_ctxs_vector = []
-        global_teacher_q_hidden = []
-        global_teacher_ctx_hidden = []
-        global_teacher_ctx_mask = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_vector, ctx_vectors, teacher_q_hidden, teacher_ctx_hidden, teacher_ctx_mask, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_vector.append(q_vector.to(local_q_vector.device))
-                global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-                global_teacher_q_hidden.extend(teacher_q_hidden.to(local_q_vector.device))
-                global_teacher_ctx_hidden.extend(teacher_ctx_hidden.to(local_q_vector.device))
-                global_teacher_ctx_mask.extend(teacher_ctx_mask.to(local_q_vector.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_vector.append(local_q_vector)
-                global_ctxs_vector.append(local_ctx_vectors)
-                global_teacher_q_hidden.extend(local_teacher_q_hidden)
-                global_teacher_ctx_hidden.extend(local_teacher_ctx_hidden)
-                global_teacher_ctx_mask.extend(local_teacher_ctx_mask)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_vectors.size(0)
-        global_q_vector = torch.cat(global_q_vector, dim=0)
-        global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
-        global_teacher_q_hidden = pad_sequence(global_teacher_q_hidden, batch_first=True)
-        global_teacher_ctx_hidden = pad_sequence(global_teacher_ctx_hidden, batch_first=True)
-        global_teacher_ctx_mask = pad_sequence(global_teacher_ctx_mask, batch_first=True)
-        # global_teacher_q_hidden= torch.cat(global_teacher_q_hidden, dim=0)
-        # global_teacher_ctx_hidden = torch.cat(global_teacher_ctx_hidden, dim=0)
+        q_vectors, ctx_vectors, teacher_q_hidden, teacher_ctx_hidden, teacher_ctx_mask, positive_idxs = \
+            all_gather_tensors([local_q_vector, local_ctx_vectors, local_teacher_q_hidden, local_teacher_ctx_hidden,
+                                local_teacher_ctx_mask,
+                                torch.tensor(local_positive_idxs, device=local_q_vector.device)])
+        global_q_vector = torch.cat(q_vectors, dim=0)
+        global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
+        global_teacher_q_hidden = pad_rows(teacher_q_hidden)
+        global_teacher_ctx_hidden = pad_rows(teacher_ctx_hidden)
+        global_teacher_ctx_mask = pad_rows(teacher_ctx_mask)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_vectors)
     else:
         global_q_vector = local_q_vector
         global_ctxs_vector = local_ctx_vectors
@@ -561,50 +454,11 @@ def caculate_Col_loss(args, local_q_vector, local_ctx_vectors, local_teacher_q_h
 
 def caculate_Col_NLLloss(args, local_q_hidden, local_ctx_hidden, local_positive_idxs):
     if torch.distributed.get_world_size() > 1:
-        q_hidden_to_send = (
-            torch.empty_like(local_q_hidden).cpu().copy_(local_q_hidden).detach_()
-        )
-        ctx_hidden_to_send = (
-            torch.empty_like(local_ctx_hidden).cpu().copy_(local_ctx_hidden).detach_()
-        )
-
-        global_question_ctx_vectors = all_gather_list(
-            [
-                q_hidden_to_send,
-                ctx_hidden_to_send,
-                local_positive_idxs,
-            ],
-            max_size=640000000,
-        )
-
-        global_q_hidden = []
-        global_ctx_hidden = []
-
-        # ctxs_per_question = local_ctx_vectors.size(0)
-        positive_idx_per_question = []
-        # hard_negatives_per_question = []
-
-        total_ctxs = 0
-
-        for i, item in enumerate(global_question_ctx_vectors):
-            q_hidden, ctx_hidden, positive_idx = item
-
-            if i != args.local_rank:
-                global_q_hidden.extend(q_hidden.to(local_q_hidden.device))
-                global_ctx_hidden.extend(ctx_hidden.to(local_q_hidden.device))
-                positive_idx_per_question.extend([v + total_ctxs for v in positive_idx])
-            else:
-                global_q_hidden.extend(local_q_hidden)
-                global_ctx_hidden.extend(local_ctx_hidden)
-                positive_idx_per_question.extend(
-                    [v + total_ctxs for v in local_positive_idxs]
-                )
-            total_ctxs += ctx_hidden.size(0)
-
-        global_q_hidden = pad_sequence(global_q_hidden, batch_first=True)
-        global_ctx_hidden = pad_sequence(global_ctx_hidden, batch_first=True)
-        #global_q_hidden = torch.cat(global_q_hidden, dim=0)
-        #global_ctx_hidden = torch.cat(global_ctx_hidden, dim=0)
+        q_hidden, ctx_hidden, positive_idxs = all_gather_tensors(
+            [local_q_hidden, local_ctx_hidden, torch.tensor(local_positive_idxs, device=local_q_hidden.device)])
+        global_q_hidden = pad_rows(q_hidden)
+        global_ctx_hidden = pad_rows(ctx_hidden)
+        positive_idx_per_question = offset_positive_idxs(positive_idxs, ctx_hidden)
     else:
         global_q_hidden = local_q_hidden
         global_ctx_hidden = local_ctx_hidden
@@ -692,28 +546,9 @@ def do_biencoder_fwd_pass_eval(args, model, batch):
 
     local_q_vector, local_ctx_vectors = model(**inputs)
 
-    q_vector_to_send = torch.empty_like(local_q_vector).cpu().copy_(local_q_vector).detach_()
-    ctx_vector_to_send = torch.empty_like(local_ctx_vectors).cpu().copy_(local_ctx_vectors).detach_()
-
-    global_question_ctx_vectors = all_gather_list(
-        [q_vector_to_send, ctx_vector_to_send],
-        max_size=640000000)
-
-    global_q_vector = []
-    global_ctxs_vector = []
-
-    for i, item in enumerate(global_question_ctx_vectors):
-        q_vector, ctx_vectors = item
-
-        if i != args.rank:
-            global_q_vector.append(q_vector.to(local_q_vector.device))
-            global_ctxs_vector.append(ctx_vectors.to(local_q_vector.device))
-        else:
-            global_q_vector.append(local_q_vector)
-            global_ctxs_vector.append(local_ctx_vectors)
-
-    global_q_vector = torch.cat(global_q_vector, dim=0)
-    global_ctxs_vector = torch.cat(global_ctxs_vector, dim=0)
+    q_vectors, ctx_vectors = all_gather_tensors([local_q_vector, local_ctx_vectors])
+    global_q_vector = torch.cat(q_vectors, dim=0)
+    global_ctxs_vector = torch.cat(ctx_vectors, dim=0)
 
     scores = torch.matmul(global_q_vector, torch.transpose(global_ctxs_vector, 0, 1))
     if len(global_q_vector.size()) > 1:
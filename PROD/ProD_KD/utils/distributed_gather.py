@@ -0,0 +1,187 @@
+import argparse
+import logging
+import os
+import pickle
+import time
+import torch
+import torch.distributed as dist
+from torch.nn.utils.rnn import pad_sequence
+
+logger = logging.getLogger(__name__)
+
+
+def _all_gather_flat(buffer, group=None):
+    """[world_size, n] gather of a 1-D tensor with the same n on every rank, in one collective"""
+    world_size = dist.get_world_size(group)
+    gather_into_tensor = getattr(dist, 'all_gather_into_tensor', None) or getattr(dist, '_all_gather_base', None)
+    if gather_into_tensor is not None and dist.get_backend(group) == 'nccl':
+        gathered = buffer.new_empty((world_size * buffer.numel(),))
+        gather_into_tensor(gathered, buffer, group=group)
+        return gathered.view(world_size, -1)
+    gathered = [torch.empty_like(buffer) for _ in range(world_size)]
+    dist.all_gather(gathered, buffer, group=group)
+    return torch.stack(gathered)
+
+
+def all_gather_tensors(tensors, group=None):
+    """`all_gather_list` for tensors, without leaving the device.
+
+    Every rank passes the same number of tensors, with the same dims and dtypes in the same order;
+    their sizes may differ between ranks. Returns, for each input, the list of the world_size
+    tensors of the ranks. The slot of this rank is the input itself, so gradients flow through it
+    as with all_gather_list; the others carry no gradient.
+
+    One all_gather exchanges the shapes, then the tensors of each dtype are padded to the largest
+    shape of any rank and gathered in a single flat buffer.
+    """
+    world_size = dist.get_world_size(group)
+    rank = dist.get_rank(group)
+    device = tensors[0].device
+    local_shapes = torch.tensor([size for tensor in tensors for size in tensor.shape], dtype=torch.long, device=device)
+    rank_shapes = _all_gather_flat(local_shapes, group=group).tolist()
+
+    shapes = []
+    by_dtype = {}
+    offset = 0
+    for index, tensor in enumerate(tensors):
+        shapes.append([tuple(sizes[offset:offset + tensor.dim()]) for sizes in rank_shapes])
+        offset += tensor.dim()
+        by_dtype.setdefault(tensor.dtype, []).append(index)
+
+    results = [[None] * world_size for _ in tensors]
+    for indices in by_dtype.values():
+        padded_shapes = [tuple(max(sizes) for sizes in zip(*shapes[index])) for index in indices]
+        parts = []
+        for index, padded_shape in zip(indices, padded_shapes):
+            tensor = tensors[index].detach()
+            if tuple(tensor.shape) != padded_shape:
+                padded = tensor.new_zeros(padded_shape)
+                padded[tuple(slice(0, size) for size in tensor.shape)] = tensor
+                tensor = padded
+            parts.append(tensor.reshape(-1))
+        gathered = _all_gather_flat(torch.cat(parts), group=group)
+        start = 0
+        for index, padded_shape, part in zip(indices, padded_shapes, parts):
+            block = gathered[:, start:start + part.numel()].reshape((world_size,) + padded_shape)
+            start += part.numel()
+            for i, shape in enumerate(shapes[index]):
+                results[index][i] = block[i][tuple(slice(0, size) for size in shape)]
+            results[index][rank] = tensors[index]
+    return results
+
+
+def offset_positive_idxs(positive_idxs, ctx_vectors):
+    """positive ctx indices of every rank, shifted to index the concatenated `ctx_vectors` of the ranks"""
+    positive_idx_per_question = []
+    total_ctxs = 0
+    for positive_idx, ctxs in zip(positive_idxs, ctx_vectors):
+        positive_idx_per_question.extend([v + total_ctxs for v in positive_idx.tolist()])
+        total_ctxs += ctxs.size(0)
+    return positive_idx_per_question
+
+
+def pad_rows(parts):
+    """the rows of the gathered [B_i, L_i, ...] tensors as one [sum B_i, max L_i, ...] batch"""
+    return pad_sequence([row for part in parts for row in part], batch_first=True)
+
+
+def _pickle_all_gather(data, max_size, device):
+    """The all_gather_list path on `device`: every rank pickles into its slot of a zeroed
+    [world_size * max_size] byte buffer, which is all_reduced and unpickled"""
+    enc = pickle.dumps(data)
+    size = len(enc) + 4
+    assert size <= max_size, 'encoded data exceeds max_size: {}'.format(len(enc))
+    rank = dist.get_rank()
+    world_size = dist.get_world_size()
+    buffer = torch.zeros(max_size * world_size, dtype=torch.uint8, device=device)
+    cpu_buffer = torch.ByteTensor(max_size)
+    if device.type == 'cuda':
+        cpu_buffer = cpu_buffer.pin_memory()
+    cpu_buffer[0:4] = torch.ByteTensor(list(len(enc).to_bytes(4, byteorder='big')))
+    cpu_buffer[4:size] = torch.ByteTensor(list(enc))
+    buffer[rank * max_size: rank * max_size + size].copy_(cpu_buffer[:size])
+    dist.all_reduce(buffer)
+    result = []
+    for i in range(world_size):
+        out_buffer = buffer[i * max_size: (i + 1) * max_size]
+        size = int.from_bytes(out_buffer[0:4].tolist(), byteorder='big')
+        result.append(pickle.loads(bytes(out_buffer[4: size + 4].tolist())))
+    return result
+
+
+def _benchmark_worker(local_rank, args):
+    if args.launched:
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+        dist.init_process_group(backend='nccl')
+    else:
+        device = torch.device('cpu')
+        dist.init_process_group(backend='gloo', init_method='tcp://127.0.0.1:%d' % args.port,
+                                rank=local_rank, world_size=args.world_size)
+    rank = dist.get_rank()
+    # ranks hold different batch sizes, as the last batch of an epoch does
+    num_questions = args.batch_size - rank % 2
+    q_vector = torch.randn(num_questions, args.dim, device=device, requires_grad=True)
+    ctx_vectors = torch.randn(num_questions * args.ctxs_per_question, args.dim, device=device, requires_grad=True)
+    positive_idxs = [i * args.ctxs_per_question for i in range(num_questions)]
+
+    def pickle_path():
+        gathered = _pickle_all_gather([q_vector.detach().cpu(), ctx_vectors.detach().cpu(), positive_idxs],
+                                      args.max_size, device)
+        return [[item[j].to(device) if torch.is_tensor(item[j]) else torch.tensor(item[j], device=device)
+                 for item in gathered] for j in range(3)]
+
+    def tensor_path():
+        return all_gather_tensors([q_vector, ctx_vectors, torch.tensor(positive_idxs, device=device)])
+
+    expected, gathered = pickle_path(), tensor_path()
+    for i in range(len(expected)):
+        for a, b in zip(expected[i], gathered[i]):
+            assert a.shape == b.shape and torch.equal(a.detach(), b.detach()), 'gathered tensors differ'
+    assert gathered[0][rank] is q_vector, 'the local slot must keep its gradient'
+
+    timings = {}
+    for name, function in [('all_gather_list', pickle_path), ('all_gather_tensors', tensor_path)]:
+        for _ in range(args.warmup):
+            function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        dist.barrier()
+        start = time.time()
+        for _ in range(args.iterations):
+            function()
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        timings[name] = (time.time() - start) / args.iterations
+    if rank == 0:
+        payload = (q_vector.numel() + ctx_vectors.numel()) * q_vector.element_size()
+        print('world_size %d, %s, %.1f MB per rank' % (dist.get_world_size(), device.type, payload / 2 ** 20))
+        for name, seconds in timings.items():
+            print('%-20s %8.2f ms / step' % (name, seconds * 1000))
+    dist.destroy_process_group()
+
+
+def main():
+    """Benchmark all_gather_tensors against the pickle + all_reduce path of all_gather_list on the
+    vectors of one contrastive-loss step. Under torch.distributed.launch it runs on the GPUs with
+    nccl, otherwise it spawns --world_size CPU processes with gloo."""
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--local_rank", type=int, default=-1)
+    parser.add_argument("--world_size", type=int, default=2, help="gloo processes spawned without a launcher")
+    parser.add_argument("--port", type=int, default=29533)
+    parser.add_argument("--batch_size", type=int, default=64, help="questions per rank")
+    parser.add_argument("--ctxs_per_question", type=int, default=16)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--max_size", type=int, default=640000000, help="all_gather_list buffer bytes per rank")
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--iterations", type=int, default=20)
+    args = parser.parse_args()
+    args.launched = args.local_rank != -1 or 'LOCAL_RANK' in os.environ
+    if args.launched:
+        _benchmark_worker(args.local_rank if args.local_rank != -1 else int(os.environ['LOCAL_RANK']), args)
+    else:
+        torch.multiprocessing.spawn(_benchmark_worker, args=(args,), nprocs=args.world_size)
+
+
+if __name__ == "__main__":
+    main()
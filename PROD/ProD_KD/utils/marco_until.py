@@ -40,6 +40,7 @@ def _read_tsv(input_file, trainer_id=0, trainer_num=1):
 
 from torch.utils.data import DataLoader, Dataset, TensorDataset, IterableDataset
 import six
+from utils.passage_store import load_passage_store
 def convert_to_unicode(text):
     """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
     if six.PY3:
@@ -95,6 +96,9 @@ class Rocketqa_v2Dataset(Dataset):
 
     def load_id_text(self,file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -107,9 +111,6 @@ class Rocketqa_v2Dataset(Dataset):
     def __getitem__(self, index):
         sample = self.data[index]
 
-        query = convert_to_unicode(sample['query_string'])
-        query = normalize_question(query)
-
         pos_ids_list = sample['pos_id']
         neg_ids_list = sample['neg_id']
         if self.is_training:
@@ -121,20 +122,31 @@ class Rocketqa_v2Dataset(Dataset):
 
         pos_id = int(pos_ids_list[0])
         neg_ids_list = neg_ids_list[0:self.num_hard_negatives]
+        pids = [pos_id] + [int(neg_id) for neg_id in neg_ids_list]
 
-        title_pos = convert_to_unicode(self.p_title.get(pos_id,'-'))
-        para_pos = convert_to_unicode(self.p_text[pos_id])
+        question_token_ids, ctx_ids, c_e_token_ids = self.encode(sample['query_string'], pids)
+        # example index and passages, the keys of a --teacher_scores_path file (utils/teacher_scores.py)
+        return question_token_ids, ctx_ids, c_e_token_ids, torch.tensor(index), torch.LongTensor(pids)
 
-        p_neg_list = [[convert_to_unicode(self.p_title.get(int(neg_id),'-')),
-                       convert_to_unicode(self.p_text[int(neg_id)])] for neg_id in neg_ids_list]
-
-        title_text_pairs = [[title_pos,para_pos]] + p_neg_list
-        ctx_token_ids = [self.tokenizer.encode(ctx[0], text_pair=ctx[1], add_special_tokens=True,
-                                        max_length=self.max_seq_length,truncation=True,
-                                        pad_to_max_length=False) for ctx in title_text_pairs]
-        question_token_ids = self.tokenizer.encode(query,add_special_tokens=True,
-                                        max_length=self.max_q_length,truncation=True,
-                                        pad_to_max_length=False)
+    def query_token_ids(self, query):
+        query = convert_to_unicode(query)
+        query = normalize_question(query)
+        return self.tokenizer.encode(query, add_special_tokens=True,
+                                     max_length=self.max_q_length, truncation=True,
+                                     pad_to_max_length=False)
+
+    def passage_token_ids(self, pids):
+        title_text_pairs = [[convert_to_unicode(self.p_title.get(int(pid), '-')),
+                             convert_to_unicode(self.p_text[int(pid)])] for pid in pids]
+        return [self.tokenizer.encode(ctx[0], text_pair=ctx[1], add_special_tokens=True,
+                                      max_length=self.max_seq_length, truncation=True,
+                                      pad_to_max_length=False) for ctx in title_text_pairs]
+
+    def encode(self, query, pids):
+        """padded query [max_q_length], passage [len(pids), max_seq_length] and cross-encoder
+        [len(pids), max_seq_length + max_q_length] ids of `query` with the passages `pids`"""
+        ctx_token_ids = self.passage_token_ids(pids)
+        question_token_ids = self.query_token_ids(query)
         def remove_special_token(token_id):
             if token_id[-1] == self.tokenizer.sep_token_id:
                 return token_id[1:-1]
@@ -169,7 +181,9 @@ class Rocketqa_v2Dataset(Dataset):
             return {'retriever': [q_tensor, (q_tensor!= 0).long(), doc_tensor, 
                                 (doc_tensor!= 0).long(), positive_ctx_indices],
                     'reranker': [ctx_tensor_out, 
-                                (ctx_tensor_out!= 0).long(), tgt_tensor],}
+                                (ctx_tensor_out!= 0).long(), tgt_tensor],
+                    'pair_ids': [torch.stack([feature[3] for feature in features]),
+                                 torch.stack([feature[4] for feature in features])],}
         return create_biencoder_input2
 
 
@@ -200,6 +214,9 @@ class MarcoDoc_Dataset(Dataset):
         return pre_data
 
     def load_id_text(self, file_name):
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         pids_to_doc = {}
         with open(file_name, 'r') as f:
             for l in f:
@@ -240,9 +257,6 @@ class MarcoDoc_Dataset(Dataset):
     def __getitem__(self, index):
         sample = self.data[index]
 
-        query = convert_to_unicode(sample['query_string'])
-        query = normalize_question(query)
-
         pos_ids_list = sample['pos_id']
         neg_ids_list = sample['neg_id']
         if self.is_training:
@@ -254,18 +268,30 @@ class MarcoDoc_Dataset(Dataset):
 
         pos_id = int(pos_ids_list[0])
         neg_ids_list = neg_ids_list[0:self.num_hard_negatives]
+        pids = [pos_id] + [int(neg_id) for neg_id in neg_ids_list]
 
-        pos_doc_text = convert_to_unicode(self.p_fulltext[pos_id])
+        question_token_ids, ctx_ids, c_e_token_ids = self.encode(sample['query_string'], pids)
+        # example index and documents, the keys of a --teacher_scores_path file (utils/teacher_scores.py)
+        return question_token_ids, ctx_ids, c_e_token_ids, torch.tensor(index), torch.LongTensor(pids)
 
-        neg_doc_text = [self.p_fulltext[neg_id] for neg_id in neg_ids_list]
-
-        all_doc_text = [pos_doc_text] + neg_doc_text
-        ctx_token_ids = [self.tokenizer.encode(ctx, add_special_tokens=True,
-                                               max_length=self.max_seq_length, truncation=True,
-                                               pad_to_max_length=False) for ctx in all_doc_text]
-        question_token_ids = self.tokenizer.encode(query, add_special_tokens=True,
-                                                   max_length=self.max_q_length, truncation=True,
-                                                   pad_to_max_length=False)
+    def query_token_ids(self, query):
+        query = convert_to_unicode(query)
+        query = normalize_question(query)
+        return self.tokenizer.encode(query, add_special_tokens=True,
+                                     max_length=self.max_q_length, truncation=True,
+                                     pad_to_max_length=False)
+
+    def passage_token_ids(self, pids):
+        all_doc_text = [convert_to_unicode(self.p_fulltext[int(pid)]) for pid in pids]
+        return [self.tokenizer.encode(ctx, add_special_tokens=True,
+                                      max_length=self.max_seq_length, truncation=True,
+                                      pad_to_max_length=False) for ctx in all_doc_text]
+
+    def encode(self, query, pids):
+        """padded query [max_q_length], document [len(pids), max_seq_length] and cross-encoder
+        [len(pids), max_seq_length + max_q_length] ids of `query` with the documents `pids`"""
+        ctx_token_ids = self.passage_token_ids(pids)
+        question_token_ids = self.query_token_ids(query)
 
         def remove_special_token(token_id):
             if token_id[-1] == self.tokenizer.sep_token_id:
@@ -308,6 +334,8 @@ class MarcoDoc_Dataset(Dataset):
             return {'retriever': [q_tensor, (q_tensor != 0).long(), doc_tensor,
                                   (doc_tensor != 0).long(), positive_ctx_indices],
                     'reranker': [ctx_tensor_out,
-                                 (ctx_tensor_out != 0).long(), tgt_tensor], }
+                                 (ctx_tensor_out != 0).long(), tgt_tensor],
+                    'pair_ids': [torch.stack([feature[3] for feature in features]),
+                                 torch.stack([feature[4] for feature in features])], }
 
         return create_biencoder_input2
\ No newline at end of file
@@ -0,0 +1,139 @@
+import json
+import logging
+import os
+import numpy as np
+import torch
+
+logger = logging.getLogger(__name__)
+
+META_FILE = 'meta.json'
+# teacher roles a score file can hold, the models `train` would otherwise run
+ROLES = ('teacher', 'double_teacher', 'student_copy')
+
+
+def candidate_ids(sample):
+    """sorted distinct passage ids a training example can be paired with: its first positive
+    (the one `Rocketqa_v2Dataset` uses) and every negative"""
+    return np.unique(np.asarray([int(sample['pos_id'][0])] + [int(pid) for pid in sample['neg_id']],
+                                dtype=np.int64))
+
+
+def score_path(path, role, kind):
+    return os.path.join(path, '%s.%s.npy' % (role, kind))
+
+
+def write_candidates(path, data):
+    """The candidate layout of the training examples `data`, in CSR form: the candidates of
+    example i are `pids[offsets[i]:offsets[i + 1]]`; `passages.ids.npy` holds all of them once"""
+    os.makedirs(path, exist_ok=True)
+    rows = [candidate_ids(sample) for sample in data]
+    offsets = np.concatenate([[0], np.cumsum([len(row) for row in rows])]).astype(np.int64)
+    pids = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+    np.save(os.path.join(path, 'candidates.offsets.npy'), offsets)
+    np.save(os.path.join(path, 'candidates.pids.npy'), pids)
+    np.save(os.path.join(path, 'passages.ids.npy'), np.unique(pids))
+    return offsets, pids
+
+
+def write_meta(path, meta):
+    with open(os.path.join(path, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(os.path.join(path, META_FILE + '.tmp'), os.path.join(path, META_FILE))
+
+
+class TeacherScores:
+    """Teacher outputs precomputed by precompute_teacher_scores.py, memmapped from `path`.
+
+    A cross-encoder role stores one logit per (example, candidate) pair, aligned with
+    `candidates.pids.npy`. A dual-encoder role stores the CLS vector of every example's query and
+    of every distinct passage in `passages.ids.npy`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, META_FILE), 'r') as f:
+            self.meta = json.load(f)
+        self.offsets = np.load(os.path.join(path, 'candidates.offsets.npy'))
+        self.pids = np.load(os.path.join(path, 'candidates.pids.npy'), mmap_mode='r')
+        self.passage_ids = np.load(os.path.join(path, 'passages.ids.npy'))
+        self._arrays = {}
+        self._selected = None
+
+    @property
+    def num_examples(self):
+        return len(self.offsets) - 1
+
+    def roles(self):
+        return self.meta['roles']
+
+    def _array(self, role, kind):
+        if (role, kind) not in self._arrays:
+            self._arrays[(role, kind)] = np.load(score_path(self.path, role, kind), mmap_mode='r')
+        return self._arrays[(role, kind)]
+
+    def _rows(self, example_ids, pids):
+        """positions in `candidates.pids.npy` of the [B, M] `pids` of `example_ids`"""
+        example_ids = np.asarray(example_ids, dtype=np.int64)
+        pids = np.asarray(pids, dtype=np.int64)
+        rows = np.empty(pids.shape, dtype=np.int64)
+        for i, example_id in enumerate(example_ids):
+            start, end = self.offsets[example_id], self.offsets[example_id + 1]
+            found = start + np.searchsorted(self.pids[start:end], pids[i])
+            if np.any(found >= end) or np.any(self.pids[np.minimum(found, end - 1)] != pids[i]):
+                raise ValueError("passages %s of example %d are not in the teacher scores at %s"
+                                 % (pids[i].tolist(), example_id, self.path))
+            rows[i] = found
+        return rows
+
+    def logits(self, role, example_ids, pids):
+        """[B, M] cross-encoder logits of the `pids` paired with `example_ids`"""
+        return np.asarray(self._array(role, 'logits')[self._rows(example_ids, pids)], dtype=np.float32)
+
+    def query_vectors(self, role, example_ids):
+        return np.asarray(self._array(role, 'queries')[np.asarray(example_ids, dtype=np.int64)], dtype=np.float32)
+
+    def passage_vectors(self, role, pids):
+        pids = np.asarray(pids, dtype=np.int64).reshape(-1)
+        found = np.searchsorted(self.passage_ids, pids)
+        if np.any(found >= len(self.passage_ids)) or \
+                np.any(self.passage_ids[np.minimum(found, len(self.passage_ids) - 1)] != pids):
+            raise ValueError("passages without teacher vectors at %s" % self.path)
+        return np.asarray(self._array(role, 'passages')[found], dtype=np.float32)
+
+    def select(self, example_ids, pids):
+        """the pairs of the current batch, read by the `PrecomputedTeacher` calls of the step"""
+        self._selected = (example_ids.cpu().numpy() if torch.is_tensor(example_ids) else example_ids,
+                          pids.cpu().numpy() if torch.is_tensor(pids) else pids)
+
+    @property
+    def selected(self):
+        if self._selected is None:
+            raise RuntimeError("TeacherScores.select was not called for this batch")
+        return self._selected
+
+
+class PrecomputedTeacher:
+    """Stand-in for a frozen teacher in `train`: called like the model it replaces, it returns
+    that model's outputs on the pairs of `scores.select`, read from the score file"""
+
+    def __init__(self, scores, role, device):
+        self.scores = scores
+        self.role = role
+        self.teacher_type = scores.meta['roles'][role]
+        self.device = device
+
+    def eval(self):
+        return self
+
+    def train(self, mode=True):
+        return self
+
+    def __call__(self, *args, **kwargs):
+        example_ids, pids = self.scores.selected
+        if self.teacher_type == 'cross_encoder':
+            logits = self.scores.logits(self.role, example_ids, pids)
+            # (binary_logits, relevance_logits, _) of Reranker, the binary head is not stored
+            return None, torch.from_numpy(logits).to(self.device), None
+        q_vectors = self.scores.query_vectors(self.role, example_ids)
+        ctx_vectors = self.scores.passage_vectors(self.role, pids)
+        return torch.from_numpy(q_vectors).to(self.device), torch.from_numpy(ctx_vectors).to(self.device)
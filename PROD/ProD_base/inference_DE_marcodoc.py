@@ -22,11 +22,15 @@ from torch.utils.data import DataLoader
 from tqdm import tqdm
 import torch.distributed as dist
 from torch import nn
+from utils.retrieval_metrics import ranking_scores
 from utils.util import (
     is_first_worker,
 )
 from model.models import BiEncoderNllLoss, BiBertEncoder, HFBertEncoder
 from utils.dpr_utils import load_states_from_checkpoint, get_model_obj
+from utils.embedding_shards import EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, write_manifest
+from utils.faiss_index import (add_index_args, build_index_from_args, cache_index_from_args, find_cached_index,
+                               load_index_from_args)
 import random
 import pickle
 from transformers import (
@@ -167,37 +171,23 @@ def get_passage_embedding(args, passages, model, tokenizer):
             end_idx = len(passages)
         passages_piece = passages[start_idx:end_idx]
         logger.info(f'Embedding generation for {len(passages_piece)} passages from idx {start_idx} to {end_idx}')
-        allids, allembeddings = embed_passages(args, passages_piece, model, tokenizer)
         if is_first_worker():
             if not os.path.exists(args.output_dir):
                 os.makedirs(args.output_dir)
         dist.barrier()
-        pickle_path = os.path.join(args.output_dir,
-                                "{1}_data_obj_{0}.pb".format(str(args.local_rank), 'passage_embedding'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allembeddings, handle, protocol=4)
-        pickle_path = os.path.join(args.output_dir,
-                                "{1}_data_obj_{0}.pb".format(str(args.local_rank), 'passage_embedding_id'))
-        with open(pickle_path, 'wb') as handle:
-            pickle.dump(allids, handle, protocol=4)
-        logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
+        writer = EmbeddingShardWriter(args.output_dir, 'passage_embedding', args.local_rank, start_idx, end_idx,
+                                      len(passages), tag=checkpoint_fingerprint(args.eval_model_dir))
+        embed_passages(args, passages_piece, model, tokenizer, writer=writer)
+        logger.info(f'Total passages processed {writer.completed}.')
         dist.barrier()
     passage_embedding,passage_embedding_id = None,None
     if is_first_worker():
-        passage_embedding_list = []
-        passage_embedding_id_list = []
-        for i in range(args.world_size):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir,"{1}_data_obj_{0}.pb".format(str(i),'passage_embedding'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_list.append(b)
-        for i in range(args.world_size):  # TODO: dynamically find the max instead of HardCode
-            pickle_path = os.path.join(args.output_dir,"{1}_data_obj_{0}.pb".format(str(i),'passage_embedding_id'))
-            with open(pickle_path, 'rb') as handle:
-                b = pickle.load(handle)
-                passage_embedding_id_list.append(b)
-        passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-        passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+        if not args.load_cache:
+            write_manifest(args.output_dir, 'passage_embedding', args.world_size, len(passages),
+                           checkpoint=args.eval_model_dir)
+        # one read-only memmap over every rank's rows, nothing is merged in memory
+        shards = EmbeddingShards(args.output_dir, 'passage_embedding')
+        passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
     dist.barrier()
     return passage_embedding, passage_embedding_id
 
@@ -270,11 +260,15 @@ class TextDataset(torch.utils.data.Dataset):
         return fn
     
 
-def embed_passages(opt, passages, model, tokenizer):
+def embed_passages(opt, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = opt.per_gpu_eval_batch_size
     dataset = TextDataset(passages, tokenizer, opt.max_seq_length)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=20, collate_fn=TextDataset.get_collate_fn(opt))
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
     with torch.no_grad():
         for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
@@ -284,11 +278,18 @@ def embed_passages(opt, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 100 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
@@ -300,7 +301,11 @@ def generate_new_embeddings(args, tokenizer, model):
     passages = load_data(args)
     logger.info("***** inference of passages *****")
 
-    if args.load_cache and is_first_worker():
+    index_cache = find_cached_index(args, args.eval_model_dir, len(passages))
+    if index_cache is not None:
+        logger.info("***** Reusing cached index %s, skip passage inference *****", index_cache)
+        passage_embedding, passage_embedding2id = None, None
+    elif args.load_cache and is_first_worker():
         passage_embedding, passage_embedding2id = get_passage_embedding(args, passages, model,tokenizer)
     else:
         passage_embedding, passage_embedding2id = get_passage_embedding(args, passages, model,tokenizer)
@@ -334,31 +339,26 @@ def generate_new_embeddings(args, tokenizer, model):
     ''' test eval'''
     if is_first_worker():
 
-        dim = passage_embedding.shape[1]
-        print('passage embedding shape: ' + str(passage_embedding.shape))
-        logger.info("***** Begin passage_embedding reorder *****")
-        # new_passage_embedding = passage_embedding.copy()
-        # for i in range(passage_embedding.shape[0]):
-        #     new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
-        # del (passage_embedding)
-        # passage_embedding = new_passage_embedding
-        # passage_embedding2id = np.arange(passage_embedding.shape[0])
-        logger.info("***** Begin passage_embedding reorder  *****")
+        if index_cache is None:
+            dim = passage_embedding.shape[1]
+            print('passage embedding shape: ' + str(passage_embedding.shape))
+            logger.info("***** Begin passage_embedding reorder *****")
+            # new_passage_embedding = passage_embedding.copy()
+            # for i in range(passage_embedding.shape[0]):
+            #     new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
+            # del (passage_embedding)
+            # passage_embedding = new_passage_embedding
+            # passage_embedding2id = np.arange(passage_embedding.shape[0])
+            logger.info("***** Begin passage_embedding reorder  *****")
         logger.info("***** Begin ANN Index build *****")
         top_k = args.top_k
         # faiss.omp_set_num_threads(args.thread_num)
-        cpu_index = faiss.IndexFlatIP(dim)
-        co = faiss.GpuMultipleClonerOptions()
-        co.shard = True
-        # co.useFloat16 = True
-        gpu_index_flat = faiss.index_cpu_to_all_gpus(  # build the index
-            cpu_index,
-            co=co
-        )
-        # gpu_index_flat = faiss.index_cpu_to_all_gpus(cpu_index)
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
-        # output_path = os.path.join(args.output_dir, 'faiss.index')
-        # faiss.write_index(cpu_index, output_path)
+        recall_queries = test_question_embedding if args.test_qa_path is not None else None
+        if index_cache is not None:
+            gpu_index_flat, passage_embedding2id = load_index_from_args(args, index_cache)
+        else:
+            gpu_index_flat = build_index_from_args(args, passage_embedding, queries=recall_queries)
+            cache_index_from_args(args, args.eval_model_dir, gpu_index_flat, passage_embedding2id)
         logger.info("***** Done ANN Index *****")
 
         if args.test_qa_path is not None:
@@ -513,71 +513,9 @@ def load_train_reference_from_stream(input_file, trainer_id=0, trainer_num=1):
     return qrel
 
 def compute_metrics(qids_to_relevant_passageids, qids_to_ranked_candidate_passages):
-    """Compute MRR metric
-    Args:
-    p_qids_to_relevant_passageids (dict): dictionary of query-passage mapping
-        Dict as read in with load_reference or load_reference_from_stream
-    p_qids_to_ranked_candidate_passages (dict): dictionary of query-passage candidates
-    Returns:
-        dict: dictionary of metrics {'MRR': <MRR Score>}
-    """
-    MaxMRRRank = 10
-    all_scores = {}
-    MRR = 0
-    qids_with_relevant_passages = 0
-    ranking = []
-    recall_q_top1 = set()
-    recall_q_top5 = set()
-    recall_q_top20 = set()
-    recall_q_top50 = set()
-    recall_q_top100 = set()
-    recall_q_all = set()
-
-    for qid in qids_to_ranked_candidate_passages:
-        if qid in qids_to_relevant_passageids:
-            ranking.append(0)
-            target_pid = qids_to_relevant_passageids[qid]
-            candidate_pid = qids_to_ranked_candidate_passages[qid]
-            for i in range(0, MaxMRRRank):
-                if candidate_pid[i] in target_pid:
-                    MRR += 1.0 / (i + 1)
-                    ranking.pop()
-                    ranking.append(i + 1)
-                    break
-            for i, pid in enumerate(candidate_pid):
-                if pid in target_pid:
-                    recall_q_all.add(qid)
-                    if i < 100:
-                        recall_q_top100.add(qid)
-                    if i < 50:
-                        recall_q_top50.add(qid)
-                    if i < 20:
-                        recall_q_top20.add(qid)
-                    if i < 5:
-                        recall_q_top5.add(qid)
-                    if i == 0:
-                        recall_q_top1.add(qid)
-                    break
-    if len(ranking) == 0:
-        raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
-
-    MRR = MRR / len(qids_to_relevant_passageids)
-    recall_top1 = len(recall_q_top1) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top5 = len(recall_q_top5) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top20 = len(recall_q_top20) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top50 = len(recall_q_top50) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top100 = len(recall_q_top100) * 1.0 / len(qids_to_relevant_passageids)
-    recall_all = len(recall_q_all) * 1.0 / len(qids_to_relevant_passageids)
-    all_scores['MRR @10'] = MRR
-    all_scores["recall@1"] = recall_top1
-    all_scores["recall@5"] = recall_top5
-    all_scores["recall@20"] = recall_top20
-    all_scores["recall@50"] = recall_top50
-    all_scores["recall@100"] = recall_top100
-    all_scores["recall@all"] = recall_all
-    all_scores['QueriesRanked'] = len(qids_to_ranked_candidate_passages)
-    all_scores['record'] = str(round(recall_top1*100, 2)) + " / " + str(round(recall_top5*100, 2)) +" / " + str(round(recall_top20*100, 2)) +" / " + str(round(recall_top50*100, 2)) +" / " + str(round(recall_top100*100, 2)) +" / " + str(round(recall_all*100, 2))
-    return all_scores
+    """MRR@10 and recall@1/5/20/50/100/all, see retrieval_metrics.py"""
+    return ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages,
+                          recall_cutoffs=(1, 5, 20, 50, 100), record=True)
 
 import math
 def get_arguments():
@@ -705,6 +643,7 @@ def get_arguments():
         default=False,
         action="store_true",
     )
+    add_index_args(parser)
     args = parser.parse_args()
 
     return args
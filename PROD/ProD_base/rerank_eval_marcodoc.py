@@ -21,6 +21,7 @@ import torch.distributed as dist
 from torch import nn
 import torch.nn.functional as F
 from model.models import BiEncoderNllLoss, BiBertEncoder, HFBertEncoder, Reranker
+from utils.retrieval_metrics import ranking_scores
 from utils.lamb import Lamb
 import random
 from transformers import (
@@ -318,70 +319,9 @@ def evaluate_dev(args, model, tokenizer, passage=None):
                 json.dump(result, f, indent=2)
 
 def compute_metrics(qids_to_relevant_passageids, qids_to_ranked_candidate_passages):
-    """Compute MRR metric
-    Args:
-    p_qids_to_relevant_passageids (dict): dictionary of query-passage mapping
-        Dict as read in with load_reference or load_reference_from_stream
-    p_qids_to_ranked_candidate_passages (dict): dictionary of query-passage candidates
-    Returns:
-        dict: dictionary of metrics {'MRR': <MRR Score>}
-    """
-    MaxMRRRank = 10
-    all_scores = {}
-    MRR = 0
-    qids_with_relevant_passages = 0
-    ranking = []
-    recall_q_top1 = set()
-    recall_q_top5 = set()
-    recall_q_top20 = set()
-    recall_q_top50 = set()
-    recall_q_top100 = set()
-    recall_q_all = set()
-
-    for qid in qids_to_ranked_candidate_passages:
-        if qid in qids_to_relevant_passageids:
-            ranking.append(0)
-            target_pid = qids_to_relevant_passageids[qid]
-            candidate_pid = qids_to_ranked_candidate_passages[qid]
-            for i in range(0, MaxMRRRank):
-                if candidate_pid[i] in target_pid:
-                    MRR += 1.0 / (i + 1)
-                    ranking.pop()
-                    ranking.append(i + 1)
-                    break
-            for i, pid in enumerate(candidate_pid):
-                if pid in target_pid:
-                    recall_q_all.add(qid)
-                    if i < 100:
-                        recall_q_top100.add(qid)
-                    if i < 50:
-                        recall_q_top50.add(qid)
-                    if i < 20:
-                        recall_q_top20.add(qid)
-                    if i < 5:
-                        recall_q_top5.add(qid)
-                    if i == 0:
-                        recall_q_top1.add(qid)
-                    break
-    if len(ranking) == 0:
-        raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
-
-    MRR = MRR / len(qids_to_relevant_passageids)
-    recall_top1 = len(recall_q_top1) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top5 = len(recall_q_top5) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top20 = len(recall_q_top20) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top50 = len(recall_q_top50) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top100 = len(recall_q_top100) * 1.0 / len(qids_to_relevant_passageids)
-    recall_all = len(recall_q_all) * 1.0 / len(qids_to_relevant_passageids)
-    all_scores['MRR @10'] = MRR
-    all_scores["recall@1"] = recall_top1
-    all_scores["recall@5"] = recall_top5
-    all_scores["recall@20"] = recall_top20
-    all_scores["recall@50"] = recall_top50
-    all_scores["recall@100"] = recall_top100
-    all_scores["recall@all"] = recall_all
-    all_scores['QueriesRanked'] = len(qids_to_ranked_candidate_passages)
-    return all_scores
+    """MRR@10 and recall@1/5/20/50/100/all, see retrieval_metrics.py"""
+    return ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages,
+                          recall_cutoffs=(1, 5, 20, 50, 100))
 
 
 
@@ -21,6 +21,7 @@ import torch.distributed as dist
 from torch import nn
 import torch.nn.functional as F
 from model.models import BiEncoderNllLoss, BiBertEncoder, HFBertEncoder, Reranker
+from utils.retrieval_metrics import hit_list_metrics
 from utils.lamb import Lamb
 import random
 from transformers import (
@@ -279,7 +280,7 @@ def validate(questions, passages, answers, closest_docs, similar_scores, query_e
     top_k_hits = [v / len(closest_docs) for v in top_k_hits]
     logger.info('Validation results: top k documents hits accuracy %s', top_k_hits)
 
-    return top_k_hits, final_scores, Eval_Tool.get_matrics(final_scores), final_result_dict_list
+    return top_k_hits, final_scores, hit_list_metrics(final_scores), final_result_dict_list
 
 def get_arguments():
     parser = argparse.ArgumentParser()
@@ -40,6 +40,7 @@ def _read_tsv(input_file, trainer_id=0, trainer_num=1):
 
 from torch.utils.data import DataLoader, Dataset, TensorDataset, IterableDataset
 import six
+from utils.passage_store import load_passage_store
 def convert_to_unicode(text):
     """Converts `text` to Unicode (if it's not already), assuming utf-8 input."""
     if six.PY3:
@@ -95,6 +96,9 @@ class Rocketqa_v2Dataset(Dataset):
 
     def load_id_text(self,file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -200,6 +204,9 @@ class MarcoDoc_Dataset(Dataset):
         return pre_data
 
     def load_id_text(self, file_name):
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         pids_to_doc = {}
         with open(file_name, 'r') as f:
             for l in f:
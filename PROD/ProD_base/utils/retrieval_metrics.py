@@ -0,0 +1,198 @@
+import logging
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# queries scored per block, bounds the [block, K] hit / key matrices
+EVAL_BLOCK_SIZE = 8192
+# up to this many relevant pids per query, membership is tested by direct comparison
+MAX_COMPARE_RELEVANT = 32
+
+
+def _cutoff_name(k):
+    return 'all' if k is None else str(k)
+
+
+class RelevanceMatrix:
+    """qid -> relevant pids of a qrels dict in CSR layout: row i holds the sorted pids of `qids[i]`"""
+
+    def __init__(self, qids_to_relevant_passageids):
+        self.qids = np.asarray(sorted(qids_to_relevant_passageids), dtype=np.int64)
+        rows = [np.unique(np.asarray(qids_to_relevant_passageids[qid], dtype=np.int64)) for qid in self.qids]
+        lengths = np.asarray([len(row) for row in rows], dtype=np.int64)
+        self.offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+        self.pids = np.concatenate(rows) if rows else np.zeros(0, dtype=np.int64)
+        # (row, pid) pairs as one sorted int64 key, so membership is a single searchsorted
+        self.stride = int(self.pids.max()) + 1 if len(self.pids) else 1
+        self.keys = np.repeat(np.arange(len(self.qids), dtype=np.int64), lengths) * self.stride + self.pids
+
+    def __len__(self):
+        return len(self.qids)
+
+    def rows(self, qids):
+        """row of every qid, -1 for queries without judgments"""
+        qids = np.asarray(qids, dtype=np.int64)
+        if len(self.qids) == 0:
+            return np.full(len(qids), -1, dtype=np.int64)
+        rows = np.minimum(np.searchsorted(self.qids, qids), len(self.qids) - 1)
+        return np.where(self.qids[rows] == qids, rows, -1)
+
+    def num_relevant(self, rows):
+        rows = np.asarray(rows, dtype=np.int64)
+        return np.where(rows >= 0, self.offsets[rows + 1] - self.offsets[rows], 0)
+
+    def hits(self, rows, ranked):
+        """bool [Q, K]: is `ranked[i, j]` relevant to the query of `rows[i]`; -1 pads never are"""
+        ranked = np.asarray(ranked)
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(self.keys) == 0:
+            return np.zeros(ranked.shape, dtype=bool)
+        num_relevant = self.num_relevant(rows)
+        if num_relevant.max(initial=0) <= MAX_COMPARE_RELEVANT:
+            # a few [Q, K] comparisons against each query's j-th relevant pid, -2 where it has fewer
+            hits = np.zeros(ranked.shape, dtype=bool)
+            for j in range(int(num_relevant.max(initial=0))):
+                has_j = num_relevant > j
+                relevant = np.where(has_j, self.pids[np.where(has_j, self.offsets[np.maximum(rows, 0)] + j, 0)], -2)
+                hits |= ranked == relevant[:, None].astype(ranked.dtype)
+            return hits
+        ranked = ranked.astype(np.int64)
+        valid = (rows[:, None] >= 0) & (ranked >= 0) & (ranked < self.stride)
+        keys = rows[:, None] * self.stride + ranked
+        found = np.minimum(np.searchsorted(self.keys, keys), len(self.keys) - 1)
+        return valid & (self.keys[found] == keys)
+
+
+def hit_metrics(hits, num_relevant, cutoffs=(10, 100)):
+    """Per-query MRR@k, Success@k (any relevant in the top k), Recall@k, nDCG@k and MAP@k of a
+    [Q, K] hit matrix with binary relevance; a cutoff of None means all K"""
+    hits = np.asarray(hits, dtype=bool)
+    num_queries, width = hits.shape
+    num_relevant = np.asarray(num_relevant, dtype=np.float64)
+    judged = np.maximum(num_relevant, 1)
+    discount = 1.0 / np.log2(np.arange(width, dtype=np.float64) + 2)
+    ideal = np.concatenate([[0.0], np.cumsum(discount)])
+    # hits are sparse: everything is computed from their (query, rank) positions, in row-major order
+    query, column = np.nonzero(hits)
+    hit_index = np.arange(len(query)) - np.searchsorted(query, query)
+    first = np.full(num_queries, width + 1, dtype=np.float64)
+    hit_queries, first_hit = np.unique(query, return_index=True)
+    first[hit_queries] = column[first_hit] + 1
+    precision = (hit_index + 1) / (column + 1.0)
+
+    metrics = {}
+    for k in cutoffs:
+        depth = width if k is None else min(k, width)
+        name = _cutoff_name(k)
+        within = column < depth
+        found = np.bincount(query[within], minlength=num_queries).astype(np.float64)
+        metrics['MRR@' + name] = np.where(first <= depth, 1.0 / first, 0.0)
+        metrics['Success@' + name] = (found > 0).astype(np.float64)
+        metrics['Recall@' + name] = found / judged
+        metrics['nDCG@' + name] = np.bincount(query[within], weights=discount[column[within]], minlength=num_queries) / \
+            np.maximum(ideal[np.minimum(num_relevant, depth).astype(np.int64)], 1e-12)
+        metrics['MAP@' + name] = np.bincount(query[within], weights=precision[within], minlength=num_queries) / \
+            np.minimum(judged, max(depth, 1))
+    return metrics
+
+
+class RetrievalEvaluator:
+    """Vectorized retrieval metrics over ranked pid matrices, fed in any number of chunks.
+
+    `add(qids, ranked)` takes [Q] qids and their [Q, K] ranked pids (-1 pads); queries without
+    judgments are skipped. `result()` averages MRR / Success / Recall / nDCG / MAP at every
+    cutoff over all judged queries of the qrels, so queries that were never ranked count as 0
+    like the official MS MARCO scorer.
+    """
+
+    def __init__(self, qids_to_relevant_passageids, cutoffs=(1, 5, 10, 20, 50, 100, 1000, None)):
+        self.relevance = qids_to_relevant_passageids if isinstance(qids_to_relevant_passageids, RelevanceMatrix) \
+            else RelevanceMatrix(qids_to_relevant_passageids)
+        self.cutoffs = tuple(cutoffs)
+        self.sums = {}
+        self.num_ranked = 0
+        self.num_judged = 0
+
+    def add(self, qids, ranked):
+        ranked = np.asarray(ranked)
+        self.num_ranked += len(qids)
+        for start in range(0, len(qids), EVAL_BLOCK_SIZE):
+            rows = self.relevance.rows(qids[start:start + EVAL_BLOCK_SIZE])
+            judged = rows >= 0
+            if not judged.any():
+                continue
+            rows = rows[judged]
+            hits = self.relevance.hits(rows, ranked[start:start + EVAL_BLOCK_SIZE][judged])
+            self.num_judged += len(rows)
+            for name, values in hit_metrics(hits, self.relevance.num_relevant(rows), self.cutoffs).items():
+                self.sums[name] = self.sums.get(name, 0.0) + float(values.sum())
+
+    def result(self):
+        if self.num_judged == 0:
+            raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
+        metrics = {name: value / len(self.relevance) for name, value in self.sums.items()}
+        metrics['QueriesRanked'] = self.num_ranked
+        return metrics
+
+
+def ranked_matrix(qids_to_ranked_candidate_passages):
+    """[Q] qids and the [Q, K] ranked pids (padded with -1) of a qid -> ranked pids dict"""
+    qids = np.asarray(list(qids_to_ranked_candidate_passages), dtype=np.int64)
+    lists = [np.asarray(qids_to_ranked_candidate_passages[qid], dtype=np.int64).ravel()
+             for qid in qids_to_ranked_candidate_passages]
+    width = max([len(pids) for pids in lists] or [0])
+    ranked = np.full((len(lists), width), -1, dtype=np.int64)
+    for i, pids in enumerate(lists):
+        ranked[i, :len(pids)] = pids
+    return qids, ranked
+
+
+def evaluate(qids_to_relevant_passageids, qids, ranked, cutoffs=(1, 5, 10, 20, 50, 100, 1000, None)):
+    evaluator = RetrievalEvaluator(qids_to_relevant_passageids, cutoffs=cutoffs)
+    evaluator.add(np.asarray(qids, dtype=np.int64), ranked)
+    return evaluator.result()
+
+
+def legacy_scores(metrics, mrr_depth=10, recall_cutoffs=(1, 50), record=False):
+    """The keys reported by the old per-script compute_metrics: `MRR @{depth}`, `recall@{k}`
+    (whether any relevant passage is in the top k) and `recall@all`"""
+    all_scores = {'MRR @' + str(mrr_depth): metrics['MRR@' + str(mrr_depth)]}
+    for k in tuple(recall_cutoffs) + (None,):
+        all_scores['recall@' + _cutoff_name(k)] = metrics['Success@' + _cutoff_name(k)]
+    all_scores['QueriesRanked'] = metrics['QueriesRanked']
+    if record:
+        all_scores['record'] = " / ".join(str(round(all_scores['recall@' + _cutoff_name(k)] * 100, 2))
+                                          for k in tuple(recall_cutoffs) + (None,))
+    return all_scores
+
+
+def ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages, mrr_depth=10,
+                    recall_cutoffs=(1, 50), record=False):
+    """MRR@`mrr_depth` and recall@k of a qid -> ranked pids dict, with the keys of the old compute_metrics"""
+    qids, ranked = ranked_matrix(qids_to_ranked_candidate_passages)
+    metrics = evaluate(qids_to_relevant_passageids, qids, ranked, cutoffs=(mrr_depth,) + tuple(recall_cutoffs) + (None,))
+    return legacy_scores(metrics, mrr_depth=mrr_depth, recall_cutoffs=recall_cutoffs, record=record)
+
+
+def hit_list_metrics(results_list, cutoffs=(1, 5, 10, 20, 50, 100)):
+    """Vectorized `Eval_Tool.get_matrics` over per-query hit lists (answer found or not per rank),
+    same keys and definitions: MAP_n divides by n and nDCG_n by the sum of log2(i + 2)"""
+    width = max([len(hits) for hits in results_list] + list(cutoffs))
+    hits = np.zeros((len(results_list), width), dtype=bool)
+    for i, row in enumerate(results_list):
+        hits[i, :len(row)] = row
+    ranks = np.arange(1, width + 1, dtype=np.float64)
+    first = np.where(hits.any(axis=1), hits.argmax(axis=1) + 1, width + 1)
+    cum_hits = np.cumsum(hits, axis=1)
+    gains = np.where(hits, 1.0 / np.log2(ranks + 1), 0.0)
+    ap_terms = np.where(hits, cum_hits / ranks, 0.0)
+    metrics = {'MRR_n': lambda n: np.where(first <= n, 1.0 / first, 0.0),
+               'MAP_n': lambda n: ap_terms[:, :n].sum(axis=1) / n,
+               'DCG_n': lambda n: gains[:, :n].sum(axis=1),
+               'nDCG_n': lambda n: gains[:, :n].sum(axis=1) / np.log2(np.arange(n) + 2.0).sum(),
+               'P_n': lambda n: cum_hits[:, n - 1] / n}
+    result_dict = {}
+    for metric_name, function in metrics.items():
+        for p in cutoffs:
+            result_dict[metric_name + '@_' + str(p)] = float(function(p).mean())
+    return result_dict
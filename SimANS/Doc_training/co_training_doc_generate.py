@@ -32,6 +32,7 @@ from utils.dpr_utils import (
     get_model_obj,
     CheckpointState
 )
+from utils.faiss_index import add_index_args
 import collections
 
 studentBatch = collections.namedtuple(
@@ -166,8 +167,11 @@ def get_arguments():
 
     parser.add_argument("--load_cache", default=False, action="store_true")
     parser.add_argument("--ann_dir", type=str, default="", help="For distant debugging.")
+    parser.add_argument("--negative_file_format", type=str, default='tsv', choices=['tsv', 'bin'],
+                        help="train_ce_{step}.tsv or the binary train_ce_{step}.negbin (utils/negative_file.py)")
 
     parser.add_argument("--global_step", type=int, default=0, help="For distant debugging.")
+    add_index_args(parser)
     args = parser.parse_args()
 
     return args
@@ -266,7 +270,8 @@ def get_new_dataset(args, model, global_step, renew_tools):
     model.eval()
     logger.info(" model_path = %s", model_path)
     with torch.no_grad():
-        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model)
+        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model, step=global_step,
+                                                                                    checkpoint=model_path)
         torch.distributed.barrier()
         if is_first_worker():
             train_q, train_q_embed, train_q_embed2id = renew_tools.get_question_embedding(args,
@@ -276,7 +281,8 @@ def get_new_dataset(args, model, global_step, renew_tools):
                                                                                     model, args.dev_qa_path, mode='dev')
 
             gpu_index_flat, passage_embedding2id = renew_tools.get_new_faiss_index(args, passage_embedding,
-                                                                                   passage_embedding_id)
+                                                                                   passage_embedding_id,
+                                                                                   queries=dev_q_embed)
             data_dir = os.path.abspath(os.path.dirname(args.train_qa_path))
             ground_truth_path = os.path.join(data_dir, 'msmarco-doctrain-qrels.tsv')
             renew_tools.get_question_topk(train_q, train_q_embed, train_q_embed2id, ground_truth_path,
@@ -309,7 +315,8 @@ def main():
     temp_slice_dir = os.path.join(args.ann_dir, 'temp')
     passages_ctx_path = os.path.join(args.passage_path, 'msmarco-docs.tsv')
     renew_tools = RenewTools(passages_ctx_path=passages_ctx_path, tokenizer=tokenizer,
-                             output_dir=args.ann_dir, temp_dir=temp_slice_dir, max_doc_character=args.max_doc_character)
+                             output_dir=args.ann_dir, temp_dir=temp_slice_dir, max_doc_character=args.max_doc_character,
+                             negative_file_format=args.negative_file_format)
     dist.barrier()
     global_step = args.global_step
     if global_step > args.max_steps:
@@ -44,6 +44,7 @@ from utils.dpr_utils import (
 from utils.MARCO_until_Doc import (
     Doc_v2Dataset
 )
+from utils.negative_file import negative_file_path
 import collections
 
 studentBatch = collections.namedtuple(
@@ -138,7 +139,7 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
         teacher_optimizer, num_warmup_steps=0.1 * teacher_max_step, num_training_steps=teacher_max_step
     )
     if global_step != 0:
-        train_data_path = os.path.join(args.ann_dir, 'train_ce_' + str(global_step) + '.tsv')
+        train_data_path = negative_file_path(args.ann_dir, 'train', global_step, args.negative_file_format)
 
         model_path = os.path.join(args.output_dir, 'checkpoint-' + str(global_step))
         teacher_model_path = os.path.join(args.output_dir, 'checkpoint-reranker' + str(global_step))
@@ -149,12 +150,14 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
 
         train_dataset = Doc_v2Dataset(train_data_path, tokenizer, num_hard_negatives=args.number_neg, a=args.a, b=args.b,
                                            trainer_id=args.local_rank, trainer_num=args.world_size,
-                                           corpus_path=args.passage_path, rand_pool=100)
+                                           corpus_path=args.passage_path, rand_pool=100,
+                                        token_cache_dir=args.token_cache_dir)
 
     else:
         train_dataset = Doc_v2Dataset(args.origin_data_dir, tokenizer, num_hard_negatives=args.number_neg, a=args.a, b=args.b,
                                            trainer_id=args.local_rank, trainer_num=args.world_size,
-                                           corpus_path=args.passage_path, rand_pool=100)
+                                           corpus_path=args.passage_path, rand_pool=100,
+                                        token_cache_dir=args.token_cache_dir)
     train_sample = RandomSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sample,
                                   collate_fn=Doc_v2Dataset.get_collate_fn(args),
@@ -570,6 +573,10 @@ def get_arguments():
     parser.add_argument("--teacher_learning_rate", default=0, type=float)
     parser.add_argument("--load_cache", default=False, action="store_true")
     parser.add_argument("--ann_dir", type=str, default="", help="For distant debugging.")
+    parser.add_argument("--negative_file_format", type=str, default='tsv', choices=['tsv', 'bin'],
+                        help="train_ce_{step}.tsv or the binary train_ce_{step}.negbin (utils/negative_file.py)")
+    parser.add_argument("--token_cache_dir", type=str, default=None,
+                        help="directory of caches built by utils/token_cache.py, tokenize on the fly if unset")
 
     parser.add_argument("--global_step", type=int, default=0, help="For distant debugging.")
     parser.add_argument("--a", type=float, default=0.5, help="For a in SimRAS.")
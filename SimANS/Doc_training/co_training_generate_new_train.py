@@ -3,6 +3,7 @@ import sys
 from torch.utils.data.dataset import Dataset
 
 sys.path += ['../']
+import time
 import json
 import logging
 import os
@@ -14,9 +15,16 @@ sys.path.append(os.path.abspath(os.path.dirname(os.getcwd())))
 #
 from tqdm import tqdm
 import torch.distributed as dist
+from utils.retrieval_metrics import ranking_scores
 from utils.util import (
     is_first_worker,
 )
+from utils.passage_store import load_passage_store, StorePassages
+from utils.negative_file import NegativeFileWriter, negative_file_path
+from utils.embedding_shards import (
+    EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, shard_range, write_manifest
+)
+from utils.faiss_index import build_index_from_args
 import pickle
 from torch.utils.data import DataLoader
 
@@ -113,12 +121,16 @@ class TextDataset(torch.utils.data.Dataset):
         return fn
 
 
-def embed_passages(args, passages, model, tokenizer):
+def embed_passages(args, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = 256
     dataset = TextDataset(passages, tokenizer, 512)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=20,
                             collate_fn=TextDataset.get_collate_fn(args))
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
     with torch.no_grad():
         for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
@@ -130,11 +142,18 @@ def embed_passages(args, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 1000 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
@@ -160,7 +179,7 @@ def load_pos_examples(q_type='train'):
 
 def write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_scores,
                   q_text, pos_qp, pos_qp_add, q_type, save_path='/quantus-nfs/zh/AN_dpr/data_train/',
-                  global_step = 0, is_paced=False):
+                  global_step = 0, is_paced=False, file_format='tsv'):
     q_text_dict={}
     for item in q_text:
         q_text_dict[item[0]]=item[1]
@@ -187,7 +206,17 @@ def write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_sc
 
         if sum(temp_pos.values())>0:
             result_dict_list.append(temp_result_dict)
-    out_path = os.path.join(save_path, q_type+'_ce_'+str(global_step) + '.tsv')
+    out_path = negative_file_path(save_path, q_type, global_step, file_format)
+    if file_format == 'bin':
+        writer = NegativeFileWriter(out_path)
+        for temp_result_dict in tqdm(result_dict_list):
+            writer.add(temp_result_dict['q_id'], temp_result_dict['question'],
+                       [int(pair[0]) for pair in temp_result_dict['positive_ctxs_id']],
+                       [float(pair[1]) for pair in temp_result_dict['positive_ctxs_id']],
+                       [int(pair[0]) for pair in temp_result_dict['hard_negative_ctxs_id']],
+                       [float(pair[1]) for pair in temp_result_dict['hard_negative_ctxs_id']])
+        writer.close()
+        return
     with open(out_path, 'w', encoding='utf-8') as f:
         for i, temp_result_dict in enumerate(tqdm(result_dict_list)):
             f.write('%s\t%s\t%s\t%s\n' % (temp_result_dict['q_id'],
@@ -218,55 +247,9 @@ def load_reference_from_stream(path_to_reference):
 
 
 def compute_metrics(qids_to_relevant_passageids, qids_to_ranked_candidate_passages):
-    """Compute MRR metric
-    Args:
-    p_qids_to_relevant_passageids (dict): dictionary of query-passage mapping
-        Dict as read in with load_reference or load_reference_from_stream
-    p_qids_to_ranked_candidate_passages (dict): dictionary of query-passage candidates
-    Returns:
-        dict: dictionary of metrics {'MRR': <MRR Score>}
-    """
-    MaxMRRRank = 100
-    all_scores = {}
-    MRR = 0
-    qids_with_relevant_passages = 0
-    ranking = []
-    recall_q_top1 = set()
-    recall_q_top100 = set()
-    recall_q_all = set()
-
-    for qid in qids_to_ranked_candidate_passages:
-        if qid in qids_to_relevant_passageids:
-            ranking.append(0)
-            target_pid = qids_to_relevant_passageids[qid]
-            candidate_pid = qids_to_ranked_candidate_passages[qid]
-            for i in range(0, MaxMRRRank):
-                if candidate_pid[i] in target_pid:
-                    MRR += 1.0 / (i + 1)
-                    ranking.pop()
-                    ranking.append(i + 1)
-                    break
-            for i, pid in enumerate(candidate_pid):
-                if pid in target_pid:
-                    recall_q_all.add(qid)
-                    if i < 100:
-                        recall_q_top100.add(qid)
-                    if i == 0:
-                        recall_q_top1.add(qid)
-                    break
-    if len(ranking) == 0:
-        raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
-
-    MRR = MRR / len(qids_to_relevant_passageids)
-    recall_top1 = len(recall_q_top1) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top100 = len(recall_q_top100) * 1.0 / len(qids_to_relevant_passageids)
-    recall_all = len(recall_q_all) * 1.0 / len(qids_to_relevant_passageids)
-    all_scores['MRR @100'] = MRR
-    all_scores["recall@1"] = recall_top1
-    all_scores["recall@100"] = recall_top100
-    all_scores["recall@all"] = recall_all
-    all_scores['QueriesRanked'] = len(qids_to_ranked_candidate_passages)
-    return all_scores
+    """MRR@100 and recall@1/100/all, see retrieval_metrics.py"""
+    return ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages,
+                          mrr_depth=100, recall_cutoffs=(1, 100))
 
 def load_id_text(file_name):
     """load tsv files"""
@@ -279,9 +262,11 @@ def load_id_text(file_name):
     return id_text
 
 class RenewTools:
-    def __init__(self, passages_ctx_path, tokenizer, output_dir, temp_dir, max_doc_character=10000):
+    def __init__(self, passages_ctx_path, tokenizer, output_dir, temp_dir, max_doc_character=10000,
+                 negative_file_format='tsv'):
         self.passages = self.load_passage(passages_ctx_path)
         self.tokenizer = tokenizer
+        self.negative_file_format = negative_file_format
         self.output_dir = output_dir
         self.temp_dir = temp_dir
         self.max_doc_character = max_doc_character
@@ -292,46 +277,28 @@ class RenewTools:
                 os.makedirs(temp_dir)
         dist.barrier()
 
-    def get_passage_embedding(self, args, model):
+    def get_passage_embedding(self, args, model, step=None, checkpoint=None):
+        """`checkpoint` is the file `model` was loaded from, an interrupted encode resumes only for the
+        same file; None (weights in memory) encodes every passage again"""
         if args.load_cache:
             pass
         else:
-            shard_size = len(self.passages) // args.world_size
-            start_idx = args.rank * shard_size
-            end_idx = start_idx + shard_size
-            if args.rank == args.world_size - 1:
-                end_idx = len(self.passages)
+            start_idx, end_idx = shard_range(len(self.passages), args.rank, args.world_size)
             passages_piece = self.passages[start_idx:end_idx]
             logger.info(f'Embedding generation for {len(passages_piece)} passages from idx {start_idx} to {end_idx}')
-            allids, allembeddings = embed_passages(args, passages_piece, model, self.tokenizer)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(str(args.rank), 'passage_embedding'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allembeddings, handle, protocol=4)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(str(args.rank), 'passage_embedding_id'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allids, handle, protocol=4)
-            logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
-        # dist.barrier()
+            writer = EmbeddingShardWriter(self.temp_dir, 'passage_embedding', args.rank, start_idx, end_idx,
+                                          len(self.passages),
+                                          tag=checkpoint_fingerprint(checkpoint) if checkpoint else None)
+            embed_passages(args, passages_piece, model, self.tokenizer, writer=writer)
+            logger.info(f'Total passages processed {writer.completed}.')
+        dist.barrier()
         passage_embedding, passage_embedding_id = None, None
         if is_first_worker():
-            logger.info('load_passage_begin')
-            passage_embedding_list = []
-            passage_embedding_id_list = []
-            for i in tqdm(range(args.world_size)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_list.append(b)
-            logger.info('load_passage_id_begin')
-            for i in tqdm(range(args.world_size)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding_id'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_id_list.append(b)
-            passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-            passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+            if not args.load_cache:
+                write_manifest(self.temp_dir, 'passage_embedding', args.world_size, len(self.passages), step=step)
+            # one read-only memmap over every rank's rows, nothing is merged in memory
+            shards = EmbeddingShards(self.temp_dir, 'passage_embedding')
+            passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
             logger.info('load_passage_done')
         return passage_embedding, passage_embedding_id
 
@@ -360,26 +327,19 @@ class RenewTools:
         allids = np.array([x for idlist in allids for x in idlist])
         return allembeddings, allids
 
-    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id):
+    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id, queries=None):
         logger.info("***** end passage_embedding reorder  *****")
 
-        dim = passage_embedding.shape[1]
         faiss.omp_set_num_threads(90)
-        cpu_index = faiss.IndexFlatIP(dim)
-
-        co = faiss.GpuMultipleClonerOptions()
-        co.shard = True
-        # co.useFloat16 = True
-        gpu_index_flat = faiss.index_cpu_to_all_gpus(  # build the index
-            cpu_index,
-            co=co
-        )
         logger.info("***** begin add passages  *****")
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
+        gpu_index_flat = build_index_from_args(args, passage_embedding, queries=queries)
         logger.info("***** end build index  *****")
         return gpu_index_flat, passage_embedding2id
 
     def load_passage(self, passages_ctx_path):
+        text_store = load_passage_store(passages_ctx_path)
+        if text_store is not None:
+            return StorePassages(text_store)
         passages = []
         with open(passages_ctx_path) as inp:
             for line in tqdm(inp):
@@ -444,4 +404,5 @@ class RenewTools:
         train_pos_qp, train_pos_qp_add = load_pos_examples(mode)
         write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_scores, train_questions,
                           train_pos_qp, train_pos_qp_add, q_type=mode,
-                          save_path=self.output_dir,global_step=step_num, is_paced=is_paced)
+                          save_path=self.output_dir,global_step=step_num, is_paced=is_paced,
+                          file_format=self.negative_file_format)
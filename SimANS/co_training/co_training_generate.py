@@ -3,6 +3,7 @@ import sys
 from torch.utils.data.dataset import Dataset
 
 sys.path += ['../']
+import time
 import json
 import logging
 import os
@@ -17,7 +18,19 @@ import torch.distributed as dist
 from utils.util import (
     is_first_worker,
 )
+from utils.passage_store import load_passage_store, StorePassages
+from utils.negative_file import NegativeFileWriter, negative_file_path
+from utils.embedding_shards import (
+    EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, shard_range, write_manifest, reorder_by_ids
+)
+from utils.faiss_index import build_index_from_args
+from utils.retrieval_metrics import RetrievalEvaluator, legacy_scores, ranking_scores
+from utils.incremental_embeddings import (
+    EmbeddingCache, CachedRowWriter, PassageSubset, CANDIDATES_FILE, PLAN_FILE, budget_recall
+)
 import pickle
+import queue
+import threading
 from torch.utils.data import DataLoader
 
 logger = logging.getLogger("__main__")
@@ -94,12 +107,16 @@ class TextDataset(torch.utils.data.Dataset):
         return fn
 
 
-def embed_passages(args, passages, model, tokenizer):
+def embed_passages(args, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = 256
     dataset = TextDataset(passages, tokenizer, 128)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=20,
                             collate_fn=TextDataset.get_collate_fn(args))
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
     with torch.no_grad():
         for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
@@ -111,11 +128,18 @@ def embed_passages(args, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 1000 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
@@ -150,47 +174,128 @@ def load_pos_examples(q_type='train'):
     return pos_qp, pos_qp_add
 
 
+def negative_record(q_id, question, p_id_list, score_list, pos_qp, pos_qp_add):
+    """positives and mined hard negatives of one query among its top-200 candidates"""
+    temp_result_dict = {}
+    temp_result_dict['q_id'] = str(q_id)
+    temp_result_dict['question'] = question
+    temp_result_dict['positive_ctxs_id'] = []
+    temp_result_dict['hard_negative_ctxs_id'] = []
+    temp_result_dict['hard_negative_ctxs_score'] = []
+    temp_pos_list = pos_qp[q_id] + pos_qp_add.get(q_id, [])
+    temp_pos = {ele:0 for ele in temp_pos_list}
+
+    for j, (doc_id, doc_score) in enumerate(zip(p_id_list[:200], score_list[:200])):
+        if doc_id in temp_pos:
+            temp_pos[doc_id] = doc_score
+        else:
+            # text, title = p_text[doc_id],p_title.get(doc_id, '-')
+            temp_result_dict['hard_negative_ctxs_id'].append((str(doc_id), str(doc_score)))
+            # temp_result_dict['hard_negative_ctxs_score'].append(str(qids_to_ranked_candidate_scores[q_id][j]))
+
+    for doc_id in temp_pos:
+        # text, title = p_text[doc_id], p_title.get(doc_id, '-')
+        temp_result_dict['positive_ctxs_id'].append((str(doc_id), str(temp_pos[doc_id])))
+
+    #else:
+    #    add_neg_num = 15 - len(temp_result_dict['hard_negative_ctxs_id'])
+    #    temp_result_dict['hard_negative_ctxs_id'].extend(hard_negatives_set[-add_neg_num:])
+    return temp_result_dict
+
+
+class NegativeSink:
+    """Writes the records of `negative_record` as they come to {q_type}_ce_{global_step} in
+    `file_format` (nothing if None); with `in_memory` `close` also returns them as a `NegativeFile`"""
+
+    def __init__(self, save_path, q_type, global_step=0, file_format='tsv', in_memory=False):
+        self.file_format = file_format
+        self.in_memory = in_memory
+        self.writer = None
+        self.tsv = None
+        if file_format == 'bin' or in_memory:
+            self.writer = NegativeFileWriter(negative_file_path(save_path, q_type, global_step, 'bin'))
+        if file_format == 'tsv':
+            self.tsv = open(negative_file_path(save_path, q_type, global_step, file_format), 'w', encoding='utf-8')
+
+    def add(self, temp_result_dict):
+        if self.writer is not None:
+            self.writer.add(temp_result_dict['q_id'], temp_result_dict['question'],
+                            [int(pair[0]) for pair in temp_result_dict['positive_ctxs_id']],
+                            [float(pair[1]) for pair in temp_result_dict['positive_ctxs_id']],
+                            [int(pair[0]) for pair in temp_result_dict['hard_negative_ctxs_id']],
+                            [float(pair[1]) for pair in temp_result_dict['hard_negative_ctxs_id']])
+        if self.tsv is not None:
+            self.tsv.write('%s\t%s\t%s\t%s\n' % (temp_result_dict['q_id'],
+                                                 temp_result_dict['question'],
+                                                 ",".join([pair[0]+' '+pair[1] for pair in temp_result_dict['positive_ctxs_id']]),
+                                                 ",".join([pair[0]+' '+pair[1] for pair in temp_result_dict['hard_negative_ctxs_id']])))
+
+    def close(self):
+        negatives = None
+        if self.writer is not None:
+            if self.file_format == 'bin':
+                self.writer.close()
+            if self.in_memory:
+                negatives = self.writer.to_negative_file()
+        if self.tsv is not None:
+            self.tsv.close()
+        return negatives
+
+
+# end of stream marker of the `get_question_topk_pipelined` queues
+_END = object()
+
+
+def _get(in_queue, errors):
+    # a blocking get that gives up once another stage failed
+    while True:
+        if errors:
+            raise RuntimeError('another pipeline stage failed')
+        try:
+            return in_queue.get(timeout=1)
+        except queue.Empty:
+            pass
+
+
+def _put(out_queue, item, errors):
+    while True:
+        if errors:
+            raise RuntimeError('another pipeline stage failed')
+        try:
+            return out_queue.put(item, timeout=1)
+        except queue.Full:
+            pass
+
+
+def _pipeline_stage(work, in_queue, out_queue, errors):
+    """Thread body: `work` on every item of `in_queue` until `_END`, results go to `out_queue` if any"""
+    try:
+        while True:
+            item = _get(in_queue, errors)
+            if item is _END:
+                break
+            result = work(item)
+            if out_queue is not None:
+                _put(out_queue, result, errors)
+        if out_queue is not None:
+            _put(out_queue, _END, errors)
+    except BaseException as e:
+        errors.append(e)
+
+
 def write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_scores,
                   q_text, pos_qp, pos_qp_add, q_type, save_path='/quantus-nfs/zh/AN_dpr/data_train/',
-                  global_step = 0):
+                  global_step = 0, file_format='tsv', in_memory=False):
+    """Write {q_type}_ce_{global_step} in `file_format` (nothing if None); with `in_memory` the same
+    negatives are also returned as an in-memory `NegativeFile`"""
     q_text_dict={}
     for item in q_text:
         q_text_dict[item[0]]=item[1]
-    result_dict_list = []
+    sink = NegativeSink(save_path, q_type, global_step, file_format=file_format, in_memory=in_memory)
     for i, (q_id, p_id_list) in enumerate(tqdm(qids_to_ranked_candidate_passages.items())):
-        temp_result_dict = {}
-        temp_result_dict['q_id'] = str(q_id)
-        temp_result_dict['question'] = q_text_dict[q_id]
-        temp_result_dict['positive_ctxs_id'] = []
-        temp_result_dict['hard_negative_ctxs_id'] = []
-        temp_result_dict['hard_negative_ctxs_score'] = []
-        temp_pos_list = pos_qp[q_id] + pos_qp_add.get(q_id, [])
-        temp_pos = {ele:0 for ele in temp_pos_list}
-
-        score_list = qids_to_ranked_candidate_scores[q_id]
-        for j, (doc_id, doc_score) in enumerate(zip(p_id_list[:200], score_list[:200])):
-            if doc_id in temp_pos:
-                temp_pos[doc_id] = doc_score
-            else:
-                # text, title = p_text[doc_id],p_title.get(doc_id, '-')
-                temp_result_dict['hard_negative_ctxs_id'].append((str(doc_id), str(doc_score)))
-                # temp_result_dict['hard_negative_ctxs_score'].append(str(qids_to_ranked_candidate_scores[q_id][j]))
-
-        for doc_id in temp_pos:
-            # text, title = p_text[doc_id], p_title.get(doc_id, '-')
-            temp_result_dict['positive_ctxs_id'].append((str(doc_id), str(temp_pos[doc_id])))
-
-        #else:
-        #    add_neg_num = 15 - len(temp_result_dict['hard_negative_ctxs_id'])
-        #    temp_result_dict['hard_negative_ctxs_id'].extend(hard_negatives_set[-add_neg_num:])
-        result_dict_list.append(temp_result_dict)
-    out_path = os.path.join(save_path, q_type+'_ce_'+str(global_step) + '.tsv')
-    with open(out_path, 'w', encoding='utf-8') as f:
-        for i, temp_result_dict in enumerate(tqdm(result_dict_list)):
-            f.write('%s\t%s\t%s\t%s\n' % (temp_result_dict['q_id'],
-                                          temp_result_dict['question'],
-                                          ",".join([pair[0]+' '+pair[1] for pair in temp_result_dict['positive_ctxs_id']]),
-                                          ",".join([pair[0]+' '+pair[1] for pair in temp_result_dict['hard_negative_ctxs_id']])))
+        sink.add(negative_record(q_id, q_text_dict[q_id], p_id_list, qids_to_ranked_candidate_scores[q_id],
+                                 pos_qp, pos_qp_add))
+    return sink.close()
 
 
 def load_reference_from_stream(path_to_reference):
@@ -215,55 +320,8 @@ def load_reference_from_stream(path_to_reference):
 
 
 def compute_metrics(qids_to_relevant_passageids, qids_to_ranked_candidate_passages):
-    """Compute MRR metric
-    Args:
-    p_qids_to_relevant_passageids (dict): dictionary of query-passage mapping
-        Dict as read in with load_reference or load_reference_from_stream
-    p_qids_to_ranked_candidate_passages (dict): dictionary of query-passage candidates
-    Returns:
-        dict: dictionary of metrics {'MRR': <MRR Score>}
-    """
-    MaxMRRRank = 10
-    all_scores = {}
-    MRR = 0
-    qids_with_relevant_passages = 0
-    ranking = []
-    recall_q_top1 = set()
-    recall_q_top50 = set()
-    recall_q_all = set()
-
-    for qid in qids_to_ranked_candidate_passages:
-        if qid in qids_to_relevant_passageids:
-            ranking.append(0)
-            target_pid = qids_to_relevant_passageids[qid]
-            candidate_pid = qids_to_ranked_candidate_passages[qid]
-            for i in range(0, MaxMRRRank):
-                if candidate_pid[i] in target_pid:
-                    MRR += 1.0 / (i + 1)
-                    ranking.pop()
-                    ranking.append(i + 1)
-                    break
-            for i, pid in enumerate(candidate_pid):
-                if pid in target_pid:
-                    recall_q_all.add(qid)
-                    if i < 50:
-                        recall_q_top50.add(qid)
-                    if i == 0:
-                        recall_q_top1.add(qid)
-                    break
-    if len(ranking) == 0:
-        raise IOError("No matching QIDs found. Are you sure you are scoring the evaluation set?")
-
-    MRR = MRR / len(qids_to_relevant_passageids)
-    recall_top1 = len(recall_q_top1) * 1.0 / len(qids_to_relevant_passageids)
-    recall_top50 = len(recall_q_top50) * 1.0 / len(qids_to_relevant_passageids)
-    recall_all = len(recall_q_all) * 1.0 / len(qids_to_relevant_passageids)
-    all_scores['MRR @10'] = MRR
-    all_scores["recall@1"] = recall_top1
-    all_scores["recall@50"] = recall_top50
-    all_scores["recall@all"] = recall_all
-    all_scores['QueriesRanked'] = len(qids_to_ranked_candidate_passages)
-    return all_scores
+    """MRR@10 and recall@1/50/all, see utils/retrieval_metrics.py"""
+    return ranking_scores(qids_to_relevant_passageids, qids_to_ranked_candidate_passages)
 
 def load_id_text(file_name):
     """load tsv files"""
@@ -276,11 +334,16 @@ def load_id_text(file_name):
     return id_text
 
 class RenewTools:
-    def __init__(self, passages_title_path,passages_ctx_path, tokenizer, output_dir, temp_dir):
+    def __init__(self, passages_title_path,passages_ctx_path, tokenizer, output_dir, temp_dir,
+                 negative_file_format='tsv'):
         self.passages = self.load_passage(passages_title_path,passages_ctx_path)
         self.tokenizer = tokenizer
+        self.negative_file_format = negative_file_format
         self.output_dir = output_dir
         self.temp_dir = temp_dir
+        # set by a budgeted refresh: keep the train candidates for the next plan
+        self.track_candidates = False
+        self.reencode_rows = None
         if is_first_worker():
             if not os.path.exists(output_dir):
                 os.makedirs(output_dir)
@@ -288,55 +351,124 @@ class RenewTools:
                 os.makedirs(temp_dir)
         dist.barrier()
 
-    def get_passage_embedding(self, args, model):
+    def get_passage_embedding(self, args, model, step=None, checkpoint=None):
+        """`checkpoint` is the file `model` was loaded from, an interrupted encode resumes only for the
+        same file; None (weights in memory) encodes every passage again"""
+        if getattr(args, 'reencode_budget', 0) > 0 and not args.load_cache:
+            return self.get_budgeted_passage_embedding(args, model, step=step, checkpoint=checkpoint)
         if args.load_cache:
             pass
         else:
-            shard_size = len(self.passages) // args.world_size
-            start_idx = args.rank * shard_size
-            end_idx = start_idx + shard_size
-            if args.rank == args.world_size - 1:
-                end_idx = len(self.passages)
+            start_idx, end_idx = shard_range(len(self.passages), args.rank, args.world_size)
             passages_piece = self.passages[start_idx:end_idx]
             logger.info(f'Embedding generation for {len(passages_piece)} passages from idx {start_idx} to {end_idx}')
-            allids, allembeddings = embed_passages(args, passages_piece, model, self.tokenizer)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(str(args.rank), 'passage_embedding'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allembeddings, handle, protocol=4)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(str(args.rank), 'passage_embedding_id'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allids, handle, protocol=4)
-            logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
-        # dist.barrier()
+            writer = EmbeddingShardWriter(self.temp_dir, 'passage_embedding', args.rank, start_idx, end_idx,
+                                          len(self.passages),
+                                          tag=checkpoint_fingerprint(checkpoint) if checkpoint else None)
+            embed_passages(args, passages_piece, model, self.tokenizer, writer=writer)
+            logger.info(f'Total passages processed {writer.completed}.')
+        dist.barrier()
         passage_embedding, passage_embedding_id = None, None
         if is_first_worker():
-            logger.info('load_passage_begin')
-            passage_embedding_list = []
-            passage_embedding_id_list = []
-            for i in tqdm(range(args.world_size)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_list.append(b)
-            logger.info('load_passage_id_begin')
-            for i in tqdm(range(args.world_size)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'passage_embedding_id'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_id_list.append(b)
-            passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-            passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+            if not args.load_cache:
+                write_manifest(self.temp_dir, 'passage_embedding', args.world_size, len(self.passages), step=step)
+            # one read-only memmap over every rank's rows, nothing is merged in memory
+            shards = EmbeddingShards(self.temp_dir, 'passage_embedding')
+            passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
             logger.info('load_passage_done')
         return passage_embedding, passage_embedding_id
 
-    def get_question_embeddings_sub(self, args, questions, model):
+    def _load_candidates(self, cache):
+        path = os.path.join(self.temp_dir, CANDIDATES_FILE)
+        return cache.positions_of(np.load(path)) if os.path.exists(path) else None
+
+    def _write_staleness(self, step, report):
+        path = os.path.join(self.output_dir, 'embedding_staleness' + str(step) + '.json')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                report = dict(json.load(f), **report)
+        with open(path, 'w') as f:
+            json.dump(report, f, indent=2)
+        logger.info('Embedding staleness at step %s: %s', step, report)
+
+    def get_budgeted_passage_embedding(self, args, model, step=None, checkpoint=None):
+        """Re-encode only `--reencode_budget` passages and reuse the cached embeddings of the others.
+
+        Rank 0 plans the rows (utils/incremental_embeddings.py): the train top-k candidates of the
+        previous refresh with the oldest embeddings first, plus a slice rotating over the corpus.
+        The first refresh, and every `--full_refresh_every`-th, still encodes the whole corpus; at
+        those `report_reencode_recall` can compare the plan against it.
+        """
+        self.track_candidates = True
+        self.reencode_rows = None
+        plan_path = os.path.join(self.temp_dir, PLAN_FILE)
+        if is_first_worker():
+            cache = EmbeddingCache(self.temp_dir)
+            cache.promote()
+            candidates = self._load_candidates(cache) if cache.exists else None
+            rows = cache.plan(step, args.reencode_budget, args.reencode_rotate_fraction, candidates) \
+                if cache.exists else np.zeros(0, dtype=np.int64)
+            full = not cache.exists or (args.full_refresh_every > 0 and
+                                        cache.meta['refreshes'] % args.full_refresh_every == 0)
+            np.savez(plan_path, rows=rows, full=full)
+        dist.barrier()
+        plan = np.load(plan_path)
+        rows, full = plan['rows'], bool(plan['full'])
+        cache = EmbeddingCache(self.temp_dir)
+        if full:
+            start_idx, end_idx = shard_range(len(self.passages), args.rank, args.world_size)
+            logger.info(f'Full refresh of {end_idx - start_idx} passages from idx {start_idx} to {end_idx}')
+            writer = EmbeddingShardWriter(self.temp_dir, 'passage_embedding', args.rank, start_idx, end_idx,
+                                          len(self.passages),
+                                          tag=checkpoint_fingerprint(checkpoint) if checkpoint else None)
+            embed_passages(args, self.passages[start_idx:end_idx], model, self.tokenizer, writer=writer)
+        else:
+            start_idx, end_idx = shard_range(len(rows), args.rank, args.world_size)
+            logger.info(f'Re-encoding {end_idx - start_idx} of the {len(rows)} planned passages')
+            writer = CachedRowWriter(cache, rows[start_idx:end_idx], step)
+            embed_passages(args, PassageSubset(self.passages, rows[start_idx:end_idx]), model, self.tokenizer,
+                           writer=writer)
+        dist.barrier()
+        passage_embedding, passage_embedding_id = None, None
+        if is_first_worker():
+            if full:
+                manifest = write_manifest(self.temp_dir, 'passage_embedding', args.world_size, len(self.passages),
+                                          step=step)
+                # the cache keeps serving the old embeddings until the next refresh promotes this one
+                cache.mark_pending(manifest, self.temp_dir, 'passage_embedding')
+                shards = EmbeddingShards(self.temp_dir, 'passage_embedding')
+                passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
+                self.reencode_rows = rows if cache.exists else None
+                self._write_staleness(step, {'step': step, 'full_refresh': True, 'planned': int(len(rows))})
+            else:
+                passage_embedding, passage_embedding_id = cache.open_embeddings(), cache.ids()
+                report = cache.staleness(step, self._load_candidates(cache))
+                self._write_staleness(step, dict(report, full_refresh=False, reencoded=int(len(rows))))
+        return passage_embedding, passage_embedding_id
+
+    def report_reencode_recall(self, args, model, step, seed=0):
+        """At a full refresh of a budgeted run, recall@200 of mining after re-encoding only the planned
+        rows against mining with the full refresh, on `--reencode_recall_queries` train queries"""
+        if self.reencode_rows is None:
+            return None
+        questions = self.load_questions(args.train_qa_path, mode='train')
+        if len(questions) > args.reencode_recall_queries:
+            sample = np.random.RandomState(seed).choice(len(questions), args.reencode_recall_queries, replace=False)
+            questions = [questions[i] for i in np.sort(sample)]
+        question_embedding, _ = self.get_question_embeddings_sub(args, questions, model)
+        fresh = EmbeddingShards(self.temp_dir, 'passage_embedding').embeddings
+        recall = budget_recall(fresh, EmbeddingCache(self.temp_dir).open_embeddings(), self.reencode_rows,
+                               question_embedding, k=200, num_queries=args.reencode_recall_queries,
+                               block_size=args.exact_block_size)
+        self._write_staleness(step, {'budget_mining_recall@200': recall})
+        return recall
+
+    def iter_question_embeddings(self, args, questions, model):
+        """(ids, embeddings) of the questions, one encoded batch at a time"""
         dataset = Question_dataset(questions, self.tokenizer)
         dataloader = DataLoader(dataset, batch_size=512, drop_last=False,
                                 num_workers=15, collate_fn=Question_dataset.get_collate_fn(args))
         total = 0
-        allids, allembeddings = [], []
         with torch.no_grad():
             for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
                 inputs = {"input_ids": text_ids.long().to(args.device),
@@ -347,43 +479,36 @@ class RenewTools:
                     embs = model.query_emb(**inputs)
                 embeddings = embs.detach().cpu()
                 total += len(ids)
-                allids.append(ids)
-                allembeddings.append(embeddings)
                 if k % 1000 == 0:
                     logger.info('Encoded question %d', total)
+                yield ids, embeddings.numpy()
 
-        allembeddings = torch.cat(allembeddings, dim=0).numpy()
+    def get_question_embeddings_sub(self, args, questions, model):
+        allids, allembeddings = [], []
+        for ids, embeddings in self.iter_question_embeddings(args, questions, model):
+            allids.append(ids)
+            allembeddings.append(embeddings)
+        allembeddings = np.concatenate(allembeddings, axis=0)
         allids = np.array([x for idlist in allids for x in idlist])
         return allembeddings, allids
 
-    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id):
+    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id, queries=None):
 
         logger.info("***** Begin passage_embedding reorder *****")
-        new_passage_embedding = passage_embedding.copy()
-        for i in range(passage_embedding.shape[0]):
-            new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
-        del (passage_embedding)
-        passage_embedding = new_passage_embedding
+        passage_embedding = reorder_by_ids(passage_embedding, passage_embedding2id)
         passage_embedding2id = np.arange(passage_embedding.shape[0])
         logger.info("***** end passage_embedding reorder  *****")
 
-        dim = passage_embedding.shape[1]
         faiss.omp_set_num_threads(90)
-        cpu_index = faiss.IndexFlatIP(dim)
-
-        co = faiss.GpuMultipleClonerOptions()
-        co.shard = True
-        # co.useFloat16 = True
-        gpu_index_flat = faiss.index_cpu_to_all_gpus(  # build the index
-            cpu_index,
-            co=co
-        )
         logger.info("***** begin add passages  *****")
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
+        gpu_index_flat = build_index_from_args(args, passage_embedding, queries=queries)
         logger.info("***** end build index  *****")
         return gpu_index_flat, passage_embedding2id
 
     def load_passage(self, passages_path,passages_ctx_path):
+        text_store, title_store = load_passage_store(passages_ctx_path), load_passage_store(passages_path)
+        if text_store is not None and title_store is not None:
+            return StorePassages(text_store, title_store)
         passage_title = load_id_text(passages_path)
         passages = []
         with open(passages_ctx_path) as inp:
@@ -393,7 +518,7 @@ class RenewTools:
                 passages.append((int(id), text,passage_title.get(id, '-')))
         return passages
 
-    def get_question_embedding(self,args,model,qa_path,mode='train'):
+    def load_questions(self, qa_path, mode='train'):
         train_questions = []
         logger.info("Loading "+mode+" question")
         with open(qa_path, "r", encoding="utf-8") as ifile:
@@ -401,7 +526,10 @@ class RenewTools:
                 line = line.strip()
                 id, text = line.split('\t')
                 train_questions.append([int(id),text])
+        return train_questions
 
+    def get_question_embedding(self,args,model,qa_path,mode='train'):
+        train_questions = self.load_questions(qa_path, mode=mode)
         train_question_embedding, train_question_embedding2id = self.get_question_embeddings_sub(args, train_questions,
                                                                                              model)
         return train_questions,train_question_embedding, train_question_embedding2id
@@ -411,7 +539,11 @@ class RenewTools:
                                 train_question_embedding,
                                 train_question_embedding2id,
                                 golden_path, gpu_index_flat, passage_embedding2id,
-                                mode='train', step_num=0):
+                                mode='train', step_num=0, save=True, in_memory=False):
+        """Evaluate the top-k of the questions and mine their negatives into {mode}_ce_{step_num}.
+
+        `save=False` skips the file, `in_memory=True` returns the negatives as a `NegativeFile`.
+        """
         faiss.omp_set_num_threads(90)
         if mode == 'train':
             similar_scores, train_I = gpu_index_flat.search(train_question_embedding.astype(np.float32),
@@ -420,6 +552,8 @@ class RenewTools:
             similar_scores, train_I = gpu_index_flat.search(train_question_embedding.astype(np.float32),
                                                         1000)  # I: [number of queries, topk]
 
+        if mode == 'train' and self.track_candidates:
+            np.save(os.path.join(self.temp_dir, CANDIDATES_FILE), np.unique(train_I[train_I >= 0]))
         qids_to_ranked_candidate_passages  = {}
         qids_to_ranked_candidate_scores = {}
         for index,ranked_candidate_passages in enumerate(train_I):
@@ -437,6 +571,82 @@ class RenewTools:
             json.dump(all_scores, f, indent=2)
 
         train_pos_qp, train_pos_qp_add = load_pos_examples(mode)
-        write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_scores, train_questions,
-                          train_pos_qp, train_pos_qp_add, q_type=mode,
-                          save_path=self.output_dir,global_step=step_num)
+        return write_to_file(qids_to_ranked_candidate_passages, qids_to_ranked_candidate_scores, train_questions,
+                             train_pos_qp, train_pos_qp_add, q_type=mode,
+                             save_path=self.output_dir, global_step=step_num,
+                             file_format=self.negative_file_format if save else None, in_memory=in_memory)
+
+    def get_question_topk_pipelined(self, args, model, qa_path, golden_path, gpu_index_flat,
+                                    mode='train', step_num=0, save=True, in_memory=False,
+                                    chunk_size=16384, max_pending=4):
+        """`get_question_embedding` followed by `get_question_topk`, as one pipeline with the same outputs.
+
+        The calling thread encodes the questions and hands them over in chunks of `chunk_size`; a
+        search thread runs every chunk through the index as soon as it is complete and a writer
+        thread streams the mined negatives into the negatives file. Encoding, search and writing
+        overlap, and at most `max_pending` chunks of questions and of top-k results are held at a
+        time instead of the [num_questions, topk] score and id matrices.
+        """
+        faiss.omp_set_num_threads(90)
+        topk = 200 if mode == 'train' else 1000
+        questions = self.load_questions(qa_path, mode=mode)
+        q_text_dict = {q_id: text for q_id, text in questions}
+        qids_to_relevant_passageids = load_reference_from_stream(golden_path)
+        train_pos_qp, train_pos_qp_add = load_pos_examples(mode)
+        sink = NegativeSink(self.output_dir, mode, step_num,
+                            file_format=self.negative_file_format if save else None, in_memory=in_memory)
+        evaluator = RetrievalEvaluator(qids_to_relevant_passageids, cutoffs=(10, 1, 50, None))
+        candidates = []
+
+        def search(chunk):
+            ids, embeddings = chunk
+            similar_scores, train_I = gpu_index_flat.search(embeddings.astype(np.float32), topk)
+            evaluator.add(ids, train_I)
+            if mode == 'train' and self.track_candidates:
+                candidates.append(np.unique(train_I[train_I >= 0]))
+            return ids, train_I, similar_scores
+
+        def write(result):
+            for q_id, p_id_list, score_list in zip(*result):
+                sink.add(negative_record(q_id, q_text_dict[q_id], p_id_list, score_list,
+                                         train_pos_qp, train_pos_qp_add))
+
+        errors = []
+        search_queue, write_queue = queue.Queue(max_pending), queue.Queue(max_pending)
+        threads = [threading.Thread(target=_pipeline_stage, args=(search, search_queue, write_queue, errors)),
+                   threading.Thread(target=_pipeline_stage, args=(write, write_queue, None, errors))]
+        for thread in threads:
+            thread.start()
+        start = time.time()
+        try:
+            chunk_ids, chunk_embeddings, num_pending = [], [], 0
+            for ids, embeddings in self.iter_question_embeddings(args, questions, model):
+                chunk_ids.append(ids)
+                chunk_embeddings.append(embeddings)
+                num_pending += len(ids)
+                if num_pending >= chunk_size:
+                    _put(search_queue, (np.concatenate(chunk_ids), np.concatenate(chunk_embeddings)), errors)
+                    chunk_ids, chunk_embeddings, num_pending = [], [], 0
+            if num_pending > 0:
+                _put(search_queue, (np.concatenate(chunk_ids), np.concatenate(chunk_embeddings)), errors)
+            _put(search_queue, _END, errors)
+        except BaseException as e:
+            errors.append(e)
+        finally:
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        logger.info('Encoded, searched and mined %d %s questions in %.1fs', len(questions), mode,
+                    time.time() - start)
+
+        all_scores = legacy_scores(evaluator.result())
+        logger.info("***** Done "+mode+" validate *****")
+        logger.info(all_scores)
+        logger.info("***** Done "+mode+" validate *****")
+        ndcg_output_path = os.path.join(self.output_dir, mode + "_eval_result"+str(step_num)+".json")
+        with open(ndcg_output_path, 'w') as f:
+            json.dump(all_scores, f, indent=2)
+        if candidates:
+            np.save(os.path.join(self.temp_dir, CANDIDATES_FILE), np.unique(np.concatenate(candidates)))
+        return sink.close()
@@ -0,0 +1,110 @@
+import sys
+
+sys.path += ['../']
+import logging
+import os
+import torch
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.dirname(os.getcwd())))
+import torch.distributed as dist
+from co_training_generate import RenewTools
+import co_training_marco_train
+from co_training_marco_train import get_parser, set_env, load_model, train
+from utils.util import is_first_worker
+from utils.negative_file import broadcast_negative_file
+from utils.faiss_index import add_index_args
+from utils.incremental_embeddings import add_reencode_args
+
+logger = logging.getLogger(__name__)
+
+
+def get_arguments():
+    """co_training_marco_train.py arguments plus the index flags of co_training_marco_generate.py"""
+    parser = get_parser()
+    add_index_args(parser)
+    add_reencode_args(parser)
+    parser.add_argument("--save_negatives", default=False, action="store_true",
+                        help="also write train_ce_{step} (--negative_file_format) at every refresh, "
+                             "needed to resume a run with --global_step")
+    args = parser.parse_args()
+    assert not args.async_refresh, "--async_refresh is for co_training_marco_train.py with co_training_marco_refresher.py"
+
+    return args
+
+
+def refresh_negatives(args, model, global_step, renew_tools):
+    """Mine new negatives with the student being trained, the same steps as co_training_marco_generate.py.
+
+    Rank 0 searches and mines, then the negatives are broadcast to every rank in memory.
+    """
+    model.eval()
+    negatives = None
+    with torch.no_grad():
+        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model, step=global_step)
+        if is_first_worker():
+            renew_tools.report_reencode_recall(args, model, global_step)
+            dev_q, dev_q_embed, dev_q_embed2id = renew_tools.get_question_embedding(args,
+                                                                                    model, args.dev_qa_path, mode='dev')
+
+            gpu_index_flat, passage_embedding2id = renew_tools.get_new_faiss_index(args, passage_embedding,
+                                                                                   passage_embedding_id,
+                                                                                   queries=dev_q_embed)
+            data_dir = os.path.abspath(os.path.dirname(args.train_qa_path))
+            ground_truth_path = os.path.join(data_dir, 'qrels.train.tsv')
+            negatives = renew_tools.get_question_topk_pipelined(args, model, args.train_qa_path, ground_truth_path,
+                                                                gpu_index_flat, mode='train', step_num=global_step,
+                                                                save=args.save_negatives, in_memory=True)
+            data_dir = os.path.abspath(os.path.dirname(args.dev_qa_path))
+            ground_truth_path = os.path.join(data_dir, 'qrels.dev.tsv')
+            renew_tools.get_question_topk(dev_q, dev_q_embed, dev_q_embed2id, ground_truth_path,
+                                          gpu_index_flat, passage_embedding2id,
+                                          mode='dev', step_num=global_step)
+            # give the GPU memory of the index back to training
+            del gpu_index_flat
+    torch.cuda.empty_cache()
+    negatives = broadcast_negative_file(negatives, args.device)
+    logger.info("***** Refreshed negatives of %d queries at step %d *****", len(negatives), global_step)
+    return negatives
+
+
+def main():
+    """Alternate training and negative refresh in one process.
+
+    The tokenizer, both models with their optimizers, the corpus and the dataset stay resident
+    and the process group is created once, instead of relaunching co_training_marco_train.py and
+    co_training_marco_generate.py for every `iteration_step` as train_MS_Pas_AR2.sh does.
+    """
+    args = get_arguments()
+    set_env(args)
+    tokenizer, model, teacher_model = load_model(args)
+
+    basic_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    formatter = logging.Formatter(basic_format)
+    log_path = os.path.join(args.output_dir, 'log.txt')
+    handler = logging.FileHandler(log_path, 'w' if args.global_step == 0 else 'a', 'utf-8')
+    handler.setFormatter(formatter)
+    for run_logger in [logger, co_training_marco_train.logger]:
+        run_logger.addHandler(handler)
+        run_logger.setLevel(logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
+
+    temp_slice_dir = os.path.join(args.ann_dir, 'temp')
+    passages_title_path = os.path.join(args.passage_path, 'para.title.txt')
+    passages_ctx_path = os.path.join(args.passage_path, 'para.txt')
+    renew_tools = RenewTools(passages_title_path=passages_title_path,
+                             passages_ctx_path=passages_ctx_path, tokenizer=tokenizer,
+                             output_dir=args.ann_dir, temp_dir=temp_slice_dir,
+                             negative_file_format=args.negative_file_format)
+    dist.barrier()
+    global_step = args.global_step
+    if global_step < args.max_steps:
+        global_step = train(args, model, teacher_model, tokenizer, global_step=global_step,
+                            refresh_negatives=lambda model, step: refresh_negatives(args, model, step, renew_tools))
+    logger.info(" global_step = %s", global_step)
+
+    if args.local_rank != -1:
+        dist.barrier()
+
+
+if __name__ == "__main__":
+    main()
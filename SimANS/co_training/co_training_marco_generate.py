@@ -32,6 +32,8 @@ from utils.dpr_utils import (
     load_states_from_checkpoint,
     CheckpointState
 )
+from utils.faiss_index import add_index_args
+from utils.incremental_embeddings import add_reencode_args
 import collections
 
 studentBatch = collections.namedtuple(
@@ -48,7 +50,7 @@ studentBatch = collections.namedtuple(
 
 
 
-def get_arguments():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Required parameters
@@ -238,9 +240,17 @@ def get_arguments():
     parser.add_argument("--teacher_learning_rate", default=0, type=float)
     parser.add_argument("--load_cache", default=False, action="store_true")
     parser.add_argument("--ann_dir", type=str, default="", help="For distant debugging.")
+    parser.add_argument("--negative_file_format", type=str, default='tsv', choices=['tsv', 'bin'],
+                        help="train_ce_{step}.tsv or the binary train_ce_{step}.negbin (utils/negative_file.py)")
 
     parser.add_argument("--global_step", type=int, default=0, help="For distant debugging.")
-    args = parser.parse_args()
+    add_index_args(parser)
+    add_reencode_args(parser)
+    return parser
+
+
+def get_arguments():
+    args = get_parser().parse_args()
 
     return args
 
@@ -338,22 +348,22 @@ def get_new_dataset(args, model, global_step, renew_tools):
     # model.to(args.device)
     logger.info(" model_path = %s", model_path)
     with torch.no_grad():
-        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model)
+        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model, step=global_step,
+                                                                                    checkpoint=model_path)
         torch.distributed.barrier()
         if is_first_worker():
-            train_q, train_q_embed, train_q_embed2id = renew_tools.get_question_embedding(args,
-                                                                                          model, args.train_qa_path,
-                                                                                          mode='train')
+            renew_tools.report_reencode_recall(args, model, global_step)
             dev_q, dev_q_embed, dev_q_embed2id = renew_tools.get_question_embedding(args,
                                                                                     model, args.dev_qa_path, mode='dev')
 
             gpu_index_flat, passage_embedding2id = renew_tools.get_new_faiss_index(args, passage_embedding,
-                                                                                   passage_embedding_id)
+                                                                                   passage_embedding_id,
+                                                                                   queries=dev_q_embed)
             data_dir = os.path.abspath(os.path.dirname(args.train_qa_path))
             ground_truth_path = os.path.join(data_dir, 'qrels.train.tsv')
-            renew_tools.get_question_topk(train_q, train_q_embed, train_q_embed2id, ground_truth_path,
-                                          gpu_index_flat, passage_embedding2id,
-                                          mode='train', step_num=global_step)
+            # train questions are encoded, searched and written in one overlapped pass
+            renew_tools.get_question_topk_pipelined(args, model, args.train_qa_path, ground_truth_path,
+                                                    gpu_index_flat, mode='train', step_num=global_step)
             data_dir = os.path.abspath(os.path.dirname(args.dev_qa_path))
             ground_truth_path = os.path.join(data_dir, 'qrels.dev.tsv')
             renew_tools.get_question_topk(dev_q, dev_q_embed, dev_q_embed2id, ground_truth_path,
@@ -383,7 +393,8 @@ def main():
     passages_ctx_path = os.path.join(args.passage_path, 'para.txt')
     renew_tools = RenewTools(passages_title_path=passages_title_path,
                              passages_ctx_path=passages_ctx_path, tokenizer=tokenizer,
-                             output_dir=args.ann_dir, temp_dir=temp_slice_dir)
+                             output_dir=args.ann_dir, temp_dir=temp_slice_dir,
+                             negative_file_format=args.negative_file_format)
     dist.barrier()
     global_step = args.global_step
     if global_step > args.max_steps:
@@ -0,0 +1,110 @@
+import sys
+
+sys.path += ['../']
+import logging
+import os
+import re
+import time
+import torch
+
+sys.path.append(os.getcwd())
+sys.path.append(os.path.abspath(os.path.dirname(os.getcwd())))
+import torch.distributed as dist
+from co_training_generate import RenewTools
+import co_training_marco_generate
+from co_training_marco_generate import get_parser, set_env, load_model, get_new_dataset
+from utils.util import is_first_worker
+from utils.negative_file import negative_file_path, publish_negatives, training_done
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_PATTERN = re.compile(r'^checkpoint-(\d+)$')
+
+
+def get_arguments():
+    """co_training_marco_generate.py arguments, --global_step is the last step already mined"""
+    parser = get_parser()
+    parser.add_argument("--poll_seconds", type=float, default=60,
+                        help="how often to look for a new checkpoint in --output_dir")
+    args = parser.parse_args()
+
+    return args
+
+
+def newest_checkpoint_step(output_dir, iteration_step, after, last):
+    """Largest step in (`after`, `last`] of a `checkpoint-{step}` saved at an iteration_step boundary,
+    None if there is none"""
+    steps = [int(match.group(1)) for match in map(CHECKPOINT_PATTERN.match, os.listdir(output_dir))
+             if match is not None]
+    steps = [step for step in steps if after < step <= last and step % iteration_step == 0]
+    return max(steps) if steps else None
+
+
+def last_refresh_step(max_steps, iteration_step):
+    """Last iteration_step boundary below max_steps: negatives mined at max_steps are never trained on"""
+    return (max_steps - 1) // iteration_step * iteration_step
+
+
+def main():
+    """Mine negatives from the checkpoints of a co_training_marco_train.py --async_refresh run.
+
+    Runs next to training on its own GPUs: whenever training saves a newer iteration_step
+    checkpoint, the corpus is re-encoded and searched with it like co_training_marco_generate.py
+    does, and the new train negatives are published for training to pick up. Checkpoints saved
+    while a refresh is running are skipped in favour of the newest one. Exits once the checkpoint
+    of the last iteration_step boundary below --max_steps is mined, or when training has written
+    its done marker.
+    """
+    args = get_arguments()
+    set_env(args)
+    basic_format = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+    formatter = logging.Formatter(basic_format)
+    handler = logging.FileHandler(os.path.join(args.output_dir, 'refresher_log.txt'), 'a', 'utf-8')
+    handler.setFormatter(formatter)
+    for run_logger in [logger, co_training_marco_generate.logger]:
+        run_logger.addHandler(handler)
+        run_logger.setLevel(logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
+    tokenizer, model = load_model(args)
+    temp_slice_dir = os.path.join(args.ann_dir, 'temp')
+    passages_title_path = os.path.join(args.passage_path, 'para.title.txt')
+    passages_ctx_path = os.path.join(args.passage_path, 'para.txt')
+    renew_tools = RenewTools(passages_title_path=passages_title_path,
+                             passages_ctx_path=passages_ctx_path, tokenizer=tokenizer,
+                             output_dir=args.ann_dir, temp_dir=temp_slice_dir,
+                             negative_file_format=args.negative_file_format)
+    dist.barrier()
+    last_step = args.global_step
+    # a done marker from before this refresher started belongs to an earlier run
+    start_time = time.time()
+    final_step = last_refresh_step(args.max_steps, args.iteration_step)
+    while last_step < final_step:
+        if is_first_worker():
+            done = training_done(args.output_dir)
+            if done is not None and done['time'] < start_time:
+                done = None
+            step = None if done is not None else \
+                newest_checkpoint_step(args.output_dir, args.iteration_step, last_step, final_step)
+        else:
+            done = step = None
+        state = [done, step]
+        dist.broadcast_object_list(state, src=0)
+        done, step = state
+        if done is not None:
+            logger.info(" training finished at step %d, stopping", done['step'])
+            break
+        if step is None:
+            time.sleep(args.poll_seconds)
+            continue
+        start = time.time()
+        get_new_dataset(args, model, step, renew_tools)
+        dist.barrier()
+        if is_first_worker():
+            publish_negatives(args.ann_dir, 'train', step,
+                              negative_file_path(args.ann_dir, 'train', step, args.negative_file_format))
+        logger.info(" refreshed negatives of step %d in %.1fs", step, time.time() - start)
+        last_step = step
+        torch.cuda.empty_cache()
+
+
+if __name__ == "__main__":
+    main()
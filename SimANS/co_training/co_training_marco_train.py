@@ -5,6 +5,7 @@ import argparse
 import json
 import logging
 import os
+import time
 import torch
 
 sys.path.append(os.getcwd())
@@ -41,6 +42,8 @@ from utils.dpr_utils import (
 from utils.MARCO_until_new import (
     Rocketqa_v2Dataset,
 )
+from utils.negative_file import negative_file_path, latest_negatives, mark_training_done, clear_training_done
+from utils.teacher_cache import TeacherScoreCache
 import collections
 studentBatch = collections.namedtuple(
     "BiENcoderInput",
@@ -79,8 +82,17 @@ def get_bert_reader_components(args, **kwargs):
     return reranker
 
 
-def train(args, model, teacher_model, tokenizer, global_step=0):
-    """ Train the model """
+def train(args, model, teacher_model, tokenizer, global_step=0, refresh_negatives=None):
+    """ Train the model
+
+    Without `refresh_negatives` training stops after saving the checkpoint at the next
+    `iteration_step` boundary and the negatives are regenerated by co_training_marco_generate.py.
+    Otherwise `refresh_negatives(model, global_step)` is called at every boundary and the
+    negatives it returns are swapped into the dataset in place (see co_training_marco.py).
+    With `--async_refresh` training never stops: co_training_marco_refresher.py mines negatives
+    from the saved checkpoints on other GPUs and the newest published ones are swapped in at the
+    next epoch boundary (see `_swap_in_latest_negatives`).
+    """
     logger.info("Training/evaluation parameters %s", args)
     tb_writer = None
     if is_first_worker():
@@ -132,8 +144,13 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
     teacher_scheduler = get_linear_schedule_with_warmup(
         teacher_optimizer, num_warmup_steps=0.1 * teacher_max_step, num_training_steps=teacher_max_step
     )
+    negatives_step = global_step
     if global_step!=0:
-        train_data_path = os.path.join(args.ann_dir, 'train_ce_' + str(global_step) + '.tsv')
+        train_data_path = negative_file_path(args.ann_dir, 'train', global_step, args.negative_file_format)
+        if args.async_refresh:
+            latest = latest_negatives(args.ann_dir, 'train')
+            train_data_path = args.origin_data_dir if latest is None else latest['path']
+            negatives_step = 0 if latest is None else latest['step']
         
         model_path = os.path.join(args.output_dir, 'checkpoint-' + str(global_step))
         teacher_model_path = os.path.join(args.output_dir, 'checkpoint-reranker' + str(global_step))
@@ -144,12 +161,14 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
 
         train_dataset = Rocketqa_v2Dataset(train_data_path, tokenizer, num_hard_negatives=args.number_neg,
                                         trainer_id=args.local_rank, trainer_num=args.world_size,
-                                        corpus_path=args.passage_path,rand_pool =100)
+                                        corpus_path=args.passage_path,rand_pool=100,
+                                        token_cache_dir=args.token_cache_dir)
 
     else:
         train_dataset = Rocketqa_v2Dataset(args.origin_data_dir, tokenizer, num_hard_negatives=args.number_neg,
                                         trainer_id=args.local_rank, trainer_num=args.world_size,
-                                        corpus_path=args.passage_path,rand_pool=100)
+                                        corpus_path=args.passage_path,rand_pool=100,
+                                        token_cache_dir=args.token_cache_dir)
     train_sample = RandomSampler(train_dataset)
     train_dataloader = DataLoader(train_dataset, sampler=train_sample,
                                 collate_fn=Rocketqa_v2Dataset.get_collate_fn(args),
@@ -172,10 +191,16 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
                 len(train_dataset) // (args.train_batch_size *
                                        args.gradient_accumulation_steps))
     eps = 1e-7
+    # the teacher logits only change when the reranker is trained, see utils/teacher_cache.py
+    teacher_cache = TeacherScoreCache(args.teacher_cache_size) if args.teacher_cache_size > 0 else None
+    teacher_step = global_step
     while global_step < args.max_steps:
         try:
             batch = next(train_dataloader_iter)
         except StopIteration:
+            if args.async_refresh:
+                epoch_iterator = train_dataloader_iter = None
+                negatives_step = _swap_in_latest_negatives(args, train_dataset, negatives_step, global_step)
             epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
             train_dataloader_iter = iter(epoch_iterator)
             batch = next(train_dataloader_iter)
@@ -205,7 +230,12 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
             else:
                 student_dist_p = F.softmax(student_simila, dim=1)
             with torch.no_grad():
-                output_teacher = teacher_model(**inputs_teacher)
+                if teacher_cache is not None:
+                    # the unwrapped module: ranks with no cache miss skip the forward, DDP would wait for them
+                    output_teacher = teacher_cache.scores(getattr(teacher_model, 'module', teacher_model),
+                                                          teacher_step, *batch['pair_ids'], **inputs_teacher)
+                else:
+                    output_teacher = teacher_model(**inputs_teacher)
                 relevance_logits = output_teacher
                 teacher_logits = relevance_logits / args.temperature_distill
                 probs = F.softmax(teacher_logits, dim=1)
@@ -261,6 +291,8 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
                 teacher_scheduler.step()
                 teacher_model.zero_grad()   
             global_step += 1
+            if train_flag == 1:
+                teacher_step = global_step
 
             if args.logging_steps > 0 and global_step % args.logging_steps == 0:
                 logs = {}
@@ -272,6 +304,12 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
                 logs["loss"] = loss_scalar
                 logs["distill_loss"] = distill_loss_scalar
                 logs["contr_loss"] = contr_loss_scalar
+                # steps trained since the checkpoint the current negatives were mined with
+                logs["negatives_staleness"] = global_step - negatives_step
+                if teacher_cache is not None:
+                    logs["teacher_cache_hit_rate"] = teacher_cache.hit_rate
+                    logs["teacher_cache_pairs"] = len(teacher_cache)
+                    teacher_cache.reset_stats()
                 tr_loss = 0
                 tr_distll_loss = 0
                 tr_contr_loss = 0
@@ -294,7 +332,25 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
                     _save_teacher_checkpoint(args, teacher_model, teacher_optimizer, teacher_scheduler, global_step)
                 torch.distributed.barrier()
                 train_flag = 0
-                break
+                if args.async_refresh:
+                    if args.max_negative_staleness <= 0 or \
+                            global_step - negatives_step <= args.max_negative_staleness:
+                        continue
+                    # too stale to wait for the end of the epoch
+                    epoch_iterator = train_dataloader_iter = None
+                    negatives_step = _swap_in_latest_negatives(args, train_dataset, negatives_step, global_step)
+                elif refresh_negatives is None:
+                    break
+                else:
+                    # shut the loader workers down while the refresh encodes the corpus
+                    epoch_iterator = train_dataloader_iter = None
+                    train_dataset.set_negatives(refresh_negatives(model, global_step))
+                    negatives_step = global_step
+                    model.train()
+                epoch_iterator = tqdm(train_dataloader, desc="Iteration", disable=args.local_rank not in [-1, 0])
+                train_dataloader_iter = iter(epoch_iterator)
+                logger.info("  Dataset example num after refresh = %d", len(train_dataset))
+                continue
             if args.save_steps > 0 and global_step % args.save_steps == 0:
                 if is_first_worker():
                     _save_checkpoint(args, model, optimizer, scheduler, global_step)
@@ -307,6 +363,37 @@ def train(args, model, teacher_model, tokenizer, global_step=0):
     return global_step
 
 
+def _swap_in_latest_negatives(args, train_dataset, negatives_step, global_step):
+    """Swap in the newest negatives published by co_training_marco_refresher.py if they were mined
+    with a later checkpoint than `negatives_step`, returns the step of the negatives now in use.
+
+    Blocks, polling every `--refresh_poll_seconds`, while the negatives are more than
+    `--max_negative_staleness` steps behind `global_step`.
+    """
+    while True:
+        latest = [latest_negatives(args.ann_dir, 'train') if is_first_worker() else None]
+        if args.local_rank != -1:
+            # every rank must swap to the same file
+            dist.broadcast_object_list(latest, src=0)
+        latest = latest[0]
+        if latest is not None and latest['step'] > negatives_step:
+            train_dataset.set_negatives(latest['path'])
+            negatives_step = latest['step']
+            logger.info("  Swapped in negatives of step %d (published %.0fs ago) at step %d, %d examples",
+                        negatives_step, time.time() - latest['time'], global_step, len(train_dataset))
+        if args.max_negative_staleness <= 0 or global_step - negatives_step <= args.max_negative_staleness:
+            return negatives_step
+        logger.info("  Negatives of step %d are %d steps old, waiting for the refresher",
+                    negatives_step, global_step - negatives_step)
+        time.sleep(args.refresh_poll_seconds)
+
+
+def _atomic_save(obj, path):
+    # the refresher loads checkpoints as soon as they appear
+    torch.save(obj, path + '.tmp')
+    os.replace(path + '.tmp', path)
+
+
 def _save_checkpoint(args, model, optimizer, scheduler, step: int) -> str:
     offset = step
     epoch = 0
@@ -321,7 +408,7 @@ def _save_checkpoint(args, model, optimizer, scheduler, step: int) -> str:
                             offset,
                             epoch, meta_params
                             )
-    torch.save(state._asdict(), cp)
+    _atomic_save(state._asdict(), cp)
     logger.info('Saved checkpoint at %s', cp)
     return cp
 
@@ -340,7 +427,7 @@ def _save_teacher_checkpoint(args, model, optimizer, scheduler, step: int) -> st
                             offset,
                             epoch, meta_params
                             )
-    torch.save(state._asdict(), cp)
+    _atomic_save(state._asdict(), cp)
     logger.info('Saved checkpoint at %s', cp)
     return cp
 
@@ -358,7 +445,7 @@ def _load_saved_state(model, optimizer, scheduler, saved_state: CheckpointState)
     return step
 
 
-def get_arguments():
+def get_parser():
     parser = argparse.ArgumentParser()
 
     # Required parameters
@@ -551,14 +638,36 @@ def get_arguments():
     parser.add_argument("--iteration_step", default=80, type=int)
     parser.add_argument("--iteration_reranker_step", default=40, type=int)
     parser.add_argument("--temperature_distill", default=3, type=float)
+    parser.add_argument("--teacher_cache_size", type=int, default=0,
+                        help="reuse the teacher logits of up to this many (qid, pid) pairs while the teacher "
+                             "is frozen, only pairs not seen since its last update go through it; 0 disables")
 
     parser.add_argument("--scale_simmila",  default=False,  action="store_true")
     parser.add_argument("--teacher_learning_rate", default=0,type=float)
     parser.add_argument("--load_cache", default=False, action="store_true")
     parser.add_argument("--ann_dir", type=str, default="", help="For distant debugging.")
+    parser.add_argument("--negative_file_format", type=str, default='tsv', choices=['tsv', 'bin'],
+                        help="train_ce_{step}.tsv or the binary train_ce_{step}.negbin (utils/negative_file.py)")
+    parser.add_argument("--token_cache_dir", type=str, default=None,
+                        help="directory of caches built by utils/token_cache.py, tokenize on the fly if unset")
+
+    parser.add_argument("--async_refresh", default=False, action="store_true",
+                        help="keep training at iteration_step boundaries and swap in the negatives published "
+                             "by co_training_marco_refresher.py at epoch boundaries")
+    parser.add_argument("--max_negative_staleness", type=int, default=0,
+                        help="with --async_refresh, wait for the refresher once the negatives are more than "
+                             "this many steps old, 0 never waits")
+    parser.add_argument("--refresh_poll_seconds", type=float, default=60)
 
     parser.add_argument("--global_step", type=int, default=0, help="For distant debugging.")
-    args = parser.parse_args()
+    return parser
+
+
+def get_arguments():
+    args = get_parser().parse_args()
+    # negatives can only be published for checkpoints, every iteration_step
+    assert args.max_negative_staleness <= 0 or args.max_negative_staleness >= args.iteration_step, \
+        "--max_negative_staleness must be 0 or at least --iteration_step"
 
     return args
 
@@ -655,6 +764,9 @@ def main():
     # logger.addHandler(sh)
     logger.setLevel(logging.INFO if args.local_rank in [-1, 0] else logging.WARN)
     print(logger)
+    if args.async_refresh and is_first_worker():
+        # a marker left by an earlier run would stop the refresher of this one
+        clear_training_done(args.output_dir)
     dist.barrier()
     global_step = args.global_step
     # eval_first(args,model,0,renew_tools)
@@ -663,6 +775,8 @@ def main():
     else:
         global_step = train(args, model,teacher_model, tokenizer,global_step=global_step) # 训练，然后当需要弹出的时候弹出
     logger.info(" global_step = %s", global_step)
+    if args.async_refresh and is_first_worker():
+        mark_training_done(args.output_dir, global_step)
 
     if args.local_rank != -1:
         dist.barrier()
@@ -4,6 +4,10 @@ from tqdm import tqdm
 import torch
 import random
 import math
+from utils.passage_store import load_passage_store
+from utils.token_cache import load_token_cache, pad_token_arrays, cross_encoder_token_arrays
+from utils.negative_file import is_negative_file, NegativeFile
+from utils.simans_sampler import SimANSSampler, pair_scores
 
 def csv_reader(fd, delimiter='\t', trainer_id=0, trainer_num=1):
     def gen():
@@ -126,17 +130,46 @@ class Rocketqa_v2Dataset(Dataset):
     def __init__(self, file_path, tokenizer, num_hard_negatives=1,
                  trainer_id=0, trainer_num=1, is_training=True,
                  corpus_path='', rand_pool=50,
-                 p_text=None, p_title=None):
-        self.file_path = file_path
+                 p_text=None, p_title=None, token_cache_dir=None):
         self.tokenizer = tokenizer
-        self.data = self._read_example(file_path, trainer_id, trainer_num)
+        self.trainer_id = trainer_id
+        self.trainer_num = trainer_num
         self.is_training = is_training
         self.num_hard_negatives = num_hard_negatives
         self.rand_pool = rand_pool
         self.tau = 3
+        self.set_negatives(file_path)
 
         self.p_text = self.load_id_text(os.path.join(corpus_path, 'para.txt')) if p_text is None else p_text
         self.p_title = self.load_id_text(os.path.join(corpus_path, 'para.title.txt')) if p_title is None else p_text
+        # pre-tokenized ids written by utils/token_cache.py, None falls back to tokenizer.encode
+        self.passage_tokens = load_token_cache(token_cache_dir, 'passage', tokenizer, 128)
+        self.query_tokens = load_token_cache(token_cache_dir, 'query', tokenizer, 32)
+
+    def set_negatives(self, file_path):
+        """(Re)load the mined negatives: a train_ce file path or an in-memory `NegativeFile`.
+
+        The corpus and token caches are kept, so the training loop can swap in newly mined
+        negatives between iterations without rebuilding the dataset.
+        """
+        self.file_path = file_path
+        if isinstance(file_path, NegativeFile) or is_negative_file(file_path):
+            # binary file from utils/negative_file.py, samples are row indices into it
+            self.negative_file = file_path if isinstance(file_path, NegativeFile) else NegativeFile(file_path)
+            self.data = self.negative_file.shard(self.trainer_id, self.trainer_num)
+        else:
+            self.negative_file = None
+            self.data = self._read_example(file_path, self.trainer_id, self.trainer_num)
+        self.sampler = self._build_sampler()
+
+    def _build_sampler(self):
+        """SimANS weights of every (query, positive), rows follow `self.data`"""
+        if self.negative_file is not None:
+            return SimANSSampler.from_negative_file(self.negative_file, self.data.indices,
+                                                    kernel='abs', a=self.tau)
+        return SimANSSampler.from_score_lists([pair_scores(sample.pos_id) for sample in self.data],
+                                              [pair_scores(sample.neg_id) for sample in self.data],
+                                              kernel='abs', a=self.tau)
 
     def _read_example(self, input_file, trainer_id=0, trainer_num=1):
         """Reads a tab separated value file."""
@@ -153,6 +186,9 @@ class Rocketqa_v2Dataset(Dataset):
 
     def load_id_text(self, file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -165,41 +201,32 @@ class Rocketqa_v2Dataset(Dataset):
     def __getitem__(self, index):
         sample = self.data[index]
 
-        query = convert_to_unicode(sample.query_string)
-
-        pos_pairs_list = sample.pos_id.split(',')
-        neg_pairs_list = sample.neg_id.split(',')
-        neg_pairs_list = [(int(pair.split()[0]), float(pair.split()[1])) for pair in neg_pairs_list]
+        if self.negative_file is not None:
+            query_id, query = self.negative_file.qid(sample), self.negative_file.query(sample)
+            pos_pairs_list = list(zip(*[array.tolist() for array in self.negative_file.positives(sample)]))
+            neg_pairs_list = list(zip(*[array.tolist() for array in self.negative_file.negatives(sample)]))
+        else:
+            query_id, query = sample.query_id, convert_to_unicode(sample.query_string)
+            pos_pairs_list = [pair.split() for pair in sample.pos_id.split(',')]
+            neg_pairs_list = sample.neg_id.split(',')
+            neg_pairs_list = [(int(pair.split()[0]), float(pair.split()[1])) for pair in neg_pairs_list]
         if self.is_training:
-            pos_id, pos_score = random.choice(pos_pairs_list).split()
+            pos_index = random.randrange(len(pos_pairs_list))
         else:
-            pos_id, pos_score = pos_pairs_list[0].split()
+            pos_index = 0
+        pos_id, pos_score = pos_pairs_list[pos_index]
         pos_id, pos_score = int(pos_id), float(pos_score)
 
         if pos_score==0:
             neg_ids_list = [pair[0] for pair in neg_pairs_list[-self.num_hard_negatives:]]
         else:
-            neg_candidates = []
-            neg_scores = []
-            for pair in neg_pairs_list:
-                neg_id, neg_score = pair
-                neg_score = math.exp(-abs(neg_score - pos_score) * self.tau)
-                neg_candidates.append(neg_id)
-                neg_scores.append(neg_score)
-
-            neg_ids_list = set()
-            while len(neg_ids_list)<self.num_hard_negatives:
-                neg_ids_list = neg_ids_list.union(random.choices(neg_candidates, weights=neg_scores, k=self.num_hard_negatives))
-                new_neg_candidates = []
-                new_neg_scores = []
-                for neg_id, neg_score in zip(neg_candidates, neg_scores):
-                    if neg_id not in neg_ids_list:
-                        new_neg_candidates.append(neg_id)
-                        new_neg_scores.append(neg_score)
-                neg_candidates = new_neg_candidates
-                neg_scores = new_neg_scores
+            neg_ids_list = [neg_pairs_list[i][0] for i in
+                            self.sampler.sample(index, pos_index, self.num_hard_negatives)]
 
-            neg_ids_list = list(neg_ids_list)[0:self.num_hard_negatives]
+        # (qid, pid) of every teacher pair, the keys of utils/teacher_cache.py
+        pair_ids = (torch.tensor(int(query_id)), torch.LongTensor([pos_id] + [int(neg_id) for neg_id in neg_ids_list]))
+        if self.passage_tokens is not None:
+            return self._get_cached_item(query_id, query, pos_id, neg_ids_list) + pair_ids
 
         title_pos = convert_to_unicode(self.p_title.get(pos_id, '-'))
         para_pos = convert_to_unicode(self.p_text[pos_id])
@@ -232,7 +259,23 @@ class Rocketqa_v2Dataset(Dataset):
         c_e_token_ids = torch.LongTensor(
             [temp + [self.tokenizer.pad_token_id] * (160 - len(temp)) for temp in c_e_token_ids])
 
-        return question_token_ids, ctx_ids, c_e_token_ids
+        return (question_token_ids, ctx_ids, c_e_token_ids) + pair_ids
+
+    def _get_cached_item(self, query_id, query, pos_id, neg_ids_list):
+        ctx_token_ids = [self.passage_tokens[int(p_id)] for p_id in [pos_id] + list(neg_ids_list)]
+        question_token_ids = None
+        if self.query_tokens is not None:
+            question_token_ids = self.query_tokens.get(int(query_id))
+        if question_token_ids is None:
+            question_token_ids = self.tokenizer.encode(query,
+                                                       add_special_tokens=True, max_length=32, truncation=True,
+                                                       pad_to_max_length=False)
+        pad_token_id = self.tokenizer.pad_token_id
+        c_e_token_ids = cross_encoder_token_arrays(question_token_ids, ctx_token_ids, self.tokenizer.sep_token_id,
+                                                   160, pad_token_id)
+        question_token_ids = pad_token_arrays([question_token_ids], 32, pad_token_id)[0]
+        ctx_ids = pad_token_arrays(ctx_token_ids, 128, pad_token_id)
+        return torch.from_numpy(question_token_ids), torch.from_numpy(ctx_ids), torch.from_numpy(c_e_token_ids)
 
     def __len__(self):
         return len(self.data)
@@ -255,7 +298,9 @@ class Rocketqa_v2Dataset(Dataset):
             return {'student': [q_tensor, (q_tensor != 0).long(), doc_tensor,
                                 (doc_tensor != 0).long(), positive_ctx_indices],
                     'teacher': [ctx_tensor_out,
-                                (ctx_tensor_out != 0).long(), tgt_tensor], }
+                                (ctx_tensor_out != 0).long(), tgt_tensor],
+                    'pair_ids': [torch.stack([feature[3] for feature in features]),
+                                 torch.stack([feature[4] for feature in features])], }
 
         return create_biencoder_input2
 
@@ -291,6 +336,9 @@ class Rocketqa_v3Dataset(Dataset):
 
     def load_id_text(self, file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
@@ -428,6 +476,9 @@ class Doc_v2Dataset(Dataset):
 
     def load_id_text(self, file_name):
         """load tsv files"""
+        store = load_passage_store(file_name)
+        if store is not None:
+            return store
         id_text = {}
         with open(file_name) as inp:
             for line in tqdm(inp):
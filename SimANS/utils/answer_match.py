@@ -0,0 +1,131 @@
+import collections
+import logging
+import multiprocessing
+import os
+import unicodedata
+import numpy as np
+import regex
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+# the token pattern of SimpleTokenizer
+ALPHA_NUM = r'[\p{L}\p{N}\p{M}]+'
+NON_WS = r'[^\p{Z}\p{C}]'
+# queries labeled per pool task
+LABEL_SHARD_SIZE = 1024
+# inputs of `label_candidates`, inherited by the forked workers instead of pickled per task
+_label_inputs = None
+
+
+class AnswerMatcher:
+    """`has_answer(answers, text, tokenizer)` with match_type='string', for many passages per query.
+
+    `answer_tokens` normalizes and tokenizes the answers of a query once. The lowercased tokens of
+    a passage and a token -> positions table over them are kept for the `cache_size` most recently
+    matched passage ids, so a passage retrieved for many queries is tokenized once. An answer is
+    only compared at the positions of its first token instead of at every offset; the hits are
+    the same as `has_answer`.
+    """
+
+    def __init__(self, cache_size=10000):
+        self._regexp = regex.compile(
+            '(%s)|(%s)' % (ALPHA_NUM, NON_WS),
+            flags=regex.IGNORECASE + regex.UNICODE + regex.MULTILINE
+        )
+        self.cache_size = cache_size
+        self._passages = collections.OrderedDict()
+
+    def tokenize(self, text):
+        """`tokenizer.tokenize(_normalize(text)).words(uncased=True)` of a SimpleTokenizer"""
+        return [m.group().lower() for m in self._regexp.finditer(unicodedata.normalize('NFD', text))]
+
+    def answer_tokens(self, answers):
+        return [self.tokenize(answer) for answer in answers]
+
+    def _passage(self, doc_id, text):
+        entry = self._passages.get(doc_id)
+        if entry is not None:
+            self._passages.move_to_end(doc_id)
+            return entry
+        tokens = self.tokenize(text)
+        positions = {}
+        for i, token in enumerate(tokens):
+            positions.setdefault(token, []).append(i)
+        entry = (tokens, positions)
+        if self.cache_size > 0:
+            self._passages[doc_id] = entry
+            if len(self._passages) > self.cache_size:
+                self._passages.popitem(last=False)
+        return entry
+
+    def has_answer(self, answer_tokens, doc_id, text):
+        """whether passage `doc_id` (with `text`) contains one of the `answer_tokens` of a query"""
+        tokens, positions = self._passage(doc_id, text)
+        for answer in answer_tokens:
+            if not answer:
+                # an answer without tokens matches any passage in has_answer too
+                return True
+            for i in positions.get(answer[0], ()):
+                if tokens[i:i + len(answer)] == answer:
+                    return True
+        return False
+
+
+def _label_shard(bounds):
+    passages, answers, query_ids, doc_ids, positive_ids, negative_sample, max_positives = _label_inputs
+    start, end = bounds
+    matcher = AnswerMatcher()
+    negatives = np.full((end - start, negative_sample), -1, dtype=np.int64)
+    positives = np.full((end - start, max_positives), -1, dtype=np.int64)
+    for row in range(start, end):
+        query_id = query_ids[row]
+        pos_pid = positive_ids[query_id]
+        answer_tokens = matcher.answer_tokens(answers[query_id])
+        seen_negatives = set()
+        neg_cnt = 0
+        pos_cnt = 0
+        for doc_id in doc_ids[row]:
+            if doc_id == pos_pid or doc_id in seen_negatives:
+                continue
+            if neg_cnt >= negative_sample:
+                break
+            if not matcher.has_answer(answer_tokens, doc_id, passages[doc_id][0]):
+                negatives[row - start, neg_cnt] = doc_id
+                seen_negatives.add(doc_id)
+                neg_cnt += 1
+            elif pos_cnt < max_positives:
+                positives[row - start, pos_cnt] = doc_id
+                pos_cnt += 1
+    return negatives, positives
+
+
+def label_candidates(passages, answers, query_ids, doc_ids, positive_ids, negative_sample,
+                     max_positives=10, num_workers=None):
+    """Split the retrieved `doc_ids` ([Q, K] passage ids of `query_ids`) into hard negatives and
+    answer-bearing passages, skipping the labeled positive `positive_ids[query_id]`.
+
+    Per query, the first `negative_sample` distinct candidates without an answer are negatives and
+    the first `max_positives` candidates with one are positives, both in rank order. Queries are
+    labeled in shards by a pool of `num_workers` forked processes (all cores by default) that share
+    `passages` and `answers` with the parent. Returns [Q, negative_sample] and [Q, max_positives]
+    int64 arrays padded with -1.
+    """
+    global _label_inputs
+    doc_ids = np.asarray(doc_ids, dtype=np.int64)
+    num_workers = num_workers or os.cpu_count()
+    shards = [(start, min(start + LABEL_SHARD_SIZE, len(query_ids)))
+              for start in range(0, len(query_ids), LABEL_SHARD_SIZE)]
+    _label_inputs = (passages, answers, query_ids, doc_ids, positive_ids, negative_sample, max_positives)
+    try:
+        if num_workers > 1 and len(shards) > 1 and 'fork' in multiprocessing.get_all_start_methods():
+            with multiprocessing.get_context('fork').Pool(min(num_workers, len(shards))) as pool:
+                results = list(tqdm(pool.imap(_label_shard, shards), total=len(shards)))
+        else:
+            results = [_label_shard(shard) for shard in tqdm(shards)]
+    finally:
+        _label_inputs = None
+    if not results:
+        return np.zeros((0, negative_sample), dtype=np.int64), np.zeros((0, max_positives), dtype=np.int64)
+    negatives, positives = zip(*results)
+    return np.concatenate(negatives), np.concatenate(positives)
@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import numpy as np
+
+try:
+    from utils.dense_search import BlockedExactIndex
+    from utils.embedding_shards import EmbeddingShards, embedding_path
+except ImportError:
+    from dense_search import BlockedExactIndex
+    from embedding_shards import EmbeddingShards, embedding_path
+
+logger = logging.getLogger(__name__)
+
+CACHE_NAME = 'passage_cache'
+CANDIDATES_FILE = 'train_candidates.npy'
+PLAN_FILE = 'reencode_plan.npz'
+NEVER_ENCODED = -1
+
+
+def add_reencode_args(parser):
+    """flags of the budgeted re-encoding done by `RenewTools.get_passage_embedding`"""
+    parser.add_argument("--reencode_budget", type=int, default=0,
+                        help="passages re-encoded per refresh, the others reuse their cached embedding; "
+                             "0 re-encodes the whole corpus every time")
+    parser.add_argument("--reencode_rotate_fraction", type=float, default=0.25,
+                        help="part of the budget spent on a slice rotating over the corpus, the rest goes to "
+                             "the top-k candidates of the training queries at the previous refresh")
+    parser.add_argument("--full_refresh_every", type=int, default=0,
+                        help="re-encode the whole corpus every this many refreshes and report the mining recall "
+                             "the budget would have reached, 0 never")
+    parser.add_argument("--reencode_recall_queries", type=int, default=1000,
+                        help="training queries sampled for that recall report")
+    return parser
+
+
+class PassageSubset:
+    """The passages at `positions` of a passage list (or `StorePassages`), sliceable like the list"""
+
+    def __init__(self, passages, positions):
+        self.passages = passages
+        self.positions = positions
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return PassageSubset(self.passages, self.positions[index])
+        return self.passages[int(self.positions[index])]
+
+
+class CachedRowWriter:
+    """`embed_passages` writer that puts the i-th encoded passage into cache row `positions[i]`"""
+
+    def __init__(self, cache, positions, step):
+        self.cache = cache
+        self.positions = positions
+        self.step = step
+        self.completed = 0
+        self._embeddings = cache.open_embeddings('r+')
+        self._steps = cache.open_steps('r+')
+
+    def append(self, ids, embeddings):
+        rows = self.positions[self.completed:self.completed + len(embeddings)]
+        self._embeddings[rows] = embeddings
+        self._steps[rows] = self.step
+        self.completed += len(embeddings)
+
+    def close(self):
+        self._embeddings.flush()
+        self._steps.flush()
+
+
+class EmbeddingCache:
+    """Passage embeddings kept across refreshes in `cache_dir`: row i holds passage position i
+    (the order of `RenewTools.passages`) and `steps[i]` the checkpoint step it was encoded with.
+
+    A full refresh is written by `EmbeddingShardWriter` as usual and becomes the cache through
+    `promote`; budgeted refreshes then overwrite only the rows of their plan in place.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.meta_path = os.path.join(cache_dir, CACHE_NAME + '.json')
+        self.steps_path = os.path.join(cache_dir, CACHE_NAME + '.steps.npy')
+        self.ids_path = os.path.join(cache_dir, CACHE_NAME + '.ids.npy')
+        self.meta = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as f:
+                self.meta = json.load(f)
+
+    @property
+    def exists(self):
+        return self.meta is not None and self.meta.get('dim') is not None
+
+    def _write_meta(self):
+        with open(self.meta_path + '.tmp', 'w') as f:
+            json.dump(self.meta, f, indent=2)
+        os.replace(self.meta_path + '.tmp', self.meta_path)
+
+    def open_embeddings(self, mode='r'):
+        return np.memmap(embedding_path(self.cache_dir, CACHE_NAME), dtype=np.dtype(self.meta['dtype']), mode=mode,
+                         shape=(self.meta['num_rows'], self.meta['dim']))
+
+    def open_steps(self, mode='r'):
+        return np.load(self.steps_path, mmap_mode=mode)
+
+    def ids(self):
+        return np.load(self.ids_path)
+
+    def positions_of(self, ids):
+        """cache rows of passage ids"""
+        cache_ids = self.ids()
+        if np.array_equal(cache_ids, np.arange(len(cache_ids))):
+            return np.asarray(ids, dtype=np.int64)
+        position = np.full(int(cache_ids.max()) + 1, -1, dtype=np.int64)
+        position[cache_ids] = np.arange(len(cache_ids))
+        return position[ids]
+
+    def mark_pending(self, manifest, output_dir, name):
+        """Remember the full refresh `{name}` (written by `EmbeddingShardWriter`) to `promote` at the next refresh"""
+        self.meta = dict(self.meta or {}, pending={'output_dir': output_dir, 'name': name, 'step': manifest['step'],
+                                                   'num_rows': manifest['num_rows'], 'dim': manifest['dim'],
+                                                   'dtype': manifest['dtype']})
+        self._write_meta()
+
+    def promote(self):
+        """Move a pending full refresh into the cache, every row now comes from its step"""
+        pending = self.meta and self.meta.get('pending')
+        if not pending:
+            return False
+        ids = EmbeddingShards(pending['output_dir'], pending['name']).ids
+        os.replace(embedding_path(pending['output_dir'], pending['name']), embedding_path(self.cache_dir, CACHE_NAME))
+        np.save(self.ids_path, np.asarray(ids, dtype=np.int64))
+        np.save(self.steps_path, np.full(pending['num_rows'], pending['step'], dtype=np.int64))
+        self.meta = {'num_rows': pending['num_rows'], 'dim': pending['dim'], 'dtype': pending['dtype'],
+                     'cursor': self.meta.get('cursor', 0), 'refreshes': self.meta.get('refreshes', 0)}
+        self._write_meta()
+        logger.info('Embedding cache now holds the full refresh of step %d', pending['step'])
+        return True
+
+    def plan(self, step, budget, rotate_fraction=0.25, candidates=None):
+        """Sorted cache rows to re-encode at `step`: the stalest `candidates` (cache rows) plus the next
+        rows of the rotating slice, `budget` rows in total"""
+        steps = np.asarray(self.open_steps())
+        num_rows = len(steps)
+        num_rotate = int(budget * rotate_fraction)
+        selected = np.flatnonzero(steps == NEVER_ENCODED)
+        if candidates is not None and len(candidates) > 0:
+            candidates = np.unique(candidates)
+            candidates = candidates[(candidates >= 0) & (steps[candidates] != step)]
+            num_priority = max(budget - num_rotate - len(selected), 0)
+            if len(candidates) > num_priority:
+                # oldest embeddings first
+                candidates = candidates[np.argsort(steps[candidates], kind='stable')[:num_priority]]
+            selected = np.union1d(selected, candidates)
+        cursor = self.meta.get('cursor', 0)
+        num_rotate = min(max(budget - len(selected), num_rotate), num_rows)
+        selected = np.union1d(selected, (cursor + np.arange(num_rotate, dtype=np.int64)) % num_rows)
+        self.meta['cursor'] = int((cursor + num_rotate) % num_rows)
+        self.meta['refreshes'] = self.meta.get('refreshes', 0) + 1
+        self._write_meta()
+        return selected.astype(np.int64)
+
+    def staleness(self, step, candidates=None):
+        """How many steps behind `step` the cached embeddings are, over the corpus and over `candidates`"""
+        steps = np.asarray(self.open_steps())
+        encoded = steps != NEVER_ENCODED
+        age = step - steps[encoded]
+        report = {'step': step, 'current_fraction': float(np.mean(steps == step)),
+                  'never_encoded': int(np.sum(~encoded)),
+                  'mean_age': float(age.mean()) if len(age) else 0.0,
+                  'max_age': int(age.max()) if len(age) else 0}
+        if candidates is not None and len(candidates) > 0:
+            candidate_steps = steps[np.unique(candidates)]
+            report['candidate_current_fraction'] = float(np.mean(candidate_steps == step))
+            report['candidate_mean_age'] = float(np.mean(step - candidate_steps))
+        return report
+
+
+class OverlayEmbeddings:
+    """`base` rows with the `rows` replaced by those of `overlay`, read in slices like a memmap"""
+
+    def __init__(self, base, overlay, rows):
+        self.base = base
+        self.overlay = overlay
+        self.rows = np.asarray(rows, dtype=np.int64)
+        self.shape = base.shape
+
+    def __len__(self):
+        return len(self.base)
+
+    def __getitem__(self, index):
+        start, stop, _ = index.indices(len(self))
+        block = np.array(self.base[start:stop], dtype=np.float32)
+        rows = self.rows[(self.rows >= start) & (self.rows < stop)]
+        block[rows - start] = self.overlay[rows]
+        return block
+
+
+def budget_recall(fresh, stale, rows, queries, k=200, num_queries=1000, seed=0, block_size=262144):
+    """Recall@k of mining with the cache after re-encoding only `rows`, against a full refresh"""
+    if len(queries) > num_queries:
+        queries = queries[np.sort(np.random.RandomState(seed).choice(len(queries), num_queries, replace=False))]
+    _, exact_ids = BlockedExactIndex(fresh, block_size=block_size).search(queries, k)
+    _, budget_ids = BlockedExactIndex(OverlayEmbeddings(stale, fresh, rows), block_size=block_size).search(queries, k)
+    hits = sum(len(np.intersect1d(budget, exact)) for budget, exact in zip(budget_ids, exact_ids))
+    return hits / float(exact_ids.size)
@@ -0,0 +1,279 @@
+import sys
+
+sys.path += ['../']
+import argparse
+import json
+import logging
+import os
+import time
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+
+NEGATIVE_FILE_SUFFIX = '.negbin'
+_ARRAYS = ['qids', 'query_offsets', 'pos_offsets', 'pos_pids', 'pos_scores',
+           'neg_offsets', 'neg_pids', 'neg_scores']
+
+
+def negative_file_path(save_path, q_type, global_step, file_format='tsv'):
+    """`{q_type}_ce_{step}.tsv` or its binary counterpart `{q_type}_ce_{step}.negbin`"""
+    suffix = NEGATIVE_FILE_SUFFIX if file_format == 'bin' else '.tsv'
+    return os.path.join(save_path, q_type + '_ce_' + str(global_step) + suffix)
+
+
+def is_negative_file(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, 'meta.json'))
+
+
+def latest_negatives_path(save_path, q_type):
+    return os.path.join(save_path, q_type + '_ce_latest.json')
+
+
+def publish_negatives(save_path, q_type, global_step, path):
+    """Point `{q_type}_ce_latest.json` at the negatives mined with checkpoint `global_step`.
+
+    The pointer is replaced atomically, so a reader never sees it half written or pointing at
+    a file that is still being written.
+    """
+    pointer = latest_negatives_path(save_path, q_type)
+    with open(pointer + '.tmp', 'w') as f:
+        json.dump({'step': global_step, 'path': path, 'time': time.time()}, f)
+    os.replace(pointer + '.tmp', pointer)
+    logger.info('Published %s negatives of step %d: %s', q_type, global_step, path)
+
+
+def training_done_path(output_dir):
+    return os.path.join(output_dir, 'training_done.json')
+
+
+def mark_training_done(output_dir, global_step):
+    """Tell co_training_marco_refresher.py that training of `output_dir` ended at `global_step`"""
+    marker = training_done_path(output_dir)
+    with open(marker + '.tmp', 'w') as f:
+        json.dump({'step': global_step, 'time': time.time()}, f)
+    os.replace(marker + '.tmp', marker)
+
+
+def clear_training_done(output_dir):
+    if os.path.exists(training_done_path(output_dir)):
+        os.remove(training_done_path(output_dir))
+
+
+def training_done(output_dir):
+    """`{'step', 'time'}` of `mark_training_done`, None while training is running"""
+    marker = training_done_path(output_dir)
+    if not os.path.exists(marker):
+        return None
+    with open(marker, 'r') as f:
+        return json.load(f)
+
+
+def latest_negatives(save_path, q_type):
+    """`{'step', 'path', 'time'}` of the last `publish_negatives`, None if nothing was published"""
+    pointer = latest_negatives_path(save_path, q_type)
+    if not os.path.exists(pointer):
+        return None
+    with open(pointer, 'r') as f:
+        return json.load(f)
+
+
+class NegativeFileWriter:
+    """Collects per-query positives / mined negatives and writes them as a directory of .npy arrays.
+
+    Layout: `qids` [Q], `neg_offsets` / `pos_offsets` [Q+1] into the flat int32 `*_pids` and
+    float16 `*_scores` arrays, and the query strings as one utf-8 blob indexed by `query_offsets`.
+    `to_negative_file` hands the same arrays over in memory instead (`path` may then be None).
+    """
+
+    def __init__(self, path, score_dtype=np.float16):
+        self.path = path
+        self.score_dtype = np.dtype(score_dtype)
+        self.qids = []
+        self.queries = []
+        self.pos_pids, self.pos_scores, self.pos_lens = [], [], []
+        self.neg_pids, self.neg_scores, self.neg_lens = [], [], []
+
+    def add(self, qid, query, pos_pids, pos_scores, neg_pids, neg_scores):
+        self.qids.append(int(qid))
+        self.queries.append(query.encode('utf-8'))
+        self.pos_pids.append(np.asarray(pos_pids, dtype=np.int32))
+        self.pos_scores.append(np.asarray(pos_scores, dtype=self.score_dtype))
+        self.pos_lens.append(len(pos_pids))
+        self.neg_pids.append(np.asarray(neg_pids, dtype=np.int32))
+        self.neg_scores.append(np.asarray(neg_scores, dtype=self.score_dtype))
+        self.neg_lens.append(len(neg_pids))
+
+    def _build_arrays(self):
+        def offsets(lens):
+            return np.concatenate([[0], np.cumsum(lens, dtype=np.int64)]).astype(np.int64)
+
+        def concat(arrays, dtype):
+            return np.concatenate(arrays).astype(dtype) if len(arrays) > 0 else np.zeros(0, dtype=dtype)
+
+        arrays = {
+            'qids': np.asarray(self.qids, dtype=np.int64),
+            'query_offsets': offsets([len(q) for q in self.queries]),
+            'pos_offsets': offsets(self.pos_lens),
+            'pos_pids': concat(self.pos_pids, np.int32),
+            'pos_scores': concat(self.pos_scores, self.score_dtype),
+            'neg_offsets': offsets(self.neg_lens),
+            'neg_pids': concat(self.neg_pids, np.int32),
+            'neg_scores': concat(self.neg_scores, self.score_dtype),
+        }
+        return arrays, np.frombuffer(bytearray(b''.join(self.queries)), dtype=np.uint8)
+
+    def to_negative_file(self):
+        arrays, queries = self._build_arrays()
+        return NegativeFile.from_arrays(arrays, queries)
+
+    def close(self):
+        os.makedirs(self.path, exist_ok=True)
+        arrays, queries = self._build_arrays()
+        for name, array in arrays.items():
+            np.save(os.path.join(self.path, name + '.npy'), array)
+        with open(os.path.join(self.path, 'queries.bin'), 'wb') as f:
+            f.write(queries.tobytes())
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump({'num_queries': len(self.qids), 'score_dtype': self.score_dtype.name}, f, indent=2)
+        logger.info('Wrote %d queries / %d negatives to %s', len(self.qids), len(arrays['neg_pids']), self.path)
+
+
+class NegativeFile:
+    """Zero-copy reader for files written by `NegativeFileWriter`.
+
+    Arrays are memory-mapped lazily per process; `shard(trainer_id, trainer_num)` keeps the
+    same `i % trainer_num == trainer_id` split as `csv_reader`.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json'), 'r') as f:
+            self.meta = json.load(f)
+        self.num_queries = self.meta['num_queries']
+        self._arrays = None
+        self._queries = None
+
+    @classmethod
+    def from_arrays(cls, arrays, queries):
+        """In-memory file over arrays laid out like the files of `NegativeFileWriter`"""
+        negative_file = cls.__new__(cls)
+        negative_file.path = None
+        negative_file.meta = {'num_queries': len(arrays['qids']), 'score_dtype': arrays['neg_scores'].dtype.name}
+        negative_file.num_queries = negative_file.meta['num_queries']
+        negative_file._arrays = arrays
+        negative_file._queries = queries
+        return negative_file
+
+    def _open(self):
+        if self._arrays is not None:
+            return
+        self._arrays = {name: np.load(os.path.join(self.path, name + '.npy'), mmap_mode='r') for name in _ARRAYS}
+        if self._arrays['query_offsets'][-1] > 0:
+            self._queries = np.memmap(os.path.join(self.path, 'queries.bin'), dtype=np.uint8, mode='r')
+        else:
+            self._queries = np.zeros(0, dtype=np.uint8)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if self.path is not None:
+            state['_arrays'] = None
+            state['_queries'] = None
+        return state
+
+    def __len__(self):
+        return self.num_queries
+
+    def qid(self, index):
+        self._open()
+        return int(self._arrays['qids'][index])
+
+    def query(self, index):
+        self._open()
+        offsets = self._arrays['query_offsets']
+        return self._queries[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def positives(self, index):
+        """(pids, scores) views of the positives of query `index`"""
+        self._open()
+        start, end = self._arrays['pos_offsets'][index], self._arrays['pos_offsets'][index + 1]
+        return self._arrays['pos_pids'][start:end], self._arrays['pos_scores'][start:end]
+
+    def negatives(self, index):
+        """(pids, scores) views of the ranked negatives of query `index`"""
+        self._open()
+        start, end = self._arrays['neg_offsets'][index], self._arrays['neg_offsets'][index + 1]
+        return self._arrays['neg_pids'][start:end], self._arrays['neg_scores'][start:end]
+
+    def shard(self, trainer_id=0, trainer_num=1):
+        return NegativeFileShard(self, np.arange(trainer_id, self.num_queries, trainer_num))
+
+
+class NegativeFileShard:
+    """Rows of a `NegativeFile` selected by index, used as the `data` of the training datasets"""
+
+    def __init__(self, negative_file, indices):
+        self.negative_file = negative_file
+        self.indices = indices
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, index):
+        return int(self.indices[index])
+
+
+def broadcast_negative_file(negative_file, device, src=0):
+    """Copy the `NegativeFile` of rank `src` to every rank as an in-memory file, one tensor broadcast per array"""
+    import torch
+    import torch.distributed as dist
+
+    if dist.get_rank() == src:
+        negative_file._open()
+        arrays = dict(negative_file._arrays, queries=negative_file._queries)
+        layout = [(name, arrays[name].dtype.str, arrays[name].shape) for name in _ARRAYS + ['queries']]
+    else:
+        layout = None
+    layout_list = [layout]
+    dist.broadcast_object_list(layout_list, src=src)
+
+    received = {}
+    for name, dtype, shape in layout_list[0]:
+        if dist.get_rank() == src:
+            tensor = torch.from_numpy(np.array(arrays[name])).to(device)
+        else:
+            tensor = torch.empty(shape, dtype=torch.from_numpy(np.zeros(0, dtype=dtype)).dtype, device=device)
+        if tensor.numel() > 0:
+            dist.broadcast(tensor, src=src)
+        received[name] = tensor.cpu().numpy()
+    queries = received.pop('queries')
+    return NegativeFile.from_arrays(received, queries)
+
+
+def convert_tsv(tsv_path, out_path, score_dtype=np.float16):
+    """Convert a `qid \\t query \\t pid score,... \\t pid score,...` file written by `write_to_file`."""
+    writer = NegativeFileWriter(out_path, score_dtype=score_dtype)
+    with open(tsv_path, 'r', encoding='utf8') as f:
+        for line in tqdm(f, desc='convert ' + os.path.basename(tsv_path)):
+            qid, query, pos, neg = line.rstrip('\n').split('\t')
+            pos_pairs = [pair.split() for pair in pos.split(',')] if pos else []
+            neg_pairs = [pair.split() for pair in neg.split(',')] if neg else []
+            writer.add(qid, query,
+                       [int(pair[0]) for pair in pos_pairs], [float(pair[1]) for pair in pos_pairs],
+                       [int(pair[0]) for pair in neg_pairs], [float(pair[1]) for pair in neg_pairs])
+    writer.close()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input_file", type=str, required=True, help="e.g. data/MS-Pas/train_ce_0.tsv")
+    parser.add_argument("--output_file", type=str, default=None, help="defaults to the input path with .negbin")
+    args = parser.parse_args()
+    output_file = args.output_file or os.path.splitext(args.input_file)[0] + NEGATIVE_FILE_SUFFIX
+    convert_tsv(args.input_file, output_file)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import logging
+import os
+import random
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def simans_logits(neg_scores, pos_scores, kernel='square', a=0.5, b=0.0):
+    """log of the SimANS sampling weights.
+
+    `square`: -a * (s_neg - s_pos + b) ** 2 (Doc_v2Dataset / TraditionDataset)
+    `abs`:    -a * |s_neg - s_pos|          (Rocketqa_v2Dataset, a = tau)
+    """
+    diff = np.asarray(neg_scores, dtype=np.float32) - np.asarray(pos_scores, dtype=np.float32)
+    if kernel == 'abs':
+        return -a * np.abs(diff)
+    if kernel == 'square':
+        return -a * (diff + b) ** 2
+    raise ValueError('unknown SimANS kernel: {}'.format(kernel))
+
+
+def _csr_offsets(lengths):
+    return np.concatenate([[0], np.cumsum(lengths, dtype=np.int64)]).astype(np.int64)
+
+
+def csr_take(values, offsets, rows):
+    """Rows `rows` of a CSR layout (`values[offsets[i]:offsets[i + 1]]` is row i) as a new (values, offsets)"""
+    rows = np.asarray(rows, dtype=np.int64)
+    starts, lengths = offsets[rows], offsets[rows + 1] - offsets[rows]
+    new_offsets = _csr_offsets(lengths)
+    gather = np.repeat(starts - new_offsets[:-1], lengths) + np.arange(new_offsets[-1], dtype=np.int64)
+    return np.asarray(values)[gather], new_offsets
+
+
+class SimANSSampler:
+    """Ambiguous-negative sampler with the weights of every (query, positive) precomputed.
+
+    Built once from the per-query positive / negative scores in CSR layout. Each positive of
+    query q owns a row of log-weights over q's negatives, and `sample` draws k distinct
+    negatives from a row in one shot with the Gumbel-top-k trick, which is the same
+    distribution as drawing them one by one without replacement.
+    """
+
+    def __init__(self, pos_scores, pos_offsets, neg_scores, neg_offsets, kernel='square', a=0.5, b=0.0):
+        pos_offsets = np.asarray(pos_offsets, dtype=np.int64)
+        neg_offsets = np.asarray(neg_offsets, dtype=np.int64)
+        num_pos = np.diff(pos_offsets)
+        num_neg = np.diff(neg_offsets)
+        row_query = np.repeat(np.arange(len(num_pos), dtype=np.int64), num_pos)
+        row_len = num_neg[row_query]
+
+        self.pos_offsets = pos_offsets
+        self.pos_scores = np.asarray(pos_scores, dtype=np.float32)
+        self.row_offsets = _csr_offsets(row_len)
+        gather = np.repeat(neg_offsets[row_query] - self.row_offsets[:-1], row_len) + \
+            np.arange(self.row_offsets[-1], dtype=np.int64)
+        self.logits = simans_logits(np.asarray(neg_scores, dtype=np.float32)[gather],
+                                    np.repeat(self.pos_scores, row_len), kernel=kernel, a=a, b=b)
+        self._rng = None
+        self._rng_pid = None
+        logger.info('SimANS sampler: %d queries, %d positives, %d weights', len(num_pos), len(row_len),
+                    len(self.logits))
+
+    @classmethod
+    def from_score_lists(cls, pos_score_lists, neg_score_lists, **kwargs):
+        pos_scores = np.concatenate([np.asarray(s, dtype=np.float32) for s in pos_score_lists] or [np.zeros(0)])
+        neg_scores = np.concatenate([np.asarray(s, dtype=np.float32) for s in neg_score_lists] or [np.zeros(0)])
+        return cls(pos_scores, _csr_offsets([len(s) for s in pos_score_lists]),
+                   neg_scores, _csr_offsets([len(s) for s in neg_score_lists]), **kwargs)
+
+    @classmethod
+    def from_negative_file(cls, negative_file, rows, **kwargs):
+        """Sampler over `rows` of a `utils.negative_file.NegativeFile`, in that order"""
+        negative_file._open()
+        arrays = negative_file._arrays
+        pos_scores, pos_offsets = csr_take(arrays['pos_scores'], arrays['pos_offsets'], rows)
+        neg_scores, neg_offsets = csr_take(arrays['neg_scores'], arrays['neg_offsets'], rows)
+        return cls(pos_scores, pos_offsets, neg_scores, neg_offsets, **kwargs)
+
+    @property
+    def rng(self):
+        # seeded from `random` in each process, which torch reseeds in every DataLoader worker
+        if self._rng is None or self._rng_pid != os.getpid():
+            self._rng = np.random.default_rng(random.getrandbits(64))
+            self._rng_pid = os.getpid()
+        return self._rng
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_rng'] = None
+        state['_rng_pid'] = None
+        return state
+
+    def num_positives(self, query_index):
+        return int(self.pos_offsets[query_index + 1] - self.pos_offsets[query_index])
+
+    def pos_score(self, query_index, pos_index):
+        return float(self.pos_scores[self.pos_offsets[query_index] + pos_index])
+
+    def sample(self, query_index, pos_index, k):
+        """positions (into the query's negative list) of k distinct sampled negatives"""
+        row = self.pos_offsets[query_index] + pos_index
+        logits = self.logits[self.row_offsets[row]:self.row_offsets[row + 1]]
+        if k >= len(logits):
+            return self.rng.permutation(len(logits))
+        keys = logits + self.rng.gumbel(size=len(logits))
+        top = np.argpartition(-keys, k - 1)[:k]
+        return top[np.argsort(-keys[top])]
+
+
+def pair_scores(pairs):
+    """scores of a `pid score,pid score,...` field of train_ce_{step}.tsv"""
+    return np.asarray(pairs.replace(',', ' ').split()[1::2], dtype=np.float32)
@@ -0,0 +1,60 @@
+import logging
+import torch
+
+logger = logging.getLogger(__name__)
+
+# (qid, pid) pairs are packed into one int key, pids stay below 2 ** PID_BITS
+PID_BITS = 32
+
+
+class TeacherScoreCache:
+    """Cross-encoder logits of (qid, pid) pairs, valid as long as the teacher weights do not change.
+
+    `scores(teacher, teacher_step, qids, pids, input_ids, attention_mask)` returns the [B, D]
+    logits the teacher gives the pairs of a batch. Pairs already scored at the same `teacher_step`
+    are read from the cache and only the others go through the teacher, flattened into a single
+    [1, misses, L] call. A new `teacher_step` (the teacher was trained since) empties the cache,
+    as does reaching `max_entries` pairs.
+    """
+
+    def __init__(self, max_entries=5000000):
+        self.max_entries = max_entries
+        self.teacher_step = None
+        self._scores = {}
+        self.lookups = 0
+        self.hits = 0
+
+    def __len__(self):
+        return len(self._scores)
+
+    @property
+    def hit_rate(self):
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    def reset_stats(self):
+        self.lookups = 0
+        self.hits = 0
+
+    def scores(self, teacher, teacher_step, qids, pids, input_ids, attention_mask):
+        if teacher_step != self.teacher_step:
+            self._scores.clear()
+            self.teacher_step = teacher_step
+        keys = ((qids.long().view(-1, 1) << PID_BITS) | pids.long()).view(-1).tolist()
+        cached = [self._scores.get(key) for key in keys]
+        missing = [i for i, score in enumerate(cached) if score is None]
+        self.lookups += len(keys)
+        self.hits += len(keys) - len(missing)
+        logits = torch.tensor([0.0 if score is None else score for score in cached], dtype=torch.float32,
+                              device=input_ids.device)
+        if missing:
+            rows = torch.tensor(missing, dtype=torch.long, device=input_ids.device)
+            seq_len = input_ids.size(-1)
+            new_logits = teacher(input_ids=input_ids.reshape(-1, seq_len)[rows].unsqueeze(0),
+                                 attention_mask=attention_mask.reshape(-1, seq_len)[rows].unsqueeze(0))
+            new_logits = new_logits.reshape(-1).float()
+            logits[rows] = new_logits
+            if len(self._scores) + len(missing) > self.max_entries:
+                logger.info('Teacher score cache full (%d pairs), emptying it', len(self._scores))
+                self._scores.clear()
+            self._scores.update(zip([keys[i] for i in missing], new_logits.tolist()))
+        return logits.view(pids.shape)
@@ -0,0 +1,295 @@
+import sys
+
+sys.path += ['../']
+import argparse
+import csv
+import json
+import logging
+import os
+from multiprocessing import Pool
+import numpy as np
+from tqdm import tqdm
+
+logger = logging.getLogger(__name__)
+csv.field_size_limit(sys.maxsize)
+
+TOKEN_SUFFIX = '.tokens.int32'
+OFFSET_SUFFIX = '.offsets.npy'
+KEY_SUFFIX = '.keys.npy'
+META_SUFFIX = '.meta.json'
+
+
+def tokenizer_tag(tokenizer):
+    name = getattr(tokenizer, 'name_or_path', None) or type(tokenizer).__name__
+    return os.path.basename(os.path.normpath(name)).replace('/', '_')
+
+
+def cache_prefix(cache_dir, name, tokenizer, max_length):
+    """Caches are keyed by content name, tokenizer and max length, e.g. `passage.bert-base-uncased.128`"""
+    return os.path.join(cache_dir, '{}.{}.{}'.format(name, tokenizer_tag(tokenizer), max_length))
+
+
+def cache_exists(prefix):
+    return all(os.path.exists(prefix + suffix) for suffix in [TOKEN_SUFFIX, OFFSET_SUFFIX, KEY_SUFFIX, META_SUFFIX])
+
+
+class TokenCache:
+    """Read-only, memory-mapped `key -> int32 token ids` lookup written by `build_token_cache`.
+
+    The ids are stored exactly as `tokenizer.encode(..., add_special_tokens=True, truncation=True)`
+    returns them, without padding.
+    """
+
+    def __init__(self, prefix):
+        self.prefix = prefix
+        with open(prefix + META_SUFFIX, 'r') as f:
+            self.meta = json.load(f)
+        self.num_records = self.meta['num_records']
+        self.dense_keys = self.meta['dense_keys']
+        self._tokens = None
+        self._offsets = None
+        self._keys = None
+        self._sorted_pos = None
+        self._sorted_keys = None
+
+    def _open(self):
+        if self._offsets is not None:
+            return
+        self._offsets = np.load(self.prefix + OFFSET_SUFFIX, mmap_mode='r')
+        self._keys = np.load(self.prefix + KEY_SUFFIX, mmap_mode='r')
+        if self._offsets[-1] > 0:
+            self._tokens = np.memmap(self.prefix + TOKEN_SUFFIX, dtype=np.int32, mode='r')
+        else:
+            self._tokens = np.zeros(0, dtype=np.int32)
+        if not self.dense_keys:
+            self._sorted_pos = np.argsort(self._keys, kind='stable')
+            self._sorted_keys = np.asarray(self._keys)[self._sorted_pos]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ['_tokens', '_offsets', '_keys', '_sorted_pos', '_sorted_keys']:
+            state[key] = None
+        return state
+
+    def position(self, key):
+        self._open()
+        key = int(key)
+        if self.dense_keys:
+            return key if 0 <= key < self.num_records else -1
+        i = int(np.searchsorted(self._sorted_keys, key))
+        if i < self.num_records and self._sorted_keys[i] == key:
+            return int(self._sorted_pos[i])
+        return -1
+
+    def get(self, key, default=None):
+        position = self.position(key)
+        if position < 0:
+            return default
+        return self._tokens[self._offsets[position]:self._offsets[position + 1]]
+
+    def __getitem__(self, key):
+        token_ids = self.get(key)
+        if token_ids is None:
+            raise KeyError(key)
+        return token_ids
+
+    def __contains__(self, key):
+        return self.position(key) >= 0
+
+    def __len__(self):
+        return self.num_records
+
+
+def load_token_cache(cache_dir, name, tokenizer, max_length):
+    """Return the `TokenCache` for (name, tokenizer, max_length) under `cache_dir`, None if not built."""
+    if not cache_dir:
+        return None
+    prefix = cache_prefix(cache_dir, name, tokenizer, max_length)
+    if not cache_exists(prefix):
+        logger.warning('Token cache %s not found, falling back to on-the-fly tokenization', prefix)
+        return None
+    logger.info('Using token cache %s', prefix)
+    return TokenCache(prefix)
+
+
+def pad_token_arrays(token_arrays, max_length, pad_token_id):
+    """[n, max_length] int64 array of right-padded (and truncated) token ids"""
+    out = np.full((len(token_arrays), max_length), pad_token_id, dtype=np.int64)
+    for i, token_ids in enumerate(token_arrays):
+        token_ids = token_ids[:max_length]
+        out[i, :len(token_ids)] = token_ids
+    return out
+
+
+def cross_encoder_token_arrays(question_ids, ctx_token_arrays, sep_token_id, max_length, pad_token_id):
+    """Same ids as `question_token_ids + remove_special_token(ctx_token_id)` in the datasets, padded to max_length"""
+    question_ids = np.asarray(question_ids)[:max_length]
+    q_len = len(question_ids)
+    out = np.full((len(ctx_token_arrays), max_length), pad_token_id, dtype=np.int64)
+    out[:, :q_len] = question_ids
+    for i, ctx_ids in enumerate(ctx_token_arrays):
+        body = ctx_ids[1:-1] if ctx_ids[-1] == sep_token_id else ctx_ids[1:]
+        body = body[:max_length - q_len]
+        out[i, q_len:q_len + len(body)] = body
+    return out
+
+
+# ---------------------------- preprocessing ----------------------------
+
+_worker_tokenizer = None
+_worker_max_length = None
+
+
+def _init_worker(tokenizer_name, lower_case, star_tokenizer, max_length):
+    global _worker_tokenizer, _worker_max_length
+    _worker_tokenizer = load_tokenizer(tokenizer_name, lower_case, star_tokenizer)
+    _worker_max_length = max_length
+
+
+def _encode_chunk(chunk):
+    results = []
+    for key, text, text_pair in chunk:
+        token_ids = _worker_tokenizer.encode(text, text_pair=text_pair, add_special_tokens=True,
+                                             max_length=_worker_max_length, truncation=True)
+        results.append((key, token_ids))
+    return results
+
+
+def load_tokenizer(tokenizer_name, lower_case=True, star_tokenizer=False):
+    if star_tokenizer:
+        sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Doc_training'))
+        from star_tokenizer import RobertaTokenizer
+        return RobertaTokenizer.from_pretrained(tokenizer_name, do_lower_case=lower_case)
+    from transformers import BertTokenizer
+    return BertTokenizer.from_pretrained(tokenizer_name, do_lower_case=lower_case)
+
+
+def chunked(records, chunk_size):
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+
+def build_token_cache(prefix, records, args, max_length, tokenizer):
+    """Tokenize `(key, text, text_pair)` records with a process pool and write them as a flat int32 file.
+
+    Records keep their input order, keys must be ints.
+    """
+    keys, offsets = [], [0]
+    os.makedirs(os.path.dirname(os.path.abspath(prefix)), exist_ok=True)
+    with Pool(args.num_workers, initializer=_init_worker,
+              initargs=(args.tokenizer_name, not args.no_lower_case, args.star_tokenizer, max_length)) as pool, \
+            open(prefix + TOKEN_SUFFIX, 'wb') as out:
+        for results in tqdm(pool.imap(_encode_chunk, chunked(records, args.chunk_size)),
+                            desc='tokenize ' + os.path.basename(prefix)):
+            for key, token_ids in results:
+                out.write(np.asarray(token_ids, dtype=np.int32).tobytes())
+                keys.append(key)
+                offsets.append(offsets[-1] + len(token_ids))
+    keys = np.asarray(keys, dtype=np.int64)
+    dense = bool(len(keys) > 0 and np.array_equal(keys, np.arange(len(keys), dtype=np.int64)))
+    np.save(prefix + OFFSET_SUFFIX, np.asarray(offsets, dtype=np.int64))
+    np.save(prefix + KEY_SUFFIX, keys)
+    with open(prefix + META_SUFFIX, 'w') as f:
+        json.dump({'num_records': int(len(keys)), 'dense_keys': dense, 'max_length': max_length,
+                   'tokenizer': tokenizer_tag(tokenizer)}, f, indent=2)
+    logger.info('Wrote %d records / %d tokens to %s', len(keys), offsets[-1], prefix)
+
+
+def _passage_store_module():
+    try:
+        import utils.passage_store as passage_store
+    except ImportError:  # run as `python utils/token_cache.py`
+        import passage_store
+    return passage_store
+
+
+def marco_pas_records(corpus_path):
+    """title/passage pairs, same inputs as Rocketqa_v2Dataset"""
+    load_passage_store = _passage_store_module().load_passage_store
+    title_path = os.path.join(corpus_path, 'para.title.txt')
+    p_title = load_passage_store(title_path)
+    if p_title is None:
+        p_title = {}
+        with open(title_path) as inp:
+            for line in tqdm(inp, desc='load titles'):
+                id, text = line.strip().split('\t')
+                p_title[int(id)] = text
+    with open(os.path.join(corpus_path, 'para.txt')) as inp:
+        for line in inp:
+            id, text = line.strip().split('\t')
+            yield int(id), p_title.get(int(id), '-'), text
+
+
+def marco_doc_records(corpus_path):
+    """url<sep>title<sep>body documents, same inputs as Doc_v2Dataset"""
+    parse_marco_doc_line = _passage_store_module().parse_marco_doc_line
+    with open(os.path.join(corpus_path, 'msmarco-docs.tsv')) as inp:
+        for line in inp:
+            p_id, full_text = parse_marco_doc_line(line)
+            yield p_id, full_text, None
+
+
+def wiki_records(corpus_path):
+    """psgs_w100.tsv title/passage pairs, same inputs as LEAD TraditionDataset (ids shifted to start at 0)"""
+    with open(corpus_path) as fin:
+        reader = csv.reader(fin, delimiter='\t')
+        for row in reader:
+            if not row[0] == 'id':
+                yield int(row[0]) - 1, row[2], row[1].strip()
+
+
+def query_records(query_files):
+    for query_file in query_files:
+        with open(query_file, 'r', encoding='utf-8') as inp:
+            for line in inp:
+                id, text = line.strip().split('\t')[:2]
+                yield int(id), text, None
+
+
+CORPUS_RECORDS = {
+    'marco_pas': marco_pas_records,
+    'marco_doc': marco_doc_records,
+    'wiki': wiki_records,
+}
+
+
+def get_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--corpus_path", type=str, default=None,
+                        help="data/MS-Pas, data/MS-Doc or the psgs_w100.tsv file")
+    parser.add_argument("--corpus_format", type=str, default='marco_pas', choices=list(CORPUS_RECORDS.keys()))
+    parser.add_argument("--query_files", nargs='*', default=[], help="`qid \\t query` files, e.g. train.query.txt")
+    parser.add_argument("--cache_dir", type=str, required=True)
+    parser.add_argument("--tokenizer_name", type=str, default='bert-base-uncased')
+    parser.add_argument("--no_lower_case", default=False, action="store_true")
+    parser.add_argument("--star_tokenizer", default=False, action="store_true",
+                        help="use Doc_training/star_tokenizer.RobertaTokenizer (MS-Doc)")
+    parser.add_argument("--max_seq_length", type=int, default=128)
+    parser.add_argument("--max_query_length", type=int, default=32)
+    parser.add_argument("--num_workers", type=int, default=16)
+    parser.add_argument("--chunk_size", type=int, default=2048)
+    return parser.parse_args()
+
+
+def main():
+    logging.basicConfig(format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+                        datefmt="%m/%d/%Y %H:%M:%S", level=logging.INFO)
+    args = get_arguments()
+    tokenizer = load_tokenizer(args.tokenizer_name, not args.no_lower_case, args.star_tokenizer)
+    if args.corpus_path is not None:
+        records = CORPUS_RECORDS[args.corpus_format](args.corpus_path)
+        build_token_cache(cache_prefix(args.cache_dir, 'passage', tokenizer, args.max_seq_length),
+                          records, args, args.max_seq_length, tokenizer)
+    if len(args.query_files) > 0:
+        build_token_cache(cache_prefix(args.cache_dir, 'query', tokenizer, args.max_query_length),
+                          query_records(args.query_files), args, args.max_query_length, tokenizer)
+
+
+if __name__ == "__main__":
+    main()
@@ -26,6 +26,7 @@ import re
 from typing import List, Set, Dict, Tuple, Callable, Iterable, Any
 import collections
 import math
+from utils.simans_sampler import SimANSSampler
 
 logger = logging.getLogger(__name__)
 BiEncoderPassage = collections.namedtuple("BiEncoderPassage", ["text", "title", "score", "passage_id"])
@@ -568,6 +569,10 @@ class TraditionDataset(Dataset):
         self.shuffle_positives = shuffle_positives
         self.a = a
         self.b = b
+        self.sampler = SimANSSampler.from_score_lists(
+            [[float(ctx['score']) for ctx in r['positive_ctxs']] for r in self.data],
+            [[float(ctx['score']) for ctx in r['hard_negative_ctxs']] for r in self.data],
+            kernel='square', a=a, b=b)
 
     def load_data(self):
         with open(self.file_path, 'r', encoding="utf-8") as f:
@@ -601,14 +606,17 @@ class TraditionDataset(Dataset):
 
         positive_passages = [create_passage(ctx) for ctx in positive_ctxs]
         hard_negative_passages = [create_passage(ctx) for ctx in hard_negative_ctxs]
+        # sampler positions index the negatives in file order
+        ranked_negative_passages = list(hard_negative_passages)
         if self.is_training:
             random.shuffle(hard_negative_passages)
 
         #hard_neg_ctxs = hard_negative_passages[0:self.num_hard_negatives]
         if self.shuffle_positives:
-            positive_passagese_ctx = random.choice(positive_passages)
+            pos_index = random.randrange(len(positive_passages))
         else:
-            positive_passagese_ctx = positive_passages[0]
+            pos_index = 0
+        positive_passagese_ctx = positive_passages[pos_index]
 
         pos_score = float(positive_passagese_ctx.score)
         if len(hard_negative_passages) < self.num_hard_negatives:
@@ -617,27 +625,8 @@ class TraditionDataset(Dataset):
         elif pos_score == 0:
             selected_hard_neg_ctxs = hard_negative_passages[-self.num_hard_negatives:]
         else:
-            neg_candidates = []
-            neg_scores = []
-            for pair in hard_negative_passages:
-                neg_score = float(pair.score)
-                neg_score = math.exp(-(neg_score - pos_score + self.b) ** 2 * self.a)
-                neg_candidates.append(pair.passage_id)
-                neg_scores.append(neg_score)
-
-            neg_ids_list = set()
-            while len(neg_ids_list) < self.num_hard_negatives:
-                neg_ids_list = neg_ids_list.union(random.choices(neg_candidates, weights=neg_scores, k=self.num_hard_negatives))
-                new_neg_candidates = []
-                new_neg_scores = []
-                for neg_id, neg_score in zip(neg_candidates, neg_scores):
-                    if neg_id not in neg_ids_list:
-                        new_neg_candidates.append(neg_id)
-                        new_neg_scores.append(neg_score)
-                neg_candidates = new_neg_candidates
-                neg_scores = new_neg_scores
-            selected_hard_neg_ctxs = [pair for pair in hard_negative_passages if pair.passage_id in neg_ids_list][0:self.num_hard_negatives]
-            #neg_ids_list = list(neg_ids_list)[0:self.num_hard_negatives]
+            selected_hard_neg_ctxs = [ranked_negative_passages[i] for i in
+                                      self.sampler.sample(index, pos_index, self.num_hard_negatives)]
 
         ctxs = [positive_passagese_ctx] + selected_hard_neg_ctxs
         ctx_token_ids = [self.tokenizer.encode(ctx.title, text_pair=ctx.text.strip(), add_special_tokens=True,
@@ -2,10 +2,12 @@ import faiss
 from tqdm import tqdm
 import pickle
 from torch.utils.data import DataLoader
+import time
 import logging
 
 logger = logging.getLogger("__main__")
 import torch
+from utils.retrieval_metrics import hit_list_metrics
 from utils.util import (
     is_first_worker,
 )
@@ -14,7 +16,12 @@ import numpy as np
 import torch.distributed as dist
 import csv
 import json
-from utils.dpr_utils import SimpleTokenizer, has_answer, Eval_Tool
+
+from utils.answer_match import AnswerMatcher
+from utils.embedding_shards import (
+    EmbeddingShardWriter, EmbeddingShards, checkpoint_fingerprint, write_manifest, reorder_by_ids
+)
+from utils.faiss_index import build_index_from_args
 
 
 class TextDataset(torch.utils.data.Dataset):
@@ -77,12 +84,16 @@ class Question_dataset(torch.utils.data.Dataset):
         return fn
 
 
-def embed_passages(args, passages, model, tokenizer):
+def embed_passages(args, passages, model, tokenizer, writer=None):
+    if writer is not None:
+        # streams into the shard memmap, resuming after the rows it already holds
+        passages = passages[writer.completed:]
     batch_size = 512
     collator = TextCollator(tokenizer, args.max_seq_length)
     dataset = TextDataset(passages)
     dataloader = DataLoader(dataset, batch_size=batch_size, drop_last=False, num_workers=15, collate_fn=collator)
     total = 0
+    start_time = time.time()
     allids, allembeddings = [], []
     with torch.no_grad():
         for k, (ids, text_ids, text_mask) in enumerate(tqdm(dataloader)):
@@ -94,11 +105,18 @@ def embed_passages(args, passages, model, tokenizer):
             embeddings = embs.detach().cpu()
             total += len(ids)
 
-            allids.append(ids)
-            allembeddings.append(embeddings)
+            if writer is not None:
+                writer.append(ids, embeddings.numpy())
+            else:
+                allids.append(ids)
+                allembeddings.append(embeddings)
             if k % 100 == 0:
-                logger.info('Encoded passages %d', total)
+                logger.info('Encoded passages %d, %.1f passages/sec', total, total / (time.time() - start_time))
 
+    logger.info('Encoded %d passages in %.1fs', total, time.time() - start_time)
+    if writer is not None:
+        writer.close()
+        return None, None
     allembeddings = torch.cat(allembeddings, dim=0).numpy()
     allids = np.array([x for idlist in allids for x in idlist])
     return allids, allembeddings
@@ -114,8 +132,7 @@ class V_dataset(torch.utils.data.Dataset):
         self.similar_scores = similar_scores
         self.query_embedding2id = query_embedding2id
         self.passage_embedding2id = passage_embedding2id
-        tok_opts = {}
-        self.tokenizer = SimpleTokenizer(**tok_opts)
+        self.matcher = AnswerMatcher()
 
     def __getitem__(self, query_idx):
         query_id = self.query_embedding2id[query_idx]
@@ -126,9 +143,10 @@ class V_dataset(torch.utils.data.Dataset):
         temp_result_dict['question'] = self.questions[query_id]
         temp_result_dict['answers'] = self.answers[query_id]
         temp_result_dict['ctxs'] = []
+        answer_tokens = self.matcher.answer_tokens(self.answers[query_id])
         for i, doc_id in enumerate(doc_ids):
             text, title = self.passages[doc_id]
-            hits.append(has_answer(self.answers[query_id], text, self.tokenizer))
+            hits.append(self.matcher.has_answer(answer_tokens, doc_id, text))
             temp_result_dict['ctxs'].append({'d_id': str(doc_id),
                                              'text': text,
                                              'title': title,
@@ -176,7 +194,7 @@ def validate(questions, passages, answers, closest_docs, similar_scores, query_e
     top_k_hits = [v / len(closest_docs) for v in top_k_hits]
     logger.info('Validation results: top k documents hits accuracy %s', top_k_hits)
 
-    return top_k_hits, final_scores, Eval_Tool.get_matrics(final_scores), final_result_dict_list
+    return top_k_hits, final_scores, hit_list_metrics(final_scores), final_result_dict_list
 
 
 def reform_out(result_dict_list, q_pos_dict):
@@ -236,41 +254,26 @@ class RenewTools:
                 os.makedirs(temp_dir)
         # dist.barrier()
 
-    def get_passage_embedding(self, args, model):
+    def get_passage_embedding(self, args, model, step=None, checkpoint=None):
+        """`checkpoint` is the file `model` was loaded from, an interrupted encode resumes only for the
+        same file; None (weights in memory) encodes every passage again"""
         if args.load_cache:
             pass
         else:
             passages_piece = self.passages
             logger.info(f'Embedding generation for {len(passages_piece)} passages')
-            allids, allembeddings = embed_passages(args, passages_piece, model, self.tokenizer)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(0, 'psg_embed'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allembeddings, handle, protocol=4)
-            pickle_path = os.path.join(self.temp_dir,
-                                       "{1}_data_obj_{0}.pb".format(0, 'psg_embed_id'))
-            with open(pickle_path, 'wb') as handle:
-                pickle.dump(allids, handle, protocol=4)
-            logger.info(f'Total passages processed {len(allids)}. Written to {pickle_path}.')
+            writer = EmbeddingShardWriter(self.temp_dir, 'psg_embed', 0, 0, len(self.passages), len(self.passages),
+                                          tag=checkpoint_fingerprint(checkpoint) if checkpoint else None)
+            embed_passages(args, passages_piece, model, self.tokenizer, writer=writer)
+            logger.info(f'Total passages processed {writer.completed}.')
         # dist.barrier()
         passage_embedding, passage_embedding_id = None, None
         if is_first_worker():
-            logger.info('load_passage_begin')
-            passage_embedding_list = []
-            passage_embedding_id_list = []
-            for i in tqdm(range(1)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'psg_embed'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_list.append(b)
-            logger.info('load_passage_id_begin')
-            for i in tqdm(range(1)):  # TODO: dynamically find the max instead of HardCode
-                pickle_path = os.path.join(self.temp_dir, "{1}_data_obj_{0}.pb".format(str(i), 'psg_embed_id'))
-                with open(pickle_path, 'rb') as handle:
-                    b = pickle.load(handle)
-                    passage_embedding_id_list.append(b)
-            passage_embedding = np.concatenate(passage_embedding_list, axis=0)
-            passage_embedding_id = np.concatenate(passage_embedding_id_list, axis=0)
+            if not args.load_cache:
+                write_manifest(self.temp_dir, 'psg_embed', 1, len(self.passages), step=step)
+            # one read-only memmap over every rank's rows, nothing is merged in memory
+            shards = EmbeddingShards(self.temp_dir, 'psg_embed')
+            passage_embedding, passage_embedding_id = shards.embeddings, shards.ids
             logger.info('load_passage_done')
         return passage_embedding, passage_embedding_id
 
@@ -299,30 +302,16 @@ class RenewTools:
         allids = np.array([x for idlist in allids for x in idlist])
         return allembeddings, allids
 
-    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id):
+    def get_new_faiss_index(self, args, passage_embedding, passage_embedding2id, queries=None):
 
         logger.info("***** Begin passage_embedding reorder *****")
-        new_passage_embedding = passage_embedding.copy()
-        for i in range(passage_embedding.shape[0]):
-            new_passage_embedding[passage_embedding2id[i]] = passage_embedding[i]
-        del (passage_embedding)
-        passage_embedding = new_passage_embedding
+        passage_embedding = reorder_by_ids(passage_embedding, passage_embedding2id)
         passage_embedding2id = np.arange(passage_embedding.shape[0])
         logger.info("***** end passage_embedding reorder  *****")
 
-        dim = passage_embedding.shape[1]
         faiss.omp_set_num_threads(90)
-        cpu_index = faiss.IndexFlatIP(dim)
-
-        co = faiss.GpuMultipleClonerOptions()
-        co.shard = True
-        co.useFloat16 = True
-        gpu_index_flat = faiss.index_cpu_to_all_gpus(  # build the index
-            cpu_index,
-            co=co
-        )
         logger.info("***** begin add passages  *****")
-        gpu_index_flat.add(passage_embedding.astype(np.float32))
+        gpu_index_flat = build_index_from_args(args, passage_embedding, queries=queries, use_float16=True)
         logger.info("***** end build index  *****")
         return gpu_index_flat, passage_embedding2id
 
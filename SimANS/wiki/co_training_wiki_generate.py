@@ -32,6 +32,7 @@ from utils.dpr_utils import (
     load_states_from_checkpoint,
     CheckpointState
 )
+from utils.faiss_index import add_index_args
 import collections
 retrieverBatch = collections.namedtuple(
     "BiENcoderInput",
@@ -177,6 +178,7 @@ def get_arguments():
     parser.add_argument("--ann_dir", type=str, default="", help="For distant debugging.")
 
     parser.add_argument("--global_step", type=int, default=0, help="For distant debugging.")
+    add_index_args(parser)
     args = parser.parse_args()
 
     return args
@@ -264,6 +266,7 @@ def get_model_obj(model: nn.Module):
     return model.module if hasattr(model, 'module') else model
 
 def get_new_dataset(args,model,global_step,renew_tools):
+    model_path = args.model_name_or_path
     if args.global_step!=0:
         model_path = os.path.join(args.output_dir, 'checkpoint-' + str(global_step))
         saved_state = load_states_from_checkpoint(model_path)
@@ -274,7 +277,8 @@ def get_new_dataset(args,model,global_step,renew_tools):
     model.eval()
     # model.to(args.device)
     with torch.no_grad():
-        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model)
+        passage_embedding, passage_embedding_id = renew_tools.get_passage_embedding(args, model, step=global_step,
+                                                                                    checkpoint=model_path)
         # torch.distributed.barrier()
         if is_first_worker():
             train_q,train_a,train_q_embed, train_q_embed2id = renew_tools.get_question_embedding(args,
@@ -285,7 +289,8 @@ def get_new_dataset(args,model,global_step,renew_tools):
                                                     model,args.test_qa_path,mode='test')
 
             gpu_index_flat, passage_embedding2id = renew_tools.get_new_faiss_index(args, passage_embedding,
-                                                                                   passage_embedding_id)
+                                                                                   passage_embedding_id,
+                                                                                   queries=dev_q_embed)
 
             renew_tools.get_question_topk(train_q,train_a,train_q_embed, train_q_embed2id, args.origin_data_dir,
                                                  gpu_index_flat, passage_embedding2id,